@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from . import metrics
+from .startup import lazy_import
+
+# Only AI uploads need an HTTP client; keep it out of the cold start
+httpx = lazy_import("httpx")
+
+logger = logging.getLogger(__name__)
+
+# AI gateway configuration; the API key is read per call (see gemini_api_key)
+GEMINI_API_URL = os.getenv(
+    "GEMINI_API_URL",
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:analyzeDiagram"
+)
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "5"))
+AI_READ_TIMEOUT = float(os.getenv("AI_READ_TIMEOUT", "60"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "10"))  # wait for a free slot before giving up
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "2"))
+AI_RETRY_BASE_MS = int(os.getenv("AI_RETRY_BASE_MS", "500"))
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "256"))
+AI_CACHE_TTL_SECONDS = float(os.getenv("AI_CACHE_TTL_SECONDS", "3600"))
+AI_MAX_IMAGE_BYTES = int(os.getenv("AI_MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+
+def gemini_api_key() -> Optional[str]:
+    """Read when used, so a .env loaded after this module is imported still applies"""
+    return os.getenv("GEMINI_API_KEY")
+
+
+# Upstream statuses worth retrying; everything else is final
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+ai_requests = metrics.registry.counter("ai_requests_total", "AI gateway calls by outcome", ("outcome",))
+ai_duration = metrics.registry.histogram(
+    "ai_upstream_seconds", "Latency of upstream AI calls, retries included",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+
+
+class AIGatewayError(Exception):
+    """An AI call that failed; carries the status the API should answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class AIGateway:
+    """Pooled async client for the AI provider with bounded concurrency, retries and a result cache.
+
+    Results are cached by the SHA-256 of the uploaded image, and identical
+    uploads already in flight share one upstream call.
+    """
+
+    def __init__(self):
+        self.client: Optional["httpx.AsyncClient"] = None
+        self.slots = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+        self.cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=AI_MAX_CONCURRENCY, max_keepalive_connections=AI_MAX_CONCURRENCY)
+            )
+
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _cached(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > AI_CACHE_TTL_SECONDS:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return result
+
+    def _remember(self, key: str, result: Dict[str, Any]):
+        self.cache[key] = (time.monotonic(), result)
+        self.cache.move_to_end(key)
+        while len(self.cache) > AI_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    async def clean_diagram(self, image: bytes, filename: str) -> Dict[str, Any]:
+        """Analyze a diagram image, answering repeated uploads from the cache"""
+        if not gemini_api_key():
+            raise AIGatewayError(500, "Gemini API key not configured.")
+        key = hashlib.sha256(image).hexdigest()
+        cached = self._cached(key)
+        if cached is not None:
+            ai_requests.inc("cache_hit")
+            return cached
+
+        shared = self.inflight.get(key)
+        if shared is None:
+            # The upstream call runs as its own task, so one uploader disconnecting
+            # does not cancel it for everyone else waiting on the same image
+            shared = asyncio.ensure_future(self._call_and_remember(key, image, filename))
+            self.inflight[key] = shared
+            shared.add_done_callback(lambda task: self._settled(key, task))
+        else:
+            ai_requests.inc("coalesced")
+        return await asyncio.shield(shared)
+
+    async def _call_and_remember(self, key: str, image: bytes, filename: str) -> Dict[str, Any]:
+        result = await self._call(image, filename)
+        self._remember(key, result)
+        return result
+
+    def _settled(self, key: str, task: asyncio.Future):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            # Waiters get the error; keep it from being reported as never retrieved
+            task.exception()
+
+    async def _call(self, image: bytes, filename: str) -> Dict[str, Any]:
+        try:
+            await asyncio.wait_for(self.slots.acquire(), AI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            ai_requests.inc("busy")
+            raise AIGatewayError(503, "AI service is busy, try again shortly")
+        started = time.perf_counter()
+        try:
+            self.start()
+            result = await self._post_with_retries(image, filename)
+            ai_requests.inc("ok")
+            return result
+        except AIGatewayError:
+            ai_requests.inc("error")
+            raise
+        finally:
+            ai_duration.observe(time.perf_counter() - started)
+            self.slots.release()
+
+    async def _post_with_retries(self, image: bytes, filename: str) -> Dict[str, Any]:
+        headers = {"Authorization": f"Bearer {gemini_api_key()}"}
+        for attempt in range(AI_MAX_RETRIES + 1):
+            final = attempt == AI_MAX_RETRIES
+            retry_after = None
+            try:
+                response = await self.client.post(GEMINI_API_URL, headers=headers, files={"file": (filename, image)})
+            except httpx.TimeoutException:
+                if final:
+                    raise AIGatewayError(504, "Gemini API timed out")
+                logger.warning("Gemini call timed out, retrying (attempt %d)", attempt + 1)
+            except httpx.TransportError as e:
+                if final:
+                    raise AIGatewayError(502, "Gemini API unreachable")
+                logger.warning("Gemini call failed, retrying (attempt %d): %s", attempt + 1, e)
+            else:
+                if response.status_code == 200:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        raise AIGatewayError(502, "Gemini API returned invalid JSON")
+                if response.status_code not in RETRYABLE_STATUSES or final:
+                    # Upstream bodies can be large or echo the request; keep the detail short
+                    raise AIGatewayError(502, f"Gemini API error {response.status_code}: {response.text[:200]}")
+                retry_after = response.headers.get("retry-after")
+                logger.warning("Gemini returned %d, retrying (attempt %d)", response.status_code, attempt + 1)
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+        raise AIGatewayError(502, "Gemini API error")
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), AI_READ_TIMEOUT)
+            except ValueError:
+                pass
+        # Full jitter keeps retries from a burst of uploads from arriving together
+        return random.uniform(0, AI_RETRY_BASE_MS / 1000.0 * (2 ** attempt))
+
+
+# Global AI gateway instance
+ai_gateway = AIGateway()
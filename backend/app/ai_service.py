@@ -1,19 +1,20 @@
 
-from fastapi import APIRouter, UploadFile, File, HTTPException, Body
+from fastapi import APIRouter, HTTPException, Body, Request, status
+from starlette.datastructures import UploadFile
 import os
+import logging
 from dotenv import load_dotenv
-import requests
+
+from .ai_gateway import AI_MAX_IMAGE_BYTES, AIGatewayError, ai_gateway
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 @router.post("/ai/predict-shape")
 async def predict_shape(data: dict = Body(...)):
-    import logging
-    logging.basicConfig(level=logging.INFO)
-    logging.info(f"Received shape prediction request: {data}")
     points = data.get('points', [])
+    logger.debug("Shape prediction request with %d points", len(points))
     if not points or len(points) < 2:
         return {"shape": None}
     # Simple heuristic: if start and end are close, and enough points, it's a circle
@@ -47,21 +48,32 @@ async def predict_shape(data: dict = Body(...)):
     miny, maxy = min(ys), max(ys)
     return {"shape": {"tool": "rect", "points": [{"x": minx, "y": miny}, {"x": maxx, "y": maxy}], "color": "#4b8", "width": 3}}
 
-@router.post("/ai/clean-diagram/")
-async def clean_diagram(file: UploadFile = File(...)):
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not configured.")
-    # Read image bytes
-    image_bytes = await file.read()
-    # Example Gemini API call (replace with actual endpoint and payload as needed)
-    headers = {"Authorization": f"Bearer {GEMINI_API_KEY}"}
-    files = {"file": (file.filename, image_bytes)}
-    # This is a placeholder URL and payload for Gemini API
-    response = requests.post(
-        "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:analyzeDiagram",
-        headers=headers,
-        files=files
-    )
-    if response.status_code != 200:
-        raise HTTPException(status_code=502, detail="Gemini API error: " + response.text)
-    return response.json()
+# Room for the multipart boundaries and part headers around the image
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+@router.post("/ai/clean-diagram/", openapi_extra={"requestBody": {"required": True, "content": {"multipart/form-data": {
+    "schema": {"type": "object", "properties": {"file": {"type": "string", "format": "binary"}}, "required": ["file"]}
+}}}})
+async def clean_diagram(request: Request):
+    # An UploadFile parameter would spool the whole body before we could look at it,
+    # so the declared length is checked first and the form parsed only if it fits
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED, detail="Content-Length required")
+    try:
+        too_large = int(content_length) > AI_MAX_IMAGE_BYTES + MULTIPART_OVERHEAD_BYTES
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Content-Length")
+    if too_large:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image too large")
+    form = await request.form(max_files=1, max_fields=1)
+    file = form.get("file")
+    if not isinstance(file, UploadFile):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Missing image file")
+    image_bytes = await file.read(AI_MAX_IMAGE_BYTES + 1)
+    if len(image_bytes) > AI_MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image too large")
+    try:
+        return await ai_gateway.clean_diagram(image_bytes, file.filename or "diagram.png")
+    except AIGatewayError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
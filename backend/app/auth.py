@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from passlib.context import CryptContext
 from jose import JWTError, jwt
@@ -6,18 +6,25 @@ from datetime import datetime, timedelta
 from typing import Optional
 import os
 
+from starlette.concurrency import run_in_threadpool
+
 from .models import UserCreate, UserLogin, UserResponse, Token, TokenData
 from .db import get_database
+from .responses import ModelResponse, from_document
 from bson import ObjectId
 
 # Security Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Users allowed to call the /admin endpoints
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+# EventSource cannot set headers, so event streams also take ?token=
+optional_security = HTTPBearer(auto_error=False)
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
@@ -58,12 +65,32 @@ async def authenticate_user(email: str, password: str):
     user = await get_user_by_email(email)
     if not user:
         return False
-    if not verify_password(password, user["password"]):
+    # bcrypt is deliberately slow; keep it off the event loop
+    if not await run_in_threadpool(verify_password, password, user["password"]):
         return False
     return user
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get current authenticated user"""
+    return await user_from_token(credentials.credentials)
+
+async def get_stream_user(
+    token: Optional[str] = Query(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Authenticated user for event streams: bearer header, or the token query parameter"""
+    if credentials is not None:
+        return await user_from_token(credentials.credentials)
+    if token:
+        return await user_from_token(token)
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Not authenticated",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+async def user_from_token(token: str):
+    """User named by a JWT access token"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -71,7 +98,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     )
     
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str | None = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -85,6 +112,15 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     
     return user
 
+async def get_admin_user(current_user: dict = Depends(get_current_user)):
+    """Require an authenticated user listed in ADMIN_EMAILS"""
+    if current_user.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return current_user
+
 @router.post("/register", response_model=Token)
 async def register_user(user_data: UserCreate):
     """Register a new user"""
@@ -107,7 +143,7 @@ async def register_user(user_data: UserCreate):
         )
     
     # Hash password and create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await run_in_threadpool(get_password_hash, user_data.password)
     user_doc = {
         "username": user_data.username,
         "email": user_data.email,
@@ -119,8 +155,7 @@ async def register_user(user_data: UserCreate):
     }
     
     # Insert user into database
-    result = await db.users.insert_one(user_doc)
-    user_doc["_id"] = str(result.inserted_id)
+    await db.users.insert_one(user_doc)
     
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -128,10 +163,7 @@ async def register_user(user_data: UserCreate):
         data={"sub": user_data.email}, expires_delta=access_token_expires
     )
     
-    # Create user response
-    user_response = UserResponse(**user_doc)
-    
-    return Token(access_token=access_token, user=user_response)
+    return ModelResponse(Token.model_construct(access_token=access_token, user=from_document(UserResponse, user_doc)))
 
 @router.post("/login", response_model=Token)
 async def login_user(form_data: UserLogin):
@@ -157,17 +189,12 @@ async def login_user(form_data: UserLogin):
         data={"sub": user["email"]}, expires_delta=access_token_expires
     )
     
-    # Create user response
-    user["_id"] = str(user["_id"])
-    user_response = UserResponse(**user)
-    
-    return Token(access_token=access_token, user=user_response)
+    return ModelResponse(Token.model_construct(access_token=access_token, user=from_document(UserResponse, user)))
 
 @router.get("/me", response_model=UserResponse)
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Get current user information"""
-    current_user["_id"] = str(current_user["_id"])
-    return UserResponse(**current_user)
+    return ModelResponse(from_document(UserResponse, current_user))
 
 @router.post("/logout")
 async def logout():
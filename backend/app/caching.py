@@ -0,0 +1,206 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from fastapi import Request
+
+from .compression import compress
+
+# Response cache configuration (set DIAGRAM_CACHE_SIZE=0 to disable)
+DIAGRAM_CACHE_SIZE = int(os.getenv("DIAGRAM_CACHE_SIZE", "256"))
+DIAGRAM_CACHE_TTL = float(os.getenv("DIAGRAM_CACHE_TTL", "30"))
+EXPORT_CACHE_BYTES = int(os.getenv("EXPORT_CACHE_BYTES", str(64 * 1024 * 1024)))
+EXPORT_CACHE_MAX_ITEM_BYTES = int(os.getenv("EXPORT_CACHE_MAX_ITEM_BYTES", str(8 * 1024 * 1024)))
+
+
+def diagram_etag(diagram_id: str, version: int) -> str:
+    """Build a strong ETag from the diagram id and its version counter"""
+    return f'"{diagram_id}-{version}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check an If-None-Match header against the current ETag"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return etag in candidates
+
+
+def http_date(value: datetime) -> str:
+    """Format a naive UTC datetime as an HTTP date"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value, usegmt=True)
+
+
+def ceil_to_second(value: datetime) -> datetime:
+    """Round a timestamp up to the whole second an HTTP date can express"""
+    if value.microsecond:
+        return value.replace(microsecond=0) + timedelta(seconds=1)
+    return value
+
+
+def stable_last_modified(value: Optional[datetime]) -> Optional[datetime]:
+    """Last-Modified value safe to hand out, or None while its second is still open"""
+    if value is None:
+        return None
+    rounded = ceil_to_second(value)
+    # A later write in the same second would otherwise share this validator
+    if rounded > datetime.utcnow():
+        return None
+    return rounded
+
+
+def not_modified_since(request: Request, last_modified: Optional[datetime]) -> bool:
+    """Check an If-Modified-Since header against a naive UTC timestamp"""
+    header = request.headers.get("if-modified-since")
+    if not header or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return ceil_to_second(last_modified) <= since
+
+
+class CachedDiagram:
+    """A serialized diagram body, its validators and compressed variants"""
+
+    __slots__ = ("version", "etag", "body", "variants", "is_public", "updated_at", "stored_at")
+
+    def __init__(self, diagram: Dict[str, Any], etag: str, body: bytes):
+        self.version = diagram.get("version", 0)
+        self.etag = etag
+        self.body = body
+        self.variants: Dict[str, bytes] = {}
+        self.is_public = diagram.get("is_public", False)
+        self.updated_at = diagram.get("updated_at")
+        self.stored_at = time.monotonic()
+
+    def encoded(self, encoding: str) -> bytes:
+        """Compressed body for a content coding, computed once per version"""
+        variant = self.variants.get(encoding)
+        if variant is None:
+            variant = self.variants[encoding] = compress(self.body, encoding)
+        return variant
+
+
+class DiagramResponseCache:
+    """In-process LRU of serialized public diagram bodies keyed by diagram id"""
+
+    def __init__(self, max_entries: int = DIAGRAM_CACHE_SIZE, ttl: float = DIAGRAM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, CachedDiagram]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, diagram_id: str) -> Optional[CachedDiagram]:
+        if not self.enabled:
+            return None
+        entry = self.entries.get(diagram_id)
+        if entry is None:
+            return None
+        # Other workers may have written since; bound staleness with a TTL
+        if time.monotonic() - entry.stored_at > self.ttl:
+            del self.entries[diagram_id]
+            return None
+        self.entries.move_to_end(diagram_id)
+        return entry
+
+    def put(self, diagram_id: str, entry: CachedDiagram):
+        if not self.enabled or not entry.is_public:
+            return
+        self.entries[diagram_id] = entry
+        self.entries.move_to_end(diagram_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, diagram_id: str):
+        self.entries.pop(diagram_id, None)
+
+
+class RenderedExport:
+    """A rendered export body, with its media type when the key does not imply it"""
+
+    __slots__ = ("body", "media_type")
+
+    def __init__(self, body: bytes, media_type: Optional[str] = None):
+        self.body = body
+        self.media_type = media_type
+
+
+class RenderCache:
+    """Byte-bounded LRU of rendered outputs keyed by (diagram_id, version, ...)"""
+
+    def __init__(self, max_bytes: int = EXPORT_CACHE_BYTES, max_item_bytes: int = EXPORT_CACHE_MAX_ITEM_BYTES):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.size = 0
+        self.entries: "OrderedDict[tuple, RenderedExport]" = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[RenderedExport]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: RenderedExport):
+        if len(entry.body) > self.max_item_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+        self.entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+
+# Global cache instances
+diagram_cache = DiagramResponseCache()
+export_cache = RenderCache()
+
+
+async def touch_listing_watermark(db, user_filter: Optional[Dict[str, Any]] = None, public: bool = False):
+    """Record that diagrams left a listing, since updated_at alone cannot show removals"""
+    now = datetime.utcnow()
+    if user_filter:
+        await db.users.update_many(user_filter, {"$set": {"listings_changed_at": now}})
+    if public:
+        await db.listing_watermarks.update_one(
+            {"_id": "public"},
+            {"$set": {"changed_at": now}},
+            upsert=True
+        )
+
+
+async def listing_last_modified(db, query: Dict[str, Any], watermark: Optional[datetime], include_chat: bool = False) -> Optional[datetime]:
+    """Latest updated_at (and chat activity, when listed) across every diagram matching a listing query"""
+    fields = ("updated_at", "chat_at") if include_chat else ("updated_at",)
+    candidates = [watermark] if watermark else []
+    for field in fields:
+        latest = await db.diagrams.find_one(query, projection={field: 1}, sort=[(field, -1)])
+        if latest and latest.get(field):
+            candidates.append(latest[field])
+    return max(candidates) if candidates else None
+
+
+def page_last_modified(diagrams, watermark: Optional[datetime], include_chat: bool = False) -> Optional[datetime]:
+    """Latest updated_at (and chat activity, when listed) within a fetched page of diagrams"""
+    fields = ("updated_at", "chat_at") if include_chat else ("updated_at",)
+    candidates = [diagram[field] for diagram in diagrams for field in fields if diagram.get(field)]
+    if watermark:
+        candidates.append(watermark)
+    return max(candidates) if candidates else None
@@ -3,17 +3,27 @@ from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
 
-from .models import ChatMessage, ChatMessageResponse, ChatMessageCreate
-from .auth import get_current_user
+from .models import ChatMessage, ChatMessageResponse, ChatMessageCreate, ChatSearchHit, ChatSearchResponse
+from .auth import get_current_user, get_stream_user
 from .db import get_database
+from .chat_cache import normalize_chat_message, recent_chat
+from .chat_pipeline import chat_message_document, chat_pipeline
+from .sharding import require_room_owner
+from .sse import event_stream, sse_manager, sse_response
+from .unread import unread_tracker
+from .responses import ModelResponse, from_document
+from .chat_search import SEARCH_SORTS, encode_cursor, query_terms, search_excerpt, search_pipeline
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
-async def verify_diagram_access(diagram_id: str, user: dict, db: AsyncIOMotorDatabase):
+MAX_EMOJI_LENGTH = 32
+
+async def verify_diagram_access(diagram_id: str, user: dict, db: AsyncIOMotorDatabase, projection: Optional[dict] = None):
     """Verify user has access to diagram"""
     try:
-        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, projection)
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -45,7 +55,7 @@ async def verify_diagram_access(diagram_id: str, user: dict, db: AsyncIOMotorDat
     
     return diagram
 
-@router.post("/{diagram_id}/messages", response_model=ChatMessageResponse)
+@router.post("/{diagram_id}/messages", response_model=ChatMessageResponse, dependencies=[Depends(require_room_owner)])
 async def send_chat_message(
     diagram_id: str,
     message_data: ChatMessageCreate,
@@ -55,31 +65,19 @@ async def send_chat_message(
     db: AsyncIOMotorDatabase = get_database()
     
     # Verify diagram access
-    await verify_diagram_access(diagram_id, current_user, db)
-    
-    # Create chat message
-    chat_message = {
-        "diagram_id": diagram_id,
-        "user_id": str(current_user["_id"]),
-        "username": current_user["username"],
-        "user_avatar": current_user.get("avatar"),
-        "message": message_data.message,
-        "message_type": message_data.message_type,
-        "reply_to": message_data.reply_to,
-        "created_at": datetime.utcnow(),
-        "is_edited": False,
-        "is_deleted": False,
-        "reactions": {}
-    }
-    
-    # Insert message into database
-    result = await db.chat_messages.insert_one(chat_message)
-    chat_message["_id"] = str(result.inserted_id)
-    chat_message["id"] = str(result.inserted_id)  # Add id field for frontend compatibility
-    
-    return ChatMessageResponse(**chat_message)
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    
+    # Persisted by the chat pipeline, which also fans it out to live subscribers
+    chat_message = await chat_pipeline.submit(chat_message_document(
+        diagram_id,
+        current_user,
+        message_data.message,
+        message_data.message_type,
+        message_data.reply_to
+    ))
+    return ModelResponse(from_document(ChatMessageResponse, chat_message))
 
-@router.get("/{diagram_id}/messages", response_model=List[ChatMessageResponse])
+@router.get("/{diagram_id}/messages", response_model=List[ChatMessageResponse], dependencies=[Depends(require_room_owner)])
 async def get_chat_messages(
     diagram_id: str,
     current_user: dict = Depends(get_current_user),
@@ -90,31 +88,71 @@ async def get_chat_messages(
     db: AsyncIOMotorDatabase = get_database()
     
     # Verify diagram access
-    await verify_diagram_access(diagram_id, current_user, db)
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    
+    # Small chats live entirely in the recent-message ring
+    recent = await chat_pipeline.recent_messages(diagram_id)
+    if recent.complete:
+        return ModelResponse([from_document(ChatMessageResponse, message) for message in recent.page(skip, limit)])
     
     # Get messages from database
     messages = await db.chat_messages.find(
         {"diagram_id": diagram_id, "is_deleted": False}
     ).sort("created_at", 1).skip(skip).limit(limit).to_list(length=limit)
+    if len(messages) < limit:
+        # The last page also shows messages still waiting in the write buffer
+        stored = {message["_id"] for message in messages}
+        messages += [m for m in chat_pipeline.pending if m["diagram_id"] == diagram_id and m["_id"] not in stored][:limit - len(messages)]
+    return ModelResponse([
+        from_document(ChatMessageResponse, normalize_chat_message(message)) for message in messages
+    ])
+
+@router.get("/{diagram_id}/search", response_model=ChatSearchResponse, dependencies=[Depends(require_room_owner)])
+async def search_chat_messages(
+    diagram_id: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    sort: str = Query("relevance"),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """Full-text search over a diagram's chat messages"""
+    db: AsyncIOMotorDatabase = get_database()
     
-    # Convert ObjectId to string and format response
-    for message in messages:
-        message["_id"] = str(message["_id"])
-        message["id"] = message["_id"]  # Add id field for frontend compatibility
-        
-        # Handle missing fields for backward compatibility
-        if "message_type" not in message:
-            message["message_type"] = "text"
-        if "reactions" not in message:
-            message["reactions"] = {}
-        if "is_edited" not in message:
-            message["is_edited"] = False
-        if "is_deleted" not in message:
-            message["is_deleted"] = False
-    
-    return [ChatMessageResponse(**message) for message in messages]
+    if sort not in SEARCH_SORTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"sort must be one of {', '.join(SEARCH_SORTS)}"
+        )
+    
+    # Verify diagram access
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    
+    try:
+        pipeline = search_pipeline(diagram_id, q, sort, limit, cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid search cursor"
+        )
+    hits = await db.chat_messages.aggregate(pipeline).to_list(length=limit + 1)
+    
+    next_cursor = encode_cursor(sort, hits[limit - 1]) if len(hits) > limit else None
+    terms = query_terms(q)
+    results = []
+    for hit in hits[:limit]:
+        score = hit.pop("score")
+        excerpt, highlights = search_excerpt(hit["message"], terms)
+        results.append(ChatSearchHit.model_construct(
+            message=from_document(ChatMessageResponse, normalize_chat_message(hit)),
+            score=score,
+            excerpt=excerpt,
+            highlights=highlights
+        ))
+    
+    return ModelResponse(ChatSearchResponse.model_construct(results=results, next_cursor=next_cursor))
 
-@router.put("/{diagram_id}/messages/{message_id}", response_model=ChatMessageResponse)
+@router.put("/{diagram_id}/messages/{message_id}", response_model=ChatMessageResponse, dependencies=[Depends(require_room_owner)])
 async def edit_chat_message(
     diagram_id: str,
     message_id: str,
@@ -125,16 +163,18 @@ async def edit_chat_message(
     db: AsyncIOMotorDatabase = get_database()
     
     # Verify diagram access
-    await verify_diagram_access(diagram_id, current_user, db)
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
     
     # Get the message
     try:
-        message = await db.chat_messages.find_one({"_id": ObjectId(message_id)})
+        message_oid = ObjectId(message_id)
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid message ID"
         )
+    await chat_pipeline.ensure_persisted(message_oid)
+    message = await db.chat_messages.find_one({"_id": message_oid})
     
     if not message:
         raise HTTPException(
@@ -167,6 +207,7 @@ async def edit_chat_message(
         {"_id": ObjectId(message_id)},
         {"$set": update_data}
     )
+    recent_chat.update(diagram_id, message_id, update_data)
     
     # Return updated message
     updated_message = await db.chat_messages.find_one({"_id": ObjectId(message_id)})
@@ -176,11 +217,9 @@ async def edit_chat_message(
             detail="Message not found after update"
         )
     
-    updated_message["_id"] = str(updated_message["_id"])
-    
-    return ChatMessageResponse(**updated_message)
+    return ModelResponse(from_document(ChatMessageResponse, normalize_chat_message(updated_message)))
 
-@router.delete("/{diagram_id}/messages/{message_id}")
+@router.delete("/{diagram_id}/messages/{message_id}", dependencies=[Depends(require_room_owner)])
 async def delete_chat_message(
     diagram_id: str,
     message_id: str,
@@ -190,16 +229,18 @@ async def delete_chat_message(
     db: AsyncIOMotorDatabase = get_database()
     
     # Verify diagram access  
-    diagram = await verify_diagram_access(diagram_id, current_user, db)
+    diagram = await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
     
     # Get the message
     try:
-        message = await db.chat_messages.find_one({"_id": ObjectId(message_id)})
+        message_oid = ObjectId(message_id)
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid message ID"
         )
+    await chat_pipeline.ensure_persisted(message_oid)
+    message = await db.chat_messages.find_one({"_id": message_oid})
     
     if not message:
         raise HTTPException(
@@ -218,12 +259,13 @@ async def delete_chat_message(
     # Soft delete the message
     await db.chat_messages.update_one(
         {"_id": ObjectId(message_id)},
-        {"$set": {"is_deleted": True, "updated_at": datetime.utcnow()}}
+        {"$set": {"is_deleted": True, "updated_at": datetime.utcnow(), "deleted_at": datetime.utcnow()}}
     )
+    recent_chat.remove(diagram_id, message_id)
     
     return {"message": "Chat message deleted successfully"}
 
-@router.post("/{diagram_id}/messages/{message_id}/reactions")
+@router.post("/{diagram_id}/messages/{message_id}/reactions", dependencies=[Depends(require_room_owner)])
 async def add_reaction(
     diagram_id: str,
     message_id: str,
@@ -234,42 +276,119 @@ async def add_reaction(
     db: AsyncIOMotorDatabase = get_database()
     
     # Verify diagram access
-    await verify_diagram_access(diagram_id, current_user, db)
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    
+    # Emoji become field names, so they must not act as paths or operators
+    if not emoji or len(emoji) > MAX_EMOJI_LENGTH or "." in emoji or emoji.startswith("$"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid emoji"
+        )
     
-    # Get the message
     try:
-        message = await db.chat_messages.find_one({"_id": ObjectId(message_id)})
+        message_oid = ObjectId(message_id)
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid message ID"
         )
+    await chat_pipeline.ensure_persisted(message_oid)
     
-    if not message or message.get("is_deleted", False):
+    user_id = str(current_user["_id"])
+    field = f"reactions.{emoji}"
+    live = {"_id": message_oid, "diagram_id": diagram_id, "is_deleted": False}
+    
+    # Toggle with conditional server-side updates so concurrent reactions never overwrite each other
+    message = None
+    for _ in range(3):
+        message = await db.chat_messages.find_one_and_update(
+            {**live, field: {"$ne": user_id}},
+            {"$addToSet": {field: user_id}},
+            projection={"reactions": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if message:
+            action = "added"
+            break
+        message = await db.chat_messages.find_one_and_update(
+            {**live, field: user_id},
+            {"$pull": {field: user_id}},
+            projection={"reactions": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if message:
+            action = "removed"
+            # Remove empty reaction lists, unless someone reacted in the meantime
+            await db.chat_messages.update_one({**live, field: {"$size": 0}}, {"$unset": {field: ""}})
+            break
+    
+    if not message:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Message not found"
         )
     
-    user_id = str(current_user["_id"])
-    reactions = message.get("reactions", {})
+    reactions = {key: users for key, users in (message.get("reactions") or {}).items() if users}
+    recent_chat.update(diagram_id, message_id, {"reactions": reactions})
+    
+    # Subscribers only need the change, not the whole map
+    await chat_pipeline.broadcast(diagram_id, {
+        "type": "reaction_update",
+        "data": {
+            "message_id": message_id,
+            "emoji": emoji,
+            "user_id": user_id,
+            "action": action,
+            "count": len(reactions.get(emoji, []))
+        },
+        "timestamp": datetime.utcnow().isoformat()
+    })
+    
+    return {"message": "Reaction updated successfully", "reactions": reactions}
+
+@router.post("/{diagram_id}/read", dependencies=[Depends(require_room_owner)])
+async def mark_chat_read(
+    diagram_id: str,
+    seq: Optional[int] = Query(None, ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    """Mark a diagram's chat as read, up to the latest message by default"""
+    db: AsyncIOMotorDatabase = get_database()
     
-    # Toggle reaction
-    if emoji not in reactions:
-        reactions[emoji] = []
+    # Verify diagram access
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
     
-    if user_id in reactions[emoji]:
-        reactions[emoji].remove(user_id)
-        if not reactions[emoji]:  # Remove empty reaction lists
-            del reactions[emoji]
-    else:
-        reactions[emoji].append(user_id)
+    user_id = str(current_user["_id"])
+    seq = await unread_tracker.mark_read(user_id, diagram_id, seq)
     
-    # Update message reactions
-    await db.chat_messages.update_one(
-        {"_id": ObjectId(message_id)},
-        {"$set": {"reactions": reactions}}
-    )
+    # Read receipts for everyone else in the room
+    await chat_pipeline.broadcast(diagram_id, {
+        "type": "read_receipt",
+        "data": {"user_id": user_id, "username": current_user["username"], "seq": seq},
+        "timestamp": datetime.utcnow().isoformat()
+    })
     
-    return {"message": "Reaction updated successfully", "reactions": reactions}
+    return {"diagram_id": diagram_id, "last_read_seq": seq}
 
+@router.get("/unread")
+async def get_unread_counts(current_user: dict = Depends(get_current_user)):
+    """Unread chat counts for every diagram the user owns or collaborates on"""
+    db: AsyncIOMotorDatabase = get_database()
+    diagrams = await unread_tracker.unread_counts(db, current_user)
+    return {str(diagram["_id"]): diagram["unread_count"] for diagram in diagrams}
+
+@router.get("/unread/stream")
+async def stream_unread_counts(current_user: dict = Depends(get_stream_user)):
+    """Server-Sent Events with unread count changes, so dashboards need not poll"""
+    db: AsyncIOMotorDatabase = get_database()
+    user_id = str(current_user["_id"])
+    
+    queue = sse_manager.add_user_connection(user_id)
+    counts = await unread_tracker.subscribe(db, current_user)
+    sse_manager.send_to_user(user_id, {"type": "unread_snapshot", "counts": counts})
+    
+    def close():
+        sse_manager.remove_user_connection(user_id, queue)
+        unread_tracker.unsubscribe(user_id)
+    
+    return sse_response(event_stream(queue, close))
@@ -0,0 +1,114 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+# Recent chat cache configuration
+CHAT_RECENT_SIZE = int(os.getenv("CHAT_RECENT_SIZE", "100"))
+CHAT_CACHE_ROOMS = int(os.getenv("CHAT_CACHE_ROOMS", "1000"))
+
+
+def normalize_chat_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy a stored chat message into the shape ChatMessageResponse expects"""
+    message = dict(message)
+    message["_id"] = str(message["_id"])
+    message["id"] = message["_id"]  # Add id field for frontend compatibility
+
+    # Handle missing fields for backward compatibility
+    message.setdefault("message_type", "text")
+    message.setdefault("is_edited", False)
+    message.setdefault("is_deleted", False)
+    message["reactions"] = dict(message.get("reactions") or {})
+    return message
+
+
+class RecentChat:
+    """The newest messages of one diagram, oldest first"""
+
+    def __init__(self, size: int):
+        self.messages: Deque[Dict[str, Any]] = deque(maxlen=size)
+        # True while the ring holds every live message the diagram has
+        self.complete = False
+        self.ready = asyncio.Event()
+
+    def append(self, message: Dict[str, Any]):
+        if len(self.messages) == self.messages.maxlen:
+            self.complete = False
+        self.messages.append(message)
+
+    def find(self, message_id: str) -> Optional[Dict[str, Any]]:
+        for message in reversed(self.messages):
+            if message["_id"] == message_id:
+                return message
+        return None
+
+    def page(self, skip: int, limit: int) -> List[Dict[str, Any]]:
+        return list(self.messages)[skip:skip + limit]
+
+
+class RecentChatCache:
+    """Per-diagram ring buffers of recent chat messages, kept in sync with writes"""
+
+    def __init__(self, size: int = CHAT_RECENT_SIZE, max_rooms: int = CHAT_CACHE_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms: "OrderedDict[str, RecentChat]" = OrderedDict()
+
+    async def get(self, db, diagram_id: str, pending: Iterable[Dict[str, Any]] = ()) -> RecentChat:
+        """Return a diagram's ring, loading it from MongoDB on first use"""
+        room = self.rooms.get(diagram_id)
+        if room is not None:
+            self.rooms.move_to_end(diagram_id)
+            await room.ready.wait()
+            return room
+
+        room = RecentChat(self.size)
+        self.rooms[diagram_id] = room
+        while len(self.rooms) > self.max_rooms:
+            self.rooms.popitem(last=False)
+
+        # Messages still waiting in the write buffer are not in MongoDB yet
+        unsaved = [normalize_chat_message(m) for m in pending if m["diagram_id"] == diagram_id]
+        try:
+            stored = await db.chat_messages.find(
+                {"diagram_id": diagram_id, "is_deleted": False}
+            ).sort("created_at", -1).limit(self.size + 1).to_list(length=self.size + 1)
+        except Exception:
+            self.rooms.pop(diagram_id, None)
+            room.ready.set()
+            raise
+
+        # Merge with anything appended while the query was running
+        merged: Dict[str, Dict[str, Any]] = {}
+        for message in [normalize_chat_message(m) for m in stored] + unsaved + list(room.messages):
+            merged[message["_id"]] = message
+        ordered = sorted(merged.values(), key=lambda m: (m["created_at"], m["_id"]))
+        room.messages.clear()
+        room.messages.extend(ordered[-self.size:])
+        room.complete = len(stored) <= self.size and len(ordered) <= self.size
+        room.ready.set()
+        return room
+
+    def append(self, chat_message: Dict[str, Any]):
+        room = self.rooms.get(chat_message["diagram_id"])
+        if room is not None:
+            room.append(normalize_chat_message(chat_message))
+
+    def update(self, diagram_id: str, message_id: str, fields: Dict[str, Any]):
+        room = self.rooms.get(diagram_id)
+        message = room.find(message_id) if room is not None else None
+        if message is not None:
+            message.update(fields)
+
+    def remove(self, diagram_id: str, message_id: str):
+        room = self.rooms.get(diagram_id)
+        message = room.find(message_id) if room is not None else None
+        if message is not None:
+            room.messages.remove(message)
+
+    def drop(self, diagram_id: str):
+        self.rooms.pop(diagram_id, None)
+
+
+# Global recent chat cache instance
+recent_chat = RecentChatCache()
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, status
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .chat_cache import RecentChat, recent_chat
+from .db import get_collection, get_database
+from . import metrics
+from .sse import broadcast_chat_message, sse_manager
+from .unread import unread_tracker
+
+logger = logging.getLogger(__name__)
+
+# Chat write pipeline configuration
+CHAT_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "25"))
+CHAT_FLUSH_BATCH_SIZE = int(os.getenv("CHAT_FLUSH_BATCH_SIZE", "500"))
+CHAT_MAX_PENDING = int(os.getenv("CHAT_MAX_PENDING", "10000"))
+CHAT_RETRY_MAX_SECONDS = 5.0
+
+
+def chat_message_document(diagram_id: str, user: dict, message: str, message_type: str = "text", reply_to: Optional[str] = None) -> Dict[str, Any]:
+    """Build a chat message with its id assigned up front"""
+    return {
+        "_id": ObjectId(),
+        "diagram_id": diagram_id,
+        "user_id": str(user["_id"]),
+        "username": user["username"],
+        "user_avatar": user.get("avatar"),
+        "message": message,
+        "message_type": message_type,
+        "reply_to": reply_to,
+        "created_at": datetime.utcnow(),
+        "is_edited": False,
+        "is_deleted": False,
+        "reactions": {}
+    }
+
+
+def chat_broadcast_data(chat_message: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a stored chat message the way WebSocket clients expect it"""
+    return {
+        "id": str(chat_message["_id"]),
+        "message": chat_message["message"],
+        "message_type": chat_message["message_type"],
+        "reply_to": chat_message["reply_to"],
+        "user": {
+            "id": chat_message["user_id"],
+            "username": chat_message["username"],
+            "avatar": chat_message.get("user_avatar")
+        },
+        "created_at": chat_message["created_at"].isoformat(),
+        "is_edited": chat_message.get("is_edited", False),
+        "reactions": chat_message.get("reactions", {})
+    }
+
+
+class ChatPipeline:
+    """Fan chat messages out immediately and persist them in grouped writes.
+
+    Ids are assigned before the write, so a batch that is retried after a
+    partial failure only re-inserts what is missing: duplicate-key errors
+    mean the message is already stored. Delivery to MongoDB is therefore
+    at-least-once with idempotent ids.
+    """
+
+    def __init__(self):
+        self.pending: List[Dict[str, Any]] = []
+        self.pending_ids: set = set()
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.flush_lock = asyncio.Lock()
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # Persist whatever is still buffered before shutting down
+        while self.pending:
+            if not await self.flush():
+                logger.error("Dropping %d unsaved chat messages on shutdown", len(self.pending))
+                break
+
+    async def submit(self, chat_message: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue a chat message for persistence and broadcast it to subscribers"""
+        if self.task is None:
+            # No background flusher (e.g. scripts): write through
+            await get_collection("chat_messages", "chat").insert_one(chat_message)
+        else:
+            if len(self.pending) >= CHAT_MAX_PENDING:
+                # The database is falling behind; hold the sender until it catches up,
+                # and refuse the message rather than buffer without bound if it cannot
+                await self.flush()
+                if len(self.pending) >= CHAT_MAX_PENDING:
+                    raise HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="Chat storage is unavailable, try again shortly"
+                    )
+            self.pending.append(chat_message)
+            self.pending_ids.add(chat_message["_id"])
+            self.wakeup.set()
+        recent_chat.append(chat_message)
+        await self.publish(chat_message)
+        return chat_message
+
+    async def publish(self, chat_message: Dict[str, Any]):
+        from .websocket import manager
+
+        diagram_id = chat_message["diagram_id"]
+        data = chat_broadcast_data(chat_message)
+        await manager.broadcast_to_diagram(diagram_id, {
+            "type": "chat_message",
+            "data": data,
+            "timestamp": datetime.utcnow().isoformat()
+        })
+        await broadcast_chat_message(diagram_id, data)
+        # Everyone connected to the room sees the message as it arrives
+        readers = [user["id"] for user in manager.get_diagram_users(diagram_id)]
+        await unread_tracker.on_message(diagram_id, chat_message["user_id"], readers)
+
+    async def broadcast(self, diagram_id: str, event: Dict[str, Any]):
+        """Send a chat event to WebSocket and SSE subscribers of a diagram"""
+        from .websocket import manager
+
+        await manager.broadcast_to_diagram(diagram_id, event)
+        await sse_manager.broadcast_to_diagram(diagram_id, event)
+
+    async def recent_messages(self, diagram_id: str) -> RecentChat:
+        """The cached tail of a diagram's chat, including messages not yet written"""
+        return await recent_chat.get(get_database(), diagram_id, self.pending)
+
+    async def ensure_persisted(self, message_id: ObjectId):
+        """Flush early when a request needs a message that is still buffered"""
+        # Flushes go oldest first, a batch at a time, until the message is written
+        while message_id in self.pending_ids:
+            if not await self.flush():
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Chat storage is unavailable, try again shortly"
+                )
+
+    async def flush(self) -> bool:
+        """Write buffered messages; returns False if the batch has to be retried"""
+        async with self.flush_lock:
+            batch = self.pending[:CHAT_FLUSH_BATCH_SIZE]
+            if not batch:
+                return True
+            try:
+                await get_collection("chat_messages", "chat").insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    # Only codes and messages; writeErrors also echo the message documents
+                    errors = [(error.get("code"), error.get("errmsg")) for error in e.details.get("writeErrors", [])[:3]]
+                    logger.error("Chat batch write failed: %s", errors)
+                    return False
+            except PyMongoError as e:
+                logger.error("Chat batch write failed: %s", e)
+                return False
+            del self.pending[:len(batch)]
+            for chat_message in batch:
+                self.pending_ids.discard(chat_message["_id"])
+            return True
+
+    async def _run(self):
+        delay = 0.0
+        while True:
+            await self.wakeup.wait()
+            # Let a burst accumulate into one insert_many
+            await asyncio.sleep(max(CHAT_FLUSH_INTERVAL_MS / 1000.0, delay))
+            self.wakeup.clear()
+            try:
+                ok = await self.flush()
+            except Exception as e:
+                logger.error("Chat flusher error: %s", e)
+                ok = False
+            if ok:
+                delay = 0.0
+            else:
+                delay = min(CHAT_RETRY_MAX_SECONDS, max(0.1, delay * 2))
+            if self.pending:
+                self.wakeup.set()
+
+
+# Global chat pipeline instance
+chat_pipeline = ChatPipeline()
+
+metrics.registry.gauge(
+    "chat_pending_messages", "Chat messages broadcast but not yet persisted",
+    collect=lambda: [((), len(chat_pipeline.pending))]
+)
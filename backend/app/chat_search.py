@@ -0,0 +1,91 @@
+import base64
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+# Characters of context kept on each side of the first hit
+EXCERPT_CONTEXT = 60
+
+SEARCH_SORTS = ("relevance", "recent")
+
+
+def query_terms(query: str) -> List[str]:
+    """Words to highlight: everything in the query except negated terms"""
+    terms = []
+    for word in re.findall(r'-?"[^"]*"|-?\S+', query):
+        if word.startswith("-"):
+            continue
+        terms.extend(re.findall(r"\w+", word.lower()))
+    return sorted(set(terms), key=len, reverse=True)
+
+
+def encode_cursor(sort: str, hit: Dict[str, Any]) -> str:
+    position = {"id": str(hit["_id"])}
+    if sort == "relevance":
+        position["s"] = hit["score"]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[ObjectId, Optional[float]]:
+    """Decode a search cursor; raises ValueError if it was tampered with"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        score = position.get("s")
+        return ObjectId(position["id"]), float(score) if score is not None else None
+    except Exception as e:
+        raise ValueError("invalid cursor") from e
+
+
+def search_pipeline(diagram_id: str, query: str, sort: str, limit: int, cursor: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Aggregation over the (diagram_id, message) text index with keyset pagination"""
+    # Equality on diagram_id lets MongoDB use only this diagram's slice of the text index
+    match: Dict[str, Any] = {"diagram_id": diagram_id, "$text": {"$search": query}, "is_deleted": False}
+    after: Dict[str, Any] = {}
+    if cursor:
+        last_id, last_score = decode_cursor(cursor)
+        if sort == "relevance":
+            if last_score is None:
+                raise ValueError("invalid cursor")
+            after = {"$or": [
+                {"score": {"$lt": last_score}},
+                {"score": last_score, "_id": {"$lt": last_id}}
+            ]}
+        else:
+            match["_id"] = {"$lt": last_id}
+
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": match},
+        {"$addFields": {"score": {"$meta": "textScore"}}}
+    ]
+    if after:
+        pipeline.append({"$match": after})
+    order = {"score": -1, "_id": -1} if sort == "relevance" else {"_id": -1}
+    pipeline += [{"$sort": order}, {"$limit": limit + 1}]
+    return pipeline
+
+
+def search_excerpt(text: str, terms: List[str]) -> Tuple[str, List[List[int]]]:
+    """Cut an excerpt around the first hit and return highlight offsets within it"""
+    if terms:
+        # Prefix matches approximate the stemming the text index applies
+        pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+        matches = list(pattern.finditer(text))
+    else:
+        matches = []
+    if not matches:
+        return text[:2 * EXCERPT_CONTEXT], []
+
+    start = max(0, matches[0].start() - EXCERPT_CONTEXT)
+    end = min(len(text), matches[0].end() + EXCERPT_CONTEXT)
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    excerpt = prefix + text[start:end] + suffix
+    offset = len(prefix) - start
+    highlights = [
+        [match.start() + offset, match.end() + offset]
+        for match in matches
+        if match.start() >= start and match.end() <= end
+    ]
+    return excerpt, highlights
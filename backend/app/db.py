@@ -1,23 +1,89 @@
 import os
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from typing import Optional
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
+from typing import Any, Dict, Optional, Tuple
 from dotenv import load_dotenv
 import asyncio
+import logging
 
-print("📦 MONGO_URL from env:", os.getenv("MONGO_URL"))
-
+from .metrics import MongoCommandMetrics, mongo_pool_metrics
 
 # ✅ Load environment variables from .env
 # This line ensures the .env file is read when app starts
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
 
-# ✅ Debug: confirm that env loaded
-print("Loaded Mongo URL:", os.getenv("MONGO_URL"))
-
 # Database Configuration
 MONGO_URL = os.getenv("MONGO_URL")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "diagramming_app")
 
+# Connection pool; unset values keep the driver defaults
+MONGO_POOL_OPTIONS = {
+    option: int(os.environ[variable])
+    for option, variable in (
+        ("maxPoolSize", "MONGO_MAX_POOL_SIZE"),
+        ("minPoolSize", "MONGO_MIN_POOL_SIZE"),
+        ("maxConnecting", "MONGO_MAX_CONNECTING"),
+        ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS"),
+        ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+    )
+    if os.getenv(variable)
+}
+
+logger = logging.getLogger(__name__)
+
+
+class OperationProfile:
+    """Write concern, read preference and time limit shared by a class of operations"""
+
+    def __init__(self, name: str, w=None, j: Optional[bool] = None, read: Optional[str] = None,
+                 max_time_ms: Optional[int] = None):
+        self.name = name
+        self.write_concern = WriteConcern(w=w, j=j) if w is not None or j is not None else None
+        self.read_preference = getattr(ReadPreference, read) if read else None
+        self.max_time_ms = max_time_ms  # pass to find()/aggregate(); not a collection option
+
+
+def parse_profile(name: str, spec: str, defaults: Dict[str, Any]) -> OperationProfile:
+    """Overrides like "w=majority,j=true,read=SECONDARY_PREFERRED,max_time_ms=2000" """
+    options = dict(defaults)
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        key, value = key.strip(), value.strip()
+        if not key or not value:
+            continue
+        if key == "w":
+            options["w"] = int(value) if value.isdigit() else value
+        elif key == "j":
+            options["j"] = value.lower() in ("1", "true", "yes")
+        elif key == "read":
+            options["read"] = value.upper()
+        elif key == "max_time_ms":
+            options["max_time_ms"] = int(value)
+    return OperationProfile(name, **options)
+
+
+# Operation classes; each can be overridden with MONGO_PROFILE_<NAME>
+PROFILE_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    # Canvas action log: durable actions and coalesced final states, so journaled;
+    # senders never wait on it
+    "actions": {"w": 1, "j": True},
+    # Chat: latency matters, but a crash must not lose acknowledged messages
+    "chat": {"w": 1, "j": True},
+    # Diagram saves survive a primary failover
+    "durable": {"w": "majority", "j": True},
+    # The user's own listings read their writes, but never run unbounded
+    "listing": {"max_time_ms": 5000},
+    # Public listings tolerate replication lag, so secondaries can serve them
+    "public_listing": {"read": "SECONDARY_PREFERRED", "max_time_ms": 5000},
+}
+OPERATION_PROFILES: Dict[str, OperationProfile] = {
+    name: parse_profile(name, os.getenv(f"MONGO_PROFILE_{name.upper()}", ""), defaults)
+    for name, defaults in PROFILE_DEFAULTS.items()
+}
+
 class MongoDB:
     client: Optional[AsyncIOMotorClient] = None
     database: Optional[AsyncIOMotorDatabase] = None
@@ -28,25 +94,29 @@ mongodb = MongoDB()
 async def connect_to_mongo():
     """Create database connection"""
     try:
-        mongodb.client = AsyncIOMotorClient(MONGO_URL)
+        mongodb.client = AsyncIOMotorClient(
+            MONGO_URL,
+            event_listeners=[MongoCommandMetrics(), mongo_pool_metrics],
+            **MONGO_POOL_OPTIONS
+        )
         mongodb.database = mongodb.client[DATABASE_NAME]
         
         # Test the connection
         await mongodb.client.admin.command('ping')
-        print(f"✅ Successfully connected to MongoDB at {MONGO_URL}")
+        logger.info("Connected to MongoDB database %s", DATABASE_NAME)
         
         # Create indexes for better performance
         await create_indexes()
         
     except Exception as e:
-        print(f"❌ Failed to connect to MongoDB: {e}")
+        logger.error("Failed to connect to MongoDB: %s", e)
         raise e
 
 async def close_mongo_connection():
     """Close database connection"""
     if mongodb.client:
         mongodb.client.close()
-        print("📝 Disconnected from MongoDB")
+        logger.info("Disconnected from MongoDB")
 
 async def create_indexes():
     """Create database indexes for better performance"""
@@ -62,17 +132,50 @@ async def create_indexes():
         await mongodb.database.diagrams.create_index("user_id")
         await mongodb.database.diagrams.create_index("created_at")
         await mongodb.database.diagrams.create_index([("title", "text")])
+        await mongodb.database.diagrams.create_index([("user_id", 1), ("updated_at", -1)])
+        await mongodb.database.diagrams.create_index([("collaborators", 1), ("updated_at", -1)])
+        await mongodb.database.diagrams.create_index([("is_public", 1), ("updated_at", -1)])
+        
+        # Element-per-document storage indexes
+        await mongodb.database.diagram_elements.create_index([("diagram_id", 1), ("element_id", 1)], unique=True)
+        await mongodb.database.diagram_elements.create_index([("diagram_id", 1), ("z", 1)])
         
         # Chat messages indexes
         await mongodb.database.chat_messages.create_index("diagram_id")
         await mongodb.database.chat_messages.create_index("created_at")
+        await mongodb.database.chat_messages.create_index([("diagram_id", 1), ("created_at", -1)])
+        # Compound text index: searches must pin diagram_id, so each only scans that diagram's terms
+        await mongodb.database.chat_messages.create_index([("diagram_id", 1), ("message", "text")])
         
-        print("✅ Database indexes created successfully")
+        logger.info("Database indexes created")
     except Exception as e:
-        print(f"⚠️ Error creating indexes: {e}")
+        logger.warning("Error creating indexes: %s", e)
 
 def get_database() -> AsyncIOMotorDatabase:
     """Get database instance"""
     if mongodb.database is None:
         raise RuntimeError("Database connection not established")
     return mongodb.database
+
+# (collection, profile) -> configured collection, for the current database
+_profiled: Dict[Tuple[str, str], AsyncIOMotorCollection] = {}
+_profiled_database: Optional[AsyncIOMotorDatabase] = None
+
+def get_collection(name: str, profile: str = "default") -> AsyncIOMotorCollection:
+    """A collection carrying the write concern and read preference of an operation profile"""
+    global _profiled_database
+    database = get_database()
+    if database is not _profiled_database:
+        _profiled.clear()
+        _profiled_database = database
+    collection = _profiled.get((name, profile))
+    if collection is None:
+        options = OPERATION_PROFILES[profile]
+        collection = _profiled[(name, profile)] = database.get_collection(
+            name, write_concern=options.write_concern, read_preference=options.read_preference
+        )
+    return collection
+
+def max_time_ms(profile: str) -> Optional[int]:
+    """Server-side time limit for reads in a profile"""
+    return OPERATION_PROFILES[profile].max_time_ms
@@ -1,15 +1,72 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from typing import List, Optional, Dict, Any
 from datetime import datetime
+import logging
 from bson import ObjectId
 
 from .models import DiagramCreate, DiagramUpdate, DiagramResponse, UserResponse
 from .auth import get_current_user
-from .db import get_database
+from .db import get_collection, get_database, max_time_ms
+from .caching import (
+    CachedDiagram, diagram_cache, diagram_etag, etag_matches, http_date, ceil_to_second,
+    stable_last_modified, not_modified_since, touch_listing_watermark, listing_last_modified, page_last_modified
+)
+from .compression import COMPRESSION_MIN_SIZE, negotiate_encoding
+from .responses import MongoJSONResponse, diagram_document, dumps
+from .thumbnails import thumbnail_service
+from .retention import retention_service
+from .unread import unread_tracker
+from .sharding import require_room_owner
+from .sse import broadcast_canvas_update
+from .elements import (
+    DIAGRAM_STORAGE, ELEMENT_STORAGE, apply_diagram_data, iter_diagram_json,
+    load_elements, save_elements, uses_element_storage
+)
 
 router = APIRouter(prefix="/diagrams", tags=["diagrams"])
+logger = logging.getLogger(__name__)
 
-@router.post("/", response_model=DiagramResponse)
+# Diagram routes return MongoJSONResponse or streamed bodies built from stored
+# documents, which FastAPI sends as-is: nothing validates or filters them against
+# these models, so they are declared for the OpenAPI schema only
+DIAGRAM_RESPONSES = {200: {"model": DiagramResponse}}
+DIAGRAM_LIST_RESPONSES = {200: {"model": List[DiagramResponse]}}
+
+def _set_last_modified(response: Response, last_modified: Optional[datetime]):
+    """Attach a Last-Modified header when the listing has a stable timestamp"""
+    last_modified = stable_last_modified(last_modified)
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+        response.headers["Cache-Control"] = "private, no-cache"
+
+def _cached_body_response(request: Request, entry: CachedDiagram, headers: Dict[str, str]) -> Response:
+    """Send a serialized diagram, reusing a pre-compressed variant when one fits"""
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    if encoding is None or len(entry.body) < COMPRESSION_MIN_SIZE:
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+    headers = {**headers, "Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+    return Response(content=entry.encoded(encoding), media_type="application/json", headers=headers)
+
+def _diagram_response(db, diagram: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> Response:
+    """Render a stored diagram, streaming elements that live in their own collection"""
+    if uses_element_storage(diagram):
+        return StreamingResponse(
+            iter_diagram_json(db, diagram_document(diagram), diagram),
+            media_type="application/json",
+            headers=headers
+        )
+    return MongoJSONResponse(diagram_document(diagram), headers=headers)
+
+def _validator_headers(etag: str, updated_at: Optional[datetime]) -> Dict[str, str]:
+    """Headers that let clients revalidate a diagram instead of refetching it"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    updated_at = stable_last_modified(updated_at)
+    if updated_at is not None:
+        headers["Last-Modified"] = http_date(updated_at)
+    return headers
+
+@router.post("/", responses=DIAGRAM_RESPONSES)
 async def create_diagram(
     diagram_data: DiagramCreate,
     current_user: dict = Depends(get_current_user)
@@ -17,28 +74,45 @@ async def create_diagram(
     """Create a new diagram"""
     db = get_database()
     
+    elements = diagram_data.diagram_data.elements
     diagram_doc = {
         "title": diagram_data.title,
         "description": diagram_data.description,
-        "diagram_data": diagram_data.diagram_data.dict(),
+        "diagram_data": diagram_data.diagram_data.model_dump(),
         "user_id": str(current_user["_id"]),
         "is_public": diagram_data.is_public,
         "collaborators": diagram_data.collaborators,
+        "version": 1,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
     
-    result = await db.diagrams.insert_one(diagram_doc)
-    diagram_doc["_id"] = str(result.inserted_id)
-    
-    return DiagramResponse(**diagram_doc)
+    # Counted for both layouts, so summaries without elements know which diagrams are empty
+    diagram_doc["element_count"] = len(elements)
+    if DIAGRAM_STORAGE == ELEMENT_STORAGE:
+        # Keep only metadata in the diagram document
+        diagram_doc["storage"] = ELEMENT_STORAGE
+        del diagram_doc["diagram_data"]["elements"]
+    
+    await get_collection("diagrams", "durable").insert_one(diagram_doc)
+    if uses_element_storage(diagram_doc):
+        diagram_doc["element_count"] = await save_elements(db, str(diagram_doc["_id"]), elements)
+    if elements:
+        thumbnail_service.schedule(str(diagram_doc["_id"]))
+    
+    response_doc = diagram_document(diagram_doc)
+    response_doc["diagram_data"]["elements"] = elements
+    return MongoJSONResponse(response_doc)
 
-@router.get("/", response_model=List[DiagramResponse])
+@router.get("/", responses=DIAGRAM_LIST_RESPONSES)
 async def get_user_diagrams(
+    request: Request,
     current_user: dict = Depends(get_current_user),
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    include_elements: bool = Query(True),
+    include_unread: bool = Query(True)
 ):
     """Get current user's diagrams"""
     db = get_database()
@@ -53,31 +127,41 @@ async def get_user_diagrams(
             {"description": {"$regex": search, "$options": "i"}}
         ]
     
+    # Answer conditional requests without fetching the page
+    watermark = current_user.get("listings_changed_at")
+    if "if-modified-since" in request.headers:
+        last_modified = await listing_last_modified(db, query, watermark, include_chat=include_unread)
+        if not_modified_since(request, last_modified):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"Last-Modified": http_date(ceil_to_second(last_modified))})
+    
     # Execute query with pagination
-    cursor = db.diagrams.find(query).sort("updated_at", -1).skip(skip).limit(limit)
+    # Summaries carry a thumbnail URL instead of every element
+    projection = None if include_elements else {"diagram_data.elements": 0}
+    cursor = db.diagrams.find(query, projection, max_time_ms=max_time_ms("listing")).sort("updated_at", -1).skip(skip).limit(limit)
     diagrams = await cursor.to_list(length=limit)
     
-    # Process diagrams for response
-    processed_diagrams = []
-    for diagram in diagrams:
-        # Convert ObjectId to string
-        diagram["_id"] = str(diagram["_id"])
-        
-        # Ensure diagram_data is a DiagramData object
-        if "diagram_data" in diagram and isinstance(diagram["diagram_data"], dict):
-            from .models import DiagramData
-            diagram["diagram_data"] = DiagramData(**diagram["diagram_data"])
-        
-        processed_diagrams.append(DiagramResponse(**diagram))
+    if include_elements:
+        for diagram in diagrams:
+            if uses_element_storage(diagram):
+                diagram.setdefault("diagram_data", {})["elements"] = await load_elements(db, diagram)
     
-    return processed_diagrams
+    if include_unread:
+        await unread_tracker.annotate(db, str(current_user["_id"]), diagrams)
+    
+    # Render stored documents directly, they are trusted and already shaped
+    response = MongoJSONResponse([diagram_document(diagram) for diagram in diagrams])
+    _set_last_modified(response, page_last_modified(diagrams, watermark, include_chat=include_unread))
+    return response
 
-@router.get("/shared", response_model=List[DiagramResponse])
+@router.get("/shared", responses=DIAGRAM_LIST_RESPONSES)
 async def get_shared_diagrams(
+    request: Request,
     current_user: dict = Depends(get_current_user),
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    include_elements: bool = Query(True),
+    include_unread: bool = Query(True)
 ):
     """Get diagrams shared with the current user"""
     db = get_database()
@@ -95,30 +179,39 @@ async def get_shared_diagrams(
             ]}
         ]
     
+    # Answer conditional requests without fetching the page
+    watermark = current_user.get("listings_changed_at")
+    if "if-modified-since" in request.headers:
+        last_modified = await listing_last_modified(db, query, watermark, include_chat=include_unread)
+        if not_modified_since(request, last_modified):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"Last-Modified": http_date(ceil_to_second(last_modified))})
+    
     # Execute query with pagination
-    cursor = db.diagrams.find(query).sort("updated_at", -1).skip(skip).limit(limit)
+    # Summaries carry a thumbnail URL instead of every element
+    projection = None if include_elements else {"diagram_data.elements": 0}
+    cursor = db.diagrams.find(query, projection, max_time_ms=max_time_ms("listing")).sort("updated_at", -1).skip(skip).limit(limit)
     diagrams = await cursor.to_list(length=limit)
     
-    # Process diagrams for response
-    processed_diagrams = []
-    for diagram in diagrams:
-        # Convert ObjectId to string
-        diagram["_id"] = str(diagram["_id"])
-        
-        # Ensure diagram_data is a DiagramData object
-        if "diagram_data" in diagram and isinstance(diagram["diagram_data"], dict):
-            from .models import DiagramData
-            diagram["diagram_data"] = DiagramData(**diagram["diagram_data"])
-        
-        processed_diagrams.append(DiagramResponse(**diagram))
+    if include_elements:
+        for diagram in diagrams:
+            if uses_element_storage(diagram):
+                diagram.setdefault("diagram_data", {})["elements"] = await load_elements(db, diagram)
+    
+    if include_unread:
+        await unread_tracker.annotate(db, str(current_user["_id"]), diagrams)
     
-    return processed_diagrams
+    # Render stored documents directly, they are trusted and already shaped
+    response = MongoJSONResponse([diagram_document(diagram) for diagram in diagrams])
+    _set_last_modified(response, page_last_modified(diagrams, watermark, include_chat=include_unread))
+    return response
 
-@router.get("/public", response_model=List[DiagramResponse])
+@router.get("/public", responses=DIAGRAM_LIST_RESPONSES)
 async def get_public_diagrams(
+    request: Request,
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    include_elements: bool = Query(True)
 ):
     """Get public diagrams"""
     db = get_database()
@@ -133,34 +226,55 @@ async def get_public_diagrams(
             {"description": {"$regex": search, "$options": "i"}}
         ]
     
-    cursor = db.diagrams.find(query).sort("created_at", -1).skip(skip).limit(limit)
+    # Answer conditional requests without fetching the page
+    marker = await db.listing_watermarks.find_one({"_id": "public"})
+    watermark = marker.get("changed_at") if marker else None
+    if "if-modified-since" in request.headers:
+        last_modified = await listing_last_modified(db, query, watermark)
+        if not_modified_since(request, last_modified):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"Last-Modified": http_date(ceil_to_second(last_modified))})
+    
+    # Summaries carry a thumbnail URL instead of every element
+    projection = None if include_elements else {"diagram_data.elements": 0}
+    # Public pages tolerate replication lag, so a secondary may serve them
+    cursor = get_collection("diagrams", "public_listing").find(
+        query, projection, max_time_ms=max_time_ms("public_listing")
+    ).sort("created_at", -1).skip(skip).limit(limit)
     diagrams = await cursor.to_list(length=limit)
     
-    # Process diagrams for response
-    processed_diagrams = []
-    for diagram in diagrams:
-        # Convert ObjectId to string
-        diagram["_id"] = str(diagram["_id"])
-        
-        # Ensure diagram_data is a DiagramData object
-        if "diagram_data" in diagram and isinstance(diagram["diagram_data"], dict):
-            from .models import DiagramData
-            diagram["diagram_data"] = DiagramData(**diagram["diagram_data"])
-        
-        processed_diagrams.append(DiagramResponse(**diagram))
+    if include_elements:
+        for diagram in diagrams:
+            if uses_element_storage(diagram):
+                diagram.setdefault("diagram_data", {})["elements"] = await load_elements(db, diagram)
     
-    return processed_diagrams
+    # Render stored documents directly, they are trusted and already shaped
+    response = MongoJSONResponse([diagram_document(diagram) for diagram in diagrams])
+    _set_last_modified(response, page_last_modified(diagrams, watermark))
+    return response
 
-@router.get("/{diagram_id}", response_model=DiagramResponse)
+@router.get("/{diagram_id}", responses=DIAGRAM_RESPONSES)
 async def get_diagram(
     diagram_id: str,
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
     """Get a specific diagram"""
+    # Serve hot public diagrams straight from the response cache
+    cached = diagram_cache.get(diagram_id)
+    if cached is not None:
+        headers = _validator_headers(cached.etag, cached.updated_at)
+        if etag_matches(request, cached.etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return _cached_body_response(request, cached, headers)
+    
     db = get_database()
     
+    # Revalidation only needs the version, so leave the elements behind
+    conditional = "if-none-match" in request.headers
+    projection = {"diagram_data": 0} if conditional else None
+    
     try:
-        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, projection)
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -184,16 +298,29 @@ async def get_diagram(
             detail="Access denied to this diagram"
         )
     
-    diagram["_id"] = str(diagram["_id"])
-    
-    # Ensure diagram_data is a DiagramData object
-    if "diagram_data" in diagram and isinstance(diagram["diagram_data"], dict):
-        from .models import DiagramData
-        diagram["diagram_data"] = DiagramData(**diagram["diagram_data"])
-    
-    return DiagramResponse(**diagram)
+    etag = diagram_etag(diagram_id, diagram.get("version", 0))
+    headers = _validator_headers(etag, diagram.get("updated_at"))
+    if conditional:
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
+        if not diagram:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Diagram not found"
+            )
+        etag = diagram_etag(diagram_id, diagram.get("version", 0))
+        headers = _validator_headers(etag, diagram.get("updated_at"))
+    
+    if uses_element_storage(diagram):
+        # Large diagrams are streamed from the element collection, never buffered
+        return _diagram_response(db, diagram, headers)
+    
+    entry = CachedDiagram(diagram, etag, dumps(diagram_document(diagram)))
+    diagram_cache.put(diagram_id, entry)
+    return _cached_body_response(request, entry, headers)
 
-@router.put("/{diagram_id}", response_model=DiagramResponse)
+@router.put("/{diagram_id}", responses=DIAGRAM_RESPONSES, dependencies=[Depends(require_room_owner)])
 async def update_diagram(
     diagram_id: str,
     diagram_update: DiagramUpdate,
@@ -203,7 +330,7 @@ async def update_diagram(
     db = get_database()
     
     try:
-        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, {"diagram_data.elements": 0})
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -228,14 +355,15 @@ async def update_diagram(
     
     # Prepare update data
     update_data: Dict[str, Any] = {"updated_at": datetime.utcnow()}
+    diagram_data = diagram_update.diagram_data.model_dump() if diagram_update.diagram_data is not None else None
     
     # Only update fields that were provided
     if diagram_update.title is not None:
         update_data["title"] = diagram_update.title
     if diagram_update.description is not None:
         update_data["description"] = diagram_update.description
-    if diagram_update.diagram_data is not None:
-        update_data["diagram_data"] = diagram_update.diagram_data.dict()
+    if diagram_data is not None:
+        await apply_diagram_data(db, diagram, diagram_data, update_data)
     if diagram_update.is_public is not None and diagram["user_id"] == user_id:
         # Only owner can change public status
         update_data["is_public"] = diagram_update.is_public
@@ -243,39 +371,46 @@ async def update_diagram(
         # Only owner can change collaborators
         update_data["collaborators"] = diagram_update.collaborators
     
-    # Update the diagram
-    await db.diagrams.update_one(
+    # Update the diagram and bump its version so cached copies go stale
+    await get_collection("diagrams", "durable").update_one(
         {"_id": ObjectId(diagram_id)},
-        {"$set": update_data}
+        {"$set": update_data, "$inc": {"version": 1}}
     )
+    diagram_cache.invalidate(diagram_id)
+    if diagram_update.diagram_data is not None:
+        thumbnail_service.schedule(diagram_id)
+    
+    # Diagrams that leave a listing do not move its updated_at forward
+    removed = set(diagram.get("collaborators", [])) - set(update_data.get("collaborators", diagram.get("collaborators", [])))
+    unpublished = diagram.get("is_public", False) and update_data.get("is_public") is False
+    if removed or unpublished:
+        await touch_listing_watermark(
+            db,
+            {"email": {"$in": list(removed)}} if removed else None,
+            public=unpublished
+        )
     
-    # Broadcast diagram update via SSE to all connected clients
+    # Broadcast diagram update via SSE to all connected clients. Element-storage
+    # diagrams keep their elements out of update_data, so send what the client saved
+    updates = {key: value for key, value in update_data.items() if not key.startswith("diagram_data") and key != "element_count"}
+    if diagram_data is not None:
+        updates["diagram_data"] = diagram_data
     try:
-        from .sse import broadcast_canvas_update
         await broadcast_canvas_update(diagram_id, {
             "type": "diagram_update",
             "diagram_id": diagram_id,
-            "updates": update_data,
+            "updates": updates,
             "updated_at": update_data.get("updated_at", datetime.utcnow()).isoformat()
         })
-        print(f"[DEBUG] SSE broadcast sent for diagram update {diagram_id}")
     except Exception as e:
-        print(f"[DEBUG] SSE broadcast failed for diagram update: {e}")
+        logger.warning("SSE broadcast failed for diagram update: %s", e, extra={"diagram_id": diagram_id})
     
     # Return updated diagram
     updated_diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
     if not updated_diagram:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Diagram not found")
         
-    # Process diagram for response
-    updated_diagram["_id"] = str(updated_diagram["_id"])
-    
-    # Ensure diagram_data is a DiagramData object
-    if "diagram_data" in updated_diagram and isinstance(updated_diagram["diagram_data"], dict):
-        from .models import DiagramData
-        updated_diagram["diagram_data"] = DiagramData(**updated_diagram["diagram_data"])
-    
-    return DiagramResponse(**updated_diagram)
+    return _diagram_response(db, updated_diagram)
 
 @router.delete("/{diagram_id}")
 async def delete_diagram(
@@ -308,9 +443,18 @@ async def delete_diagram(
     
     # Delete the diagram
     await db.diagrams.delete_one({"_id": ObjectId(diagram_id)})
+    diagram_cache.invalidate(diagram_id)
+    await touch_listing_watermark(
+        db,
+        {"$or": [
+            {"_id": current_user["_id"]},
+            {"email": {"$in": diagram.get("collaborators", [])}}
+        ]},
+        public=diagram.get("is_public", False)
+    )
     
-    # Also delete related chat messages
-    await db.chat_messages.delete_many({"diagram_id": diagram_id})
+    # Related chat, elements and history are removed in batches in the background
+    await retention_service.purge_diagram(diagram_id)
     
     return {"message": "Diagram deleted successfully"}
 
@@ -354,10 +498,15 @@ async def add_collaborator(
     
     # Add collaborator if not already added
     if user_email not in diagram.get("collaborators", []):
-        await db.diagrams.update_one(
+        await get_collection("diagrams", "durable").update_one(
             {"_id": ObjectId(diagram_id)},
-            {"$addToSet": {"collaborators": user_email}}
+            {
+                "$addToSet": {"collaborators": user_email},
+                "$set": {"updated_at": datetime.utcnow()},
+                "$inc": {"version": 1}
+            }
         )
+        diagram_cache.invalidate(diagram_id)
     
     return {"message": f"Collaborator {user_email} added successfully"}
 
@@ -392,9 +541,15 @@ async def remove_collaborator(
         )
     
     # Remove collaborator
-    await db.diagrams.update_one(
+    await get_collection("diagrams", "durable").update_one(
         {"_id": ObjectId(diagram_id)},
-        {"$pull": {"collaborators": user_email}}
+        {
+            "$pull": {"collaborators": user_email},
+            "$set": {"updated_at": datetime.utcnow()},
+            "$inc": {"version": 1}
+        }
     )
+    diagram_cache.invalidate(diagram_id)
+    await touch_listing_watermark(db, {"email": user_email})
     
     return {"message": f"Collaborator {user_email} removed successfully"}
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from fastapi import APIRouter, Depends, Query
+
+from . import metrics
+from .auth import get_admin_user
+from .chat_pipeline import chat_pipeline
+from .db import get_database
+from .persistence_policy import action_coalescer
+from .unread import unread_tracker
+from .websocket import manager, wait_for_action_log
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+logger = logging.getLogger(__name__)
+
+# Drain configuration
+DRAIN_WAVE_SIZE = int(os.getenv("DRAIN_WAVE_SIZE", "200"))  # connections closed per wave
+DRAIN_WAVE_INTERVAL_MS = int(os.getenv("DRAIN_WAVE_INTERVAL_MS", "500"))
+DRAIN_RECONNECT_JITTER_MS = int(os.getenv("DRAIN_RECONNECT_JITTER_MS", "5000"))
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "30"))
+
+drained_connections = metrics.registry.counter(
+    "websocket_drained_total", "WebSocket connections closed by a drain with a reconnect hint"
+)
+
+
+class DrainController:
+    """Take a worker out of rotation without a reconnect storm.
+
+    Draining refuses new rooms, flushes the write-behind buffers so another
+    worker reads current state from MongoDB, then closes sockets a wave at
+    a time. Each client is told how long to wait before reconnecting (with
+    jitter) and the sequence numbers it had reached, so it can resume
+    without refetching what it already has.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self.closed = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> asyncio.Task:
+        if self.task is None:
+            self.draining = manager.draining = True
+            self.started_at = time.monotonic()
+            self.task = asyncio.create_task(self._run())
+        return self.task
+
+    async def drain(self):
+        """Drain and wait for it, giving up after DRAIN_TIMEOUT_SECONDS"""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.start()), DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Drain timed out with %d connections open", len(manager.connection_users))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "complete": self.task is not None and self.task.done(),
+            "elapsed_seconds": round(time.monotonic() - self.started_at, 3) if self.started_at else None,
+            "closed_connections": self.closed,
+            "open_connections": len(manager.connection_users),
+            "open_rooms": len(manager.active_connections)
+        }
+
+    async def _run(self):
+        logger.info("Draining %d WebSocket connections in %d rooms",
+                    len(manager.connection_users), len(manager.active_connections))
+        try:
+            await self.flush()
+        except Exception as e:
+            # Clients still have to move; the services flush again on shutdown
+            logger.error("Drain flush failed: %s", e)
+        wave = 0
+        while manager.active_connections:
+            if wave:
+                await asyncio.sleep(DRAIN_WAVE_INTERVAL_MS / 1000.0)
+            await self.close_rooms(self._next_wave())
+            wave += 1
+        logger.info("Drain complete: %d connections closed in %d waves", self.closed, wave)
+
+    async def flush(self):
+        """Write buffered chat and unread state so another worker reads it from MongoDB"""
+        while chat_pipeline.pending:
+            if not await chat_pipeline.flush():
+                logger.error("Drain could not flush %d chat messages", len(chat_pipeline.pending))
+                break
+        await unread_tracker.flush()
+        await wait_for_action_log()
+        if not await action_coalescer.flush(force=True):
+            logger.error("Drain could not flush %d canvas elements", len(action_coalescer.pending))
+
+    def _next_wave(self) -> List[str]:
+        """Whole rooms, smallest first, until the wave is full"""
+        rooms = sorted(manager.active_connections, key=lambda diagram_id: len(manager.active_connections[diagram_id]))
+        wave, size = [], 0
+        for diagram_id in rooms:
+            if wave and size + len(manager.active_connections[diagram_id]) > DRAIN_WAVE_SIZE:
+                break
+            wave.append(diagram_id)
+            size += len(manager.active_connections[diagram_id])
+        return wave
+
+    async def close_rooms(self, diagram_ids: List[str], url: Optional[str] = None):
+        """Close every socket in the rooms with a reconnect hint, optionally naming the worker to use"""
+        db = get_database()
+        versions = {
+            str(diagram["_id"]): diagram.get("version", 1)
+            async for diagram in db.diagrams.find(
+                {"_id": {"$in": [ObjectId(diagram_id) for diagram_id in diagram_ids]}}, {"version": 1}
+            )
+        }
+        for diagram_id in diagram_ids:
+            hint = {
+                "type": "reconnect",
+                "seq": manager.room_seq.get(diagram_id, 0),
+                "chat_seq": await unread_tracker.current_seq(db, diagram_id, fresh=True),
+                "version": versions.get(diagram_id)
+            }
+            if url:
+                hint["url"] = url
+            for websocket in list(manager.active_connections.get(diagram_id, ())):
+                message = json.dumps({**hint, "reconnect_after_ms": random.randint(0, DRAIN_RECONNECT_JITTER_MS)})
+                manager.disconnect(websocket, diagram_id)
+                try:
+                    await manager.send_personal_message(message, websocket, "reconnect")
+                    await websocket.close(code=1012)  # service restart
+                except Exception as e:
+                    logger.debug("Drain close failed: %s", e, extra={"diagram_id": diagram_id})
+                self.closed += 1
+                drained_connections.inc()
+
+
+# Global drain controller instance
+drain_controller = DrainController()
+
+
+@router.post("/drain")
+async def start_drain(wait: bool = Query(False), admin: dict = Depends(get_admin_user)):
+    """Stop taking new rooms and move this worker's clients elsewhere"""
+    if wait:
+        await drain_controller.drain()
+    else:
+        drain_controller.start()
+    return drain_controller.status()
+
+
+@router.get("/drain")
+async def drain_status(admin: dict = Depends(get_admin_user)):
+    """Progress of the current drain"""
+    return drain_controller.status()
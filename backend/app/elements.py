@@ -0,0 +1,166 @@
+import hashlib
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from .responses import dumps
+
+# Storage layouts a diagram document can declare in its `storage` field
+EMBEDDED_STORAGE = "embedded"
+ELEMENT_STORAGE = "elements"
+
+# Element storage configuration
+DIAGRAM_STORAGE = os.getenv("DIAGRAM_STORAGE", EMBEDDED_STORAGE)
+ELEMENT_BATCH_SIZE = int(os.getenv("ELEMENT_BATCH_SIZE", "1000"))
+
+
+def uses_element_storage(diagram: Dict[str, Any]) -> bool:
+    return diagram.get("storage") == ELEMENT_STORAGE
+
+
+def element_bbox(element: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    """Bounding box of an element, mirroring getElementBounds in Canvas.jsx"""
+    kind = element.get("type") or element.get("tool")
+    try:
+        if kind in ("line", "rect", "pen"):
+            points = element.get("points") or []
+            if not points:
+                return None
+            xs = [p["x"] for p in points]
+            ys = [p["y"] for p in points]
+            return {"min_x": min(xs), "min_y": min(ys), "max_x": max(xs), "max_y": max(ys)}
+        if kind == "circle":
+            center, radius = element["center"], element["radius"]
+            return {
+                "min_x": center["x"] - radius, "min_y": center["y"] - radius,
+                "max_x": center["x"] + radius, "max_y": center["y"] + radius
+            }
+        if kind in ("image", "text"):
+            x, y = element["x"], element["y"]
+            return {
+                "min_x": x, "min_y": y,
+                "max_x": x + element.get("width", 0), "max_y": y + element.get("height", 0)
+            }
+    except (KeyError, TypeError, ValueError):
+        return None
+    return None
+
+
+def element_hash(element: Dict[str, Any]) -> str:
+    return hashlib.blake2b(dumps(element), digest_size=16).hexdigest()
+
+
+def element_document(diagram_id: str, element: Dict[str, Any], z: int) -> Dict[str, Any]:
+    """Wrap a canvas element for the diagram_elements collection"""
+    document = {
+        "diagram_id": diagram_id,
+        "element_id": str(element.get("id", z)),
+        "z": z,
+        "hash": element_hash(element),
+        "data": element
+    }
+    bbox = element_bbox(element)
+    if bbox:
+        document.update(bbox)
+    return document
+
+
+async def insert_element_batch(db, documents: List[Dict[str, Any]]) -> int:
+    """Insert a batch of element documents, ignoring ids that already exist"""
+    if not documents:
+        return 0
+    try:
+        result = await db.diagram_elements.insert_many(documents, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        # Duplicate element ids keep their first occurrence
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nInserted", 0)
+
+
+async def iter_elements(db, diagram: Dict[str, Any], batch_size: int = ELEMENT_BATCH_SIZE) -> AsyncIterator[Dict[str, Any]]:
+    """Yield a diagram's elements in z-order, whichever layout stores them"""
+    if not uses_element_storage(diagram):
+        for element in (diagram.get("diagram_data") or {}).get("elements", []):
+            yield element
+        return
+    cursor = db.diagram_elements.find(
+        {"diagram_id": str(diagram["_id"])},
+        {"data": 1, "_id": 0}
+    ).sort("z", 1).batch_size(batch_size)
+    async for document in cursor:
+        yield document["data"]
+
+
+async def load_elements(db, diagram: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [element async for element in iter_elements(db, diagram)]
+
+
+async def save_elements(db, diagram_id: str, elements: List[Dict[str, Any]]) -> int:
+    """Sync the element collection with a full element list, writing only what changed"""
+    existing: Dict[str, tuple] = {}
+    cursor = db.diagram_elements.find(
+        {"diagram_id": diagram_id},
+        {"element_id": 1, "z": 1, "hash": 1, "_id": 0}
+    ).batch_size(ELEMENT_BATCH_SIZE)
+    async for document in cursor:
+        existing[document["element_id"]] = (document.get("z"), document.get("hash"))
+
+    operations = []
+    seen = set()
+    for z, element in enumerate(elements):
+        document = element_document(diagram_id, element, z)
+        element_id = document["element_id"]
+        if element_id in seen:
+            continue
+        seen.add(element_id)
+        if existing.get(element_id) == (z, document["hash"]):
+            continue
+        operations.append(ReplaceOne(
+            {"diagram_id": diagram_id, "element_id": element_id},
+            document,
+            upsert=True
+        ))
+    removed = [element_id for element_id in existing if element_id not in seen]
+
+    for start in range(0, len(operations), ELEMENT_BATCH_SIZE):
+        await db.diagram_elements.bulk_write(operations[start:start + ELEMENT_BATCH_SIZE], ordered=False)
+    for start in range(0, len(removed), ELEMENT_BATCH_SIZE):
+        await db.diagram_elements.delete_many({
+            "diagram_id": diagram_id,
+            "element_id": {"$in": removed[start:start + ELEMENT_BATCH_SIZE]}
+        })
+    return len(seen)
+
+
+async def apply_diagram_data(db, diagram: Dict[str, Any], diagram_data: Dict[str, Any], update_data: Dict[str, Any]):
+    """Route a diagram_data update to whichever layout the diagram uses"""
+    if not uses_element_storage(diagram):
+        update_data["diagram_data"] = diagram_data
+        update_data["element_count"] = len(diagram_data.get("elements") or [])
+        return
+    update_data["diagram_data.canvas_state"] = diagram_data.get("canvas_state") or {}
+    update_data["element_count"] = await save_elements(db, str(diagram["_id"]), diagram_data.get("elements") or [])
+
+
+async def iter_diagram_json(db, document: Dict[str, Any], diagram: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """Stream a DiagramResponse body, pulling elements from the collection in batches"""
+    body = dumps({**document, "diagram_data": {**document["diagram_data"], "elements": []}})
+    # Strings escape their quotes, so this marker can only be the elements key
+    prefix, suffix = body.split(b'"elements":[]', 1)
+    yield prefix + b'"elements":['
+    chunk = bytearray()
+    first = True
+    async for element in iter_elements(db, diagram):
+        if not first:
+            chunk += b","
+        chunk += dumps(element)
+        first = False
+        if len(chunk) >= 64 * 1024:
+            yield bytes(chunk)
+            chunk.clear()
+    chunk += b"]" + suffix
+    yield bytes(chunk)
@@ -0,0 +1,269 @@
+import base64
+import io
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from .auth import get_current_user
+from .caching import RenderedExport, diagram_etag, etag_matches, export_cache
+from .chat import verify_diagram_access
+from .db import get_database
+from .elements import iter_elements, load_elements, uses_element_storage
+from .responses import dumps
+
+router = APIRouter(prefix="/diagrams", tags=["export"])
+
+# Matches the fixed canvas size used by the editor
+CANVAS_WIDTH = 800
+CANVAS_HEIGHT = 600
+DEFAULT_COLOR = "#000"
+DEFAULT_WIDTH = 2
+STREAM_CHUNK_SIZE = 64 * 1024
+
+EXPORT_MEDIA_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def canvas_size(canvas_state: Dict[str, Any]) -> tuple:
+    """Canvas dimensions stored with the diagram, or the editor defaults"""
+    width = canvas_state.get("width") or CANVAS_WIDTH
+    height = canvas_state.get("height") or CANVAS_HEIGHT
+    return int(width), int(height)
+
+
+def element_kind(element: Dict[str, Any]) -> Optional[str]:
+    """Element type as the canvas reads it (`type` first, then `tool`)"""
+    return element.get("type") or element.get("tool")
+
+
+def _num(value: Any) -> str:
+    """A coordinate or size as an SVG number; anything else raises and skips the element"""
+    return repr(float(value))
+
+
+def _stroke(element: Dict[str, Any]) -> str:
+    color = quoteattr(str(element.get("color") or DEFAULT_COLOR))
+    width = _num(element.get("width") or DEFAULT_WIDTH)
+    return f'stroke={color} stroke-width="{width}" fill="none" stroke-linecap="round"'
+
+
+def svg_element(element: Dict[str, Any]) -> str:
+    """Render a single canvas element as an SVG fragment"""
+    kind = element_kind(element)
+    try:
+        if kind == "pen":
+            points = " ".join(f"{_num(p['x'])},{_num(p['y'])}" for p in element.get("points", []))
+            return f'<polyline points="{points}" {_stroke(element)} stroke-linejoin="round"/>\n'
+        if kind == "line":
+            p0, p1 = element["points"][:2]
+            return (
+                f'<line x1="{_num(p0["x"])}" y1="{_num(p0["y"])}" x2="{_num(p1["x"])}" y2="{_num(p1["y"])}" '
+                f'{_stroke(element)}/>\n'
+            )
+        if kind == "rect":
+            p0, p1 = element["points"][:2]
+            x0, y0, x1, y1 = (float(p0["x"]), float(p0["y"]), float(p1["x"]), float(p1["y"]))
+            return (
+                f'<rect x="{_num(min(x0, x1))}" y="{_num(min(y0, y1))}" '
+                f'width="{_num(abs(x1 - x0))}" height="{_num(abs(y1 - y0))}" {_stroke(element)}/>\n'
+            )
+        if kind == "circle":
+            center = element["center"]
+            return (
+                f'<circle cx="{_num(center["x"])}" cy="{_num(center["y"])}" r="{_num(element["radius"])}" '
+                f'{_stroke(element)}/>\n'
+            )
+        if kind == "image" and element.get("src"):
+            return (
+                f'<image x="{_num(element["x"])}" y="{_num(element["y"])}" width="{_num(element["width"])}" '
+                f'height="{_num(element["height"])}" href={quoteattr(str(element["src"]))}/>\n'
+            )
+        if kind == "text" and element.get("text"):
+            color = quoteattr(str(element.get("color") or DEFAULT_COLOR))
+            return (
+                f'<text x="{_num(element.get("x", 0))}" y="{_num(element.get("y", 0))}" fill={color}>'
+                f'{escape(str(element["text"]))}</text>\n'
+            )
+    except (KeyError, TypeError, ValueError):
+        # Malformed elements are skipped rather than failing the whole export
+        pass
+    return ""
+
+
+async def iter_svg(elements: AsyncIterator[Dict[str, Any]], width: int, height: int) -> AsyncIterator[bytes]:
+    """Stream an SVG document one element at a time"""
+    yield (
+        f'<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}">\n'
+        f'<rect width="100%" height="100%" fill="white"/>\n'
+    ).encode("utf-8")
+    buffer: List[str] = []
+    size = 0
+    async for element in elements:
+        fragment = svg_element(element)
+        buffer.append(fragment)
+        size += len(fragment)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer).encode("utf-8")
+            buffer, size = [], 0
+    buffer.append("</svg>\n")
+    yield "".join(buffer).encode("utf-8")
+
+
+async def iter_ndjson(elements: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Stream elements as newline-delimited JSON"""
+    buffer = bytearray()
+    async for element in elements:
+        buffer += dumps(element)
+        buffer += b"\n"
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def _decode_data_url(src: str) -> Optional[bytes]:
+    if not src.startswith("data:") or "," not in src:
+        return None
+    header, data = src.split(",", 1)
+    if ";base64" not in header:
+        return None
+    try:
+        return base64.b64decode(data)
+    except ValueError:
+        return None
+
+
+def render_raster(
+    elements: Iterable[Dict[str, Any]],
+    width: int,
+    height: int,
+    scale: float = 1.0,
+    image_format: str = "PNG"
+) -> bytes:
+    """Rasterize elements with Pillow; CPU-bound, so call it off the event loop"""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        raise RuntimeError("Pillow is required for raster export")
+
+    image = Image.new("RGB", (max(1, int(width * scale)), max(1, int(height * scale))), "white")
+    draw = ImageDraw.Draw(image)
+
+    def pt(p):
+        return (p["x"] * scale, p["y"] * scale)
+
+    for element in elements:
+        kind = element_kind(element)
+        color = element.get("color") or DEFAULT_COLOR
+        line_width = max(1, int(round((element.get("width") or DEFAULT_WIDTH) * scale)))
+        try:
+            if kind == "pen" and len(element.get("points", [])) > 1:
+                draw.line([pt(p) for p in element["points"]], fill=color, width=line_width, joint="curve")
+            elif kind == "line":
+                draw.line([pt(p) for p in element["points"][:2]], fill=color, width=line_width)
+            elif kind == "rect":
+                (x0, y0), (x1, y1) = [pt(p) for p in element["points"][:2]]
+                draw.rectangle([min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)], outline=color, width=line_width)
+            elif kind == "circle":
+                cx, cy = pt(element["center"])
+                r = element["radius"] * scale
+                draw.ellipse([cx - r, cy - r, cx + r, cy + r], outline=color, width=line_width)
+            elif kind == "image" and element.get("src"):
+                data = _decode_data_url(element["src"])
+                if data:
+                    embedded = Image.open(io.BytesIO(data)).convert("RGBA")
+                    size = (max(1, int(element["width"] * scale)), max(1, int(element["height"] * scale)))
+                    embedded = embedded.resize(size)
+                    image.paste(embedded, (int(element["x"] * scale), int(element["y"] * scale)), embedded)
+            elif kind == "text" and element.get("text"):
+                draw.text(pt(element), str(element["text"]), fill=color)
+        except (KeyError, TypeError, ValueError, OSError):
+            continue
+
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+def iter_chunks(data: bytes) -> Iterator[bytes]:
+    for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+        yield data[offset:offset + STREAM_CHUNK_SIZE]
+
+
+async def _cache_stream(key: tuple, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Pass chunks through to the client and keep a copy for the export cache"""
+    parts: List[bytes] = []
+    size = 0
+    async for chunk in chunks:
+        if size <= export_cache.max_item_bytes:
+            parts.append(chunk)
+            size += len(chunk)
+        yield chunk
+    if size <= export_cache.max_item_bytes:
+        export_cache.put(key, RenderedExport(b"".join(parts)))
+
+
+@router.get("/{diagram_id}/export/{export_format}")
+async def export_diagram(
+    diagram_id: str,
+    export_format: str,
+    request: Request,
+    scale: float = Query(1.0, gt=0, le=4),
+    current_user: dict = Depends(get_current_user)
+):
+    """Export a diagram as SVG, PNG or newline-delimited JSON elements"""
+    if export_format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported export format. Use one of: {', '.join(EXPORT_MEDIA_TYPES)}"
+        )
+
+    db = get_database()
+    # Elements are only loaded on a cache miss
+    diagram = await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data.elements": 0})
+
+    version = diagram.get("version", 0)
+    etag = diagram_etag(diagram_id, version)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f'attachment; filename="diagram-{diagram_id}.{export_format}"'
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    media_type = EXPORT_MEDIA_TYPES[export_format]
+    key = (diagram_id, version, export_format, scale if export_format == "png" else 1.0)
+    cached = export_cache.get(key)
+    if cached is not None:
+        return Response(content=cached.body, media_type=media_type, headers=headers)
+
+    width, height = canvas_size((diagram.get("diagram_data") or {}).get("canvas_state", {}))
+    if not uses_element_storage(diagram):
+        diagram = await db.diagrams.find_one({"_id": diagram["_id"]}, {"diagram_data.elements": 1})
+        if not diagram:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Diagram not found")
+
+    if export_format == "png":
+        elements = await load_elements(db, diagram)
+        try:
+            body = await run_in_threadpool(render_raster, elements, width, height, scale)
+        except RuntimeError as e:
+            raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+        export_cache.put(key, RenderedExport(body))
+        return StreamingResponse(iter_chunks(body), media_type=media_type, headers=headers)
+
+    if export_format == "svg":
+        chunks = iter_svg(iter_elements(db, diagram), width, height)
+    else:
+        chunks = iter_ndjson(iter_elements(db, diagram))
+    return StreamingResponse(_cache_stream(key, chunks), media_type=media_type, headers=headers)
@@ -0,0 +1,242 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from pydantic import ValidationError
+
+from .auth import get_current_user
+from .db import get_database
+from .elements import ELEMENT_BATCH_SIZE, ELEMENT_STORAGE, element_document, insert_element_batch
+from .models import DiagramCreate
+from .responses import loads
+
+router = APIRouter(prefix="/diagrams", tags=["import"])
+
+# Import configuration
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(1024 * 1024)))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "100"))
+IMPORT_JOB_HISTORY = 100
+
+NUMBER = (int, float)
+
+
+def _is_point(value: Any) -> bool:
+    return isinstance(value, dict) and isinstance(value.get("x"), NUMBER) and isinstance(value.get("y"), NUMBER)
+
+
+def validate_element(element: Any) -> Optional[str]:
+    """Cheap structural check of one element; returns an error message or None"""
+    if not isinstance(element, dict):
+        return "element must be a JSON object"
+    kind = element.get("type") or element.get("tool")
+    if kind in ("pen", "line", "rect"):
+        points = element.get("points")
+        if not isinstance(points, list) or not points or not all(_is_point(p) for p in points):
+            return f"{kind} element needs a list of {{x, y}} points"
+        if kind != "pen" and len(points) < 2:
+            return f"{kind} element needs two points"
+    elif kind == "circle":
+        if not _is_point(element.get("center")) or not isinstance(element.get("radius"), NUMBER):
+            return "circle element needs center and radius"
+    elif kind == "image":
+        if not all(isinstance(element.get(key), NUMBER) for key in ("x", "y", "width", "height")):
+            return "image element needs x, y, width and height"
+        if not isinstance(element.get("src"), str):
+            return "image element needs a src"
+    elif kind == "text":
+        if not _is_point(element) or not isinstance(element.get("text"), str):
+            return "text element needs x, y and text"
+    else:
+        return f"unknown element type: {kind!r}"
+    return None
+
+
+class ImportJob:
+    """Progress of one streaming import"""
+
+    def __init__(self, job_id: str, user_id: str):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.status = "in_progress"
+        self.bytes_received = 0
+        self.lines_read = 0
+        self.elements_imported = 0
+        self.elements_rejected = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    def reject(self, line: int, message: str):
+        self.elements_rejected += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.finished_at or time.monotonic()
+        return {
+            "job_id": self.job_id,
+            "diagram_id": self.job_id,
+            "status": self.status,
+            "bytes_received": self.bytes_received,
+            "lines_read": self.lines_read,
+            "elements_imported": self.elements_imported,
+            "elements_rejected": self.elements_rejected,
+            "errors": self.errors,
+            "elapsed_seconds": round(end - self.started_at, 3)
+        }
+
+
+# Recent import jobs, for progress polling
+import_jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+
+
+async def discard_import(db, job_id: str, diagram_id: ObjectId):
+    """Remove whatever part of an imported diagram was written"""
+    await db.diagram_elements.delete_many({"diagram_id": job_id})
+    await db.diagrams.delete_one({"_id": diagram_id})
+
+
+def _register_job(job: ImportJob):
+    import_jobs[job.job_id] = job
+    while len(import_jobs) > IMPORT_JOB_HISTORY:
+        import_jobs.popitem(last=False)
+
+
+@router.post("/import")
+async def import_diagram(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Import a diagram from newline-delimited JSON.
+
+    The first line holds the diagram metadata (title, description,
+    is_public, collaborators, canvas_state); every following line is one
+    element. Elements are validated and written in batches as the body
+    streams in, so the diagram never has to fit in memory or in one
+    document.
+    """
+    db = get_database()
+    diagram_id = ObjectId()
+    job = ImportJob(str(diagram_id), str(current_user["_id"]))
+    _register_job(job)
+
+    batch: List[Dict[str, Any]] = []
+    header: Optional[DiagramCreate] = None
+    buffer = b""
+    z = 0
+
+    async def handle_line(raw: bytes):
+        nonlocal header, z
+        job.lines_read += 1
+        raw = raw.strip()
+        if not raw:
+            return
+        try:
+            value = loads(raw)
+        except ValueError:
+            if header is None:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="First line must be the diagram metadata object")
+            job.reject(job.lines_read, "invalid JSON")
+            return
+
+        if header is None:
+            if not isinstance(value, dict) or not isinstance(value.get("title"), str) or not value["title"].strip():
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="First line must be the diagram metadata object with a title")
+            # Same rules as a diagram created through the API
+            try:
+                header = DiagramCreate.model_validate({
+                    "title": value["title"][:200],
+                    "description": value.get("description"),
+                    "diagram_data": {"canvas_state": value.get("canvas_state") or {}},
+                    "is_public": value.get("is_public", False),
+                    "collaborators": value.get("collaborators") or []
+                })
+            except ValidationError as e:
+                errors = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid diagram metadata: {errors}")
+            await db.diagrams.insert_one({
+                "_id": diagram_id,
+                "title": header.title,
+                "description": header.description,
+                "diagram_data": {"canvas_state": header.diagram_data.canvas_state},
+                "storage": ELEMENT_STORAGE,
+                "element_count": 0,
+                "import_status": "in_progress",
+                "user_id": str(current_user["_id"]),
+                "is_public": header.is_public,
+                "collaborators": header.collaborators,
+                "version": 1,
+                "created_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow()
+            })
+            return
+
+        error = validate_element(value)
+        if error:
+            job.reject(job.lines_read, error)
+            return
+        batch.append(element_document(job.job_id, value, z))
+        z += 1
+        if len(batch) >= ELEMENT_BATCH_SIZE:
+            job.elements_imported += await insert_element_batch(db, batch)
+            batch.clear()
+
+    try:
+        async for chunk in request.stream():
+            job.bytes_received += len(chunk)
+            buffer += chunk
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            if len(buffer) > IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Line {job.lines_read + 1} exceeds {IMPORT_MAX_LINE_BYTES} bytes")
+            for line in lines:
+                await handle_line(line)
+        if buffer:
+            await handle_line(buffer)
+        if header is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Import body is empty")
+        job.elements_imported += await insert_element_batch(db, batch)
+    except BaseException:
+        # Also on cancellation (client gone, shutdown); shielded so the cleanup itself is not cut short
+        job.status = "failed"
+        job.finished_at = time.monotonic()
+        await asyncio.shield(asyncio.ensure_future(discard_import(db, job.job_id, diagram_id)))
+        raise
+
+    await db.diagrams.update_one(
+        {"_id": diagram_id},
+        {
+            "$set": {"element_count": job.elements_imported, "updated_at": datetime.utcnow()},
+            "$unset": {"import_status": ""}
+        }
+    )
+    job.status = "complete"
+    job.finished_at = time.monotonic()
+    return job.to_dict()
+
+
+@router.get("/imports")
+async def list_imports(current_user: dict = Depends(get_current_user)):
+    """List the current user's running and recent imports"""
+    user_id = str(current_user["_id"])
+    return [job.to_dict() for job in import_jobs.values() if job.user_id == user_id]
+
+
+@router.get("/imports/{job_id}")
+async def get_import_progress(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the progress of a running or recent import"""
+    job = import_jobs.get(job_id)
+    if job is None or job.user_id != str(current_user["_id"]):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Import job not found"
+        )
+    return job.to_dict()
@@ -0,0 +1,169 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set, Tuple
+
+from . import metrics
+
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # per-module overrides, e.g. "app.websocket=DEBUG,app.db=WARNING"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json or text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_PER_SECOND = float(os.getenv("LOG_SAMPLE_PER_SECOND", "20"))  # per message template, below WARNING; 0 disables
+LOG_DEBUG_DIAGRAMS = os.getenv("LOG_DEBUG_DIAGRAMS", "")  # comma-separated diagram ids with debug output on
+
+# Diagrams whose debug output is emitted regardless of module levels
+debug_diagrams: Set[str] = {diagram_id for diagram_id in LOG_DEBUG_DIAGRAMS.split(",") if diagram_id}
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the record's extra fields as top-level keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = " ".join(f"{key}={value}" for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        return f"{line} {extra}" if extra else line
+
+
+class SamplingFilter(logging.Filter):
+    """Token bucket per message template so a hot path cannot flood the log.
+
+    Warnings and errors always pass. Suppressed records are counted and
+    reported on the next record of the same template that gets through.
+    """
+
+    def __init__(self, per_second: float):
+        super().__init__()
+        self.per_second = per_second
+        self.buckets: Dict[Tuple[str, str], list] = {}  # (logger, template) -> [tokens, updated, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.per_second <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) > 10000:
+                    self.buckets.clear()
+                bucket = self.buckets[key] = [self.per_second, now, 0]
+            bucket[0] = min(self.per_second, bucket[0] + (now - bucket[1]) * self.per_second)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the writer thread; never block the caller when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Render the message and traceback here, keep the extra fields for the formatter
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[DroppingQueueHandler] = None
+
+metrics.registry.gauge(
+    "log_records_dropped", "Log records dropped because the log queue was full",
+    collect=lambda: [((), _handler.dropped if _handler else 0)]
+)
+
+
+def setup_logging():
+    """Route all logging through a bounded queue drained by a background writer thread"""
+    global _listener, _handler
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _handler = DroppingQueueHandler(log_queue)
+    _handler.addFilter(SamplingFilter(LOG_SAMPLE_PER_SECOND))
+
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(LOG_LEVEL)
+    for override in LOG_LEVELS.split(","):
+        name, _, level = override.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def diagram_debug(logger: logging.Logger, diagram_id: str, msg: str, *args, **extra):
+    """Debug record that is also emitted when debugging is switched on for this diagram"""
+    if diagram_id not in debug_diagrams and not logger.isEnabledFor(logging.DEBUG):
+        return
+    # Bypass the logger's level check, handlers still apply sampling
+    filename, lineno, func, _ = logger.findCaller(False, 2)
+    record = logger.makeRecord(
+        logger.name, logging.DEBUG, filename, lineno, msg, args, None, func,
+        extra={"diagram_id": diagram_id, **extra}
+    )
+    logger.handle(record)
@@ -1,22 +1,62 @@
+import logging
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from . import websocket, ai_service, auth, diagrams, chat
-from .db import connect_to_mongo, close_mongo_connection
+from pymongo.errors import ExecutionTimeout
+from . import websocket, ai_service, auth, diagrams, chat, export, thumbnails, imports, sse, retention, metrics, profiling, drain, startup, sharding
+from .chat_pipeline import chat_pipeline
+from .ai_gateway import ai_gateway
+from .unread import unread_tracker
+from .presence import presence
+from .persistence_policy import action_coalescer
+from .db import connect_to_mongo, close_mongo_connection, mongodb
+from .compression import CompressionMiddleware
+from .logging_config import setup_logging
+from .startup import FirstRequestMiddleware, startup_profile
+
+# Interpreter start to here: everything imported before the app exists
+startup_profile.mark("imports")
+
+# Logging goes through a queue drained off the event loop
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # Database connection lifecycle management
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    print("[DEBUG] FastAPI application starting up...")
-    await connect_to_mongo()
-    print("[DEBUG] FastAPI application startup complete")
+    with startup_profile.phase("mongo"):
+        await connect_to_mongo()
+    with startup_profile.phase("services"):
+        profiling.loop_watchdog.start()
+        thumbnails.thumbnail_service.start()
+        chat_pipeline.start()
+        retention.retention_service.start()
+        unread_tracker.start()
+        presence.start()
+        action_coalescer.start()
+    # The AI gateway opens its client on first use
+    startup_profile.ready()
+    logger.info("Application startup complete")
     yield
     # Shutdown
-    print("[DEBUG] FastAPI application shutting down...")
+    logger.info("Application shutting down")
+    # Hand clients off in waves while MongoDB is still reachable
+    await drain.drain_controller.drain()
+    await presence.stop()
+    await retention.retention_service.stop()
+    await chat_pipeline.stop()
+    await action_coalescer.stop()
+    await unread_tracker.stop()
+    await thumbnails.thumbnail_service.stop()
+    await ai_gateway.stop()
+    await profiling.loop_watchdog.stop()
+    # Canvas action log writes still in flight
+    await websocket.wait_for_action_log()
     await close_mongo_connection()
-    print("[DEBUG] FastAPI application shutdown complete")
+    logger.info("Application shutdown complete")
 
 # Create FastAPI app with lifespan events
 app = FastAPI(
@@ -26,8 +66,6 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-print("[DEBUG] FastAPI app created successfully")
-
 # CORS middleware
 app.add_middleware(
     CORSMiddleware, 
@@ -37,25 +75,57 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Compress large JSON payloads for clients that accept it
+app.add_middleware(CompressionMiddleware)
+
+# Per-route request latency; outermost so it times compression too
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Time to first request, for the cold start report
+app.add_middleware(FirstRequestMiddleware)
+
+# Reads that hit their profile's maxTimeMS are overload, not a bug
+@app.exception_handler(ExecutionTimeout)
+async def query_timeout_handler(request: Request, exc: ExecutionTimeout):
+    logger.warning("Query exceeded its time limit: %s %s", request.method, request.url.path)
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "The database took too long to answer, try again shortly"}
+    )
+
 # Include routers
 app.include_router(auth.router)
+app.include_router(imports.router)
 app.include_router(diagrams.router)
+app.include_router(export.router)
+app.include_router(thumbnails.router)
 app.include_router(chat.router)
+app.include_router(retention.router)
 app.include_router(websocket.router)
+app.include_router(sse.router)
 app.include_router(ai_service.router)
+app.include_router(metrics.router)
+app.include_router(profiling.router)
+app.include_router(drain.router)
+app.include_router(startup.router)
+app.include_router(sharding.router)
 
 # Health check endpoint
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    print("[DEBUG] Health check endpoint called")
+    if drain.drain_controller.draining:
+        # Failing the check takes the worker out of the load balancer while it drains
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "draining", "message": "Worker is draining connections"}
+        )
     return {"status": "healthy", "message": "Collaborative Diagramming API is running"}
 
 # WebSocket health check endpoint
 @app.get("/health/websocket")
 async def websocket_health_check():
     """WebSocket health check endpoint"""
-    print("[DEBUG] WebSocket health check endpoint called")
     return {
         "status": "healthy", 
         "websocket_endpoint": "/ws/{diagram_id}",
@@ -76,10 +146,8 @@ async def websocket_health_check():
 @app.get("/status")
 async def system_status():
     """Detailed system status endpoint"""
-    print("[DEBUG] System status endpoint called")
     try:
         # Test database connection
-        from .db import mongodb
         db_status = "connected" if mongodb.database is not None else "disconnected"
     except:
         db_status = "error"
@@ -109,7 +177,6 @@ async def system_status():
 # Root endpoint
 @app.get("/")
 async def root():
-    print("[DEBUG] Root endpoint called")
     return {
         "message": "Collaborative Diagramming API",
         "version": "1.0.0",
@@ -121,7 +188,7 @@ async def root():
 @app.get("/debug/websockets")
 async def debug_websockets():
     """Debug endpoint to see active WebSocket connections"""
-    from .websocket import manager
+    manager = websocket.manager
     
     connections_info = {}
     for diagram_id, connections in manager.active_connections.items():
@@ -0,0 +1,327 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+router = APIRouter(tags=["metrics"])
+
+# Metrics configuration
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # when set, scrapes must send it as a Bearer token
+METRICS_MAX_ROOMS = int(os.getenv("METRICS_MAX_ROOMS", "50"))  # per-room series, largest rooms first
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Mongo command events arrive on driver threads
+        self.lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in values]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Optional[Callable[[], Iterable[Tuple[Labels, float]]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Labels, float] = {}
+        self.collect = collect  # computed at scrape time instead of on every change
+
+    def set(self, value: float, *labels: str):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self) -> List[str]:
+        if self.collect is not None:
+            values = list(self.collect())
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Global metrics registry
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_duration = registry.histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+ws_frames_in = registry.counter("websocket_frames_received_total", "WebSocket frames received by message type", ("type",))
+ws_frames_out = registry.counter("websocket_frames_sent_total", "WebSocket frames sent by message type", ("type",))
+ws_send_failures = registry.counter("websocket_send_failures_total", "WebSocket sends that raised", ("type",))
+broadcast_duration = registry.histogram("websocket_broadcast_seconds", "Time to fan a message out to a room", ("type",))
+mongo_duration = registry.histogram("mongo_command_duration_seconds", "MongoDB command latency", ("command",))
+mongo_failures = registry.counter("mongo_command_failures_total", "MongoDB commands that failed", ("command",))
+# Fed by the loop watchdog in profiling.py
+loop_lag = registry.gauge("event_loop_lag_seconds", "Most recent event loop scheduling delay")
+loop_lag_histogram = registry.histogram(
+    "event_loop_lag_distribution_seconds", "Event loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+
+
+def top_rooms(rooms: Dict[str, list]) -> List[Tuple[Labels, float]]:
+    """Connection counts of the largest rooms, bounded so label cardinality stays fixed"""
+    sizes = sorted(((len(connections), diagram_id) for diagram_id, connections in rooms.items()), reverse=True)
+    return [((diagram_id,), count) for count, diagram_id in sizes[:METRICS_MAX_ROOMS]]
+
+
+class MetricsMiddleware:
+    """Record latency and status of every HTTP request, labelled by route template"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope; templates keep label cardinality bounded
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_duration.observe(time.perf_counter() - start, method, path)
+            http_requests.inc(method, path, str(status_code))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Time MongoDB commands from the driver's own command events"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_duration.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        mongo_duration.observe(event.duration_micros / 1e6, event.command_name)
+        mongo_failures.inc(event.command_name)
+
+
+mongo_pool_wait = registry.histogram(
+    "mongo_pool_wait_seconds", "Time spent waiting to check a connection out of the MongoDB pool", ("outcome",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+mongo_pool_checkout_failures = registry.counter(
+    "mongo_pool_checkout_failures_total", "Pool checkouts that failed, e.g. waitQueueTimeoutMS expiring", ("reason",)
+)
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Checkout waits and open/in-use connections per server, from the driver's pool events.
+
+    Events arrive on driver threads, so the counts are kept under a lock
+    and read by a gauge at scrape time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections: Dict[Tuple[str, str], int] = {}  # (address, state) -> count
+        # Connections currently checked out, so one closed while in use still leaves "in_use"
+        self.checked_out: Set[Tuple[Any, int]] = set()
+
+    def _add(self, address, state: str, delta: int):
+        key = (f"{address[0]}:{address[1]}", state)
+        with self.lock:
+            self.connections[key] = self.connections.get(key, 0) + delta
+
+    def collect(self) -> List[Tuple[Labels, float]]:
+        with self.lock:
+            # A connection checked in after its pool closed would otherwise read as -1
+            return [(key, max(0, count)) for key, count in self.connections.items()]
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        address = f"{event.address[0]}:{event.address[1]}"
+        with self.lock:
+            for key in [key for key in self.connections if key[0] == address]:
+                del self.connections[key]
+            self.checked_out = {key for key in self.checked_out if key[0] != event.address}
+
+    def connection_created(self, event):
+        self._add(event.address, "open", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(event.address, "open", -1)
+        self._release(event)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        mongo_pool_wait.observe(event.duration, "failed")
+        mongo_pool_checkout_failures.inc(str(event.reason))
+
+    def connection_checked_out(self, event):
+        mongo_pool_wait.observe(event.duration, "ok")
+        with self.lock:
+            self.checked_out.add((event.address, event.connection_id))
+        self._add(event.address, "in_use", 1)
+
+    def connection_checked_in(self, event):
+        self._release(event)
+
+    def _release(self, event):
+        """Count a connection as no longer in use, once, whether it was checked in or closed"""
+        key = (event.address, event.connection_id)
+        with self.lock:
+            if key not in self.checked_out:
+                return
+            self.checked_out.discard(key)
+        self._add(event.address, "in_use", -1)
+
+
+# One listener for the process, so the counts survive reconnects
+mongo_pool_metrics = MongoPoolMetrics()
+registry.gauge(
+    "mongo_pool_connections", "MongoDB pool connections by server and state", ("address", "state"),
+    collect=mongo_pool_metrics.collect
+)
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus text exposition of all registered metrics"""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token"
+        )
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
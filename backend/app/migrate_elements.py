@@ -0,0 +1,137 @@
+"""Convert diagrams between the embedded and element-per-document layouts.
+
+Usage:
+    python -m app.migrate_elements [--to elements|embedded] [--diagram ID] [--min-elements N] [--dry-run]
+"""
+import argparse
+import asyncio
+from datetime import datetime
+
+from bson import ObjectId
+
+from .db import close_mongo_connection, connect_to_mongo, get_database
+from .elements import (
+    ELEMENT_BATCH_SIZE, ELEMENT_STORAGE, EMBEDDED_STORAGE,
+    element_document, insert_element_batch, load_elements
+)
+
+# Stay well below MongoDB's 16 MB document limit when embedding again
+MAX_EMBEDDED_BYTES = 12 * 1024 * 1024
+CONVERT_ATTEMPTS = 3  # re-reads of a diagram that is saved while being converted
+
+
+class DiagramChanged(Exception):
+    """The diagram was saved while it was being converted; nothing was changed"""
+
+
+async def to_element_storage(db, diagram: dict, dry_run: bool) -> int:
+    """Move a diagram's embedded elements into diagram_elements"""
+    diagram_id = str(diagram["_id"])
+    elements = (diagram.get("diagram_data") or {}).get("elements", [])
+    if dry_run:
+        return len(elements)
+
+    # Re-runs start from a clean slate for this diagram
+    await db.diagram_elements.delete_many({"diagram_id": diagram_id})
+    inserted = 0
+    for start in range(0, len(elements), ELEMENT_BATCH_SIZE):
+        batch = [
+            element_document(diagram_id, element, z)
+            for z, element in enumerate(elements[start:start + ELEMENT_BATCH_SIZE], start)
+        ]
+        inserted += await insert_element_batch(db, batch)
+
+    # Only switch layouts if no save landed since the diagram was read
+    result = await db.diagrams.update_one(
+        {"_id": diagram["_id"], "version": diagram.get("version", 0)},
+        {
+            "$set": {"storage": ELEMENT_STORAGE, "element_count": inserted, "updated_at": datetime.utcnow()},
+            "$unset": {"diagram_data.elements": ""},
+            "$inc": {"version": 1}
+        }
+    )
+    if result.matched_count == 0:
+        # The diagram is still embedded, so these element documents are ours alone
+        await db.diagram_elements.delete_many({"diagram_id": diagram_id})
+        raise DiagramChanged()
+    return inserted
+
+
+async def to_embedded_storage(db, diagram: dict, dry_run: bool) -> int:
+    """Fold a diagram's element documents back into the diagram document"""
+    elements = await load_elements(db, diagram)
+    if dry_run:
+        return len(elements)
+
+    from bson import BSON
+    if len(BSON.encode({"elements": elements})) > MAX_EMBEDDED_BYTES:
+        raise ValueError("elements are too large to embed in a single document")
+
+    result = await db.diagrams.update_one(
+        {"_id": diagram["_id"], "version": diagram.get("version", 0)},
+        {
+            "$set": {
+                "diagram_data.elements": elements, "storage": EMBEDDED_STORAGE,
+                "element_count": len(elements), "updated_at": datetime.utcnow()
+            },
+            "$inc": {"version": 1}
+        }
+    )
+    if result.matched_count == 0:
+        # A save changed the element documents after they were loaded; keep them
+        raise DiagramChanged()
+    await db.diagram_elements.delete_many({"diagram_id": str(diagram["_id"])})
+    return len(elements)
+
+
+async def migrate(target: str, diagram_id: str = None, min_elements: int = 0, dry_run: bool = False):
+    await connect_to_mongo()
+    db = get_database()
+    try:
+        if target == ELEMENT_STORAGE:
+            query = {"storage": {"$ne": ELEMENT_STORAGE}}
+            if min_elements:
+                query[f"diagram_data.elements.{min_elements - 1}"] = {"$exists": True}
+            convert = to_element_storage
+        else:
+            query = {"storage": ELEMENT_STORAGE}
+            convert = to_embedded_storage
+        if diagram_id:
+            query["_id"] = ObjectId(diagram_id)
+
+        converted = failed = 0
+        async for diagram in db.diagrams.find(query):
+            oid = diagram["_id"]
+            try:
+                for attempt in range(CONVERT_ATTEMPTS):
+                    try:
+                        count = await convert(db, diagram, dry_run)
+                        break
+                    except DiagramChanged:
+                        if attempt == CONVERT_ATTEMPTS - 1:
+                            raise RuntimeError("diagram kept changing during conversion, run again later")
+                        diagram = await db.diagrams.find_one({**query, "_id": oid})
+                        if diagram is None:
+                            raise RuntimeError("diagram was deleted or converted during conversion")
+                converted += 1
+                print(f"{'Would convert' if dry_run else 'Converted'} diagram {oid} ({count} elements) to {target}")
+            except Exception as e:
+                failed += 1
+                print(f"Failed to convert diagram {oid}: {e}")
+        print(f"Done: {converted} converted, {failed} failed")
+    finally:
+        await close_mongo_connection()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert diagrams between storage layouts")
+    parser.add_argument("--to", choices=[ELEMENT_STORAGE, EMBEDDED_STORAGE], default=ELEMENT_STORAGE)
+    parser.add_argument("--diagram", help="Only convert this diagram id")
+    parser.add_argument("--min-elements", type=int, default=0, help="Only convert diagrams with at least this many elements")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.to, args.diagram, args.min_elements, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
+from pydantic_core import core_schema
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 from bson import ObjectId
@@ -6,8 +7,10 @@ from bson import ObjectId
 # Custom ObjectId type for MongoDB
 class PyObjectId(ObjectId):
     @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+    def __get_pydantic_core_schema__(cls, source, handler):
+        return core_schema.no_info_plain_validator_function(
+            cls.validate, serialization=core_schema.to_string_ser_schema()
+        )
 
     @classmethod
     def validate(cls, v):
@@ -16,8 +19,11 @@ class PyObjectId(ObjectId):
         return ObjectId(v)
 
     @classmethod
-    def __modify_schema__(cls, field_schema):
-        field_schema.update(type="string")
+    def __get_pydantic_json_schema__(cls, schema, handler):
+        return {"type": "string"}
+
+# Response models read `_id` from stored documents but accept `id` too
+MONGO_MODEL_CONFIG = ConfigDict(populate_by_name=True)
 
 # User Models
 class UserCreate(BaseModel):
@@ -39,10 +45,7 @@ class UserResponse(BaseModel):
     last_login: Optional[datetime] = None
     is_active: bool = True
 
-    class Config:
-        allow_population_by_field_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = MONGO_MODEL_CONFIG
 
 class UserUpdate(BaseModel):
     username: Optional[str] = None
@@ -64,11 +67,8 @@ class ChatMessage(BaseModel):
     is_edited: bool = False
     is_deleted: bool = False
     reactions: Dict[str, List[str]] = {}  # emoji -> list of user_ids
-    
-    class Config:
-        allow_population_by_field_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+
+    model_config = MONGO_MODEL_CONFIG
 
 class ChatMessageCreate(BaseModel):
     message: str = Field(..., min_length=1, max_length=2000)
@@ -89,13 +89,20 @@ class ChatMessageResponse(BaseModel):
     is_edited: bool = False
     is_deleted: bool = False
     reactions: Dict[str, List[str]] = {}
-    
-    class Config:
-        allow_population_by_field_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
     is_active: Optional[bool] = None
 
+    model_config = MONGO_MODEL_CONFIG
+
+class ChatSearchHit(BaseModel):
+    message: ChatMessageResponse
+    score: float
+    excerpt: str
+    highlights: List[List[int]] = []  # [start, end) offsets into excerpt
+
+class ChatSearchResponse(BaseModel):
+    results: List[ChatSearchHit]
+    next_cursor: Optional[str] = None
+
 # Token Models
 class Token(BaseModel):
     access_token: str
@@ -132,13 +139,13 @@ class DiagramResponse(BaseModel):
     user_id: str
     is_public: bool
     collaborators: List[str]
+    version: int = 0
+    thumbnail_url: Optional[str] = None
+    unread_count: Optional[int] = None
     created_at: datetime
     updated_at: datetime
-    
-    class Config:
-        allow_population_by_field_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+
+    model_config = MONGO_MODEL_CONFIG
 
 # Chat models are already defined above
 
@@ -153,3 +160,8 @@ class CanvasState(BaseModel):
     diagram_id: str
     actions: List[DrawingAction] = []
     last_updated: datetime = Field(default_factory=datetime.utcnow)
+
+# Sharding Models
+class ShardRebalance(BaseModel):
+    nodes: Dict[str, str]  # shard id -> base WebSocket URL
+    pins: Dict[str, str] = {}  # diagram id -> shard id
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from .db import get_collection
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# How each drawing action type is persisted
+EPHEMERAL = "ephemeral"  # broadcast only
+COALESCIBLE = "coalescible"  # only the last state within the window is written
+DURABLE = "durable"  # every action is written
+POLICIES = (EPHEMERAL, COALESCIBLE, DURABLE)
+
+DEFAULT_POLICY: Dict[str, str] = {
+    "draw": DURABLE,
+    "add_shape": DURABLE,
+    "add_text": DURABLE,
+    "erase": DURABLE,
+    "delete": DURABLE,
+    "clear": DURABLE,
+    "move": COALESCIBLE,
+    "drag": COALESCIBLE,
+    "resize": COALESCIBLE,
+    "rotate": COALESCIBLE,
+    "update_text": COALESCIBLE,
+    "update_style": COALESCIBLE,
+    "select": EPHEMERAL,
+    "hover": EPHEMERAL,
+    "preview": EPHEMERAL,
+    "*": EPHEMERAL,  # action types not listed
+}
+
+
+def parse_policy(spec: str) -> Dict[str, str]:
+    """Overrides like "move=durable,laser=ephemeral,*=coalescible" """
+    policy = dict(DEFAULT_POLICY)
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value:
+            if value.strip() not in POLICIES:
+                raise ValueError(f"Unknown persistence policy {value.strip()!r} for {name.strip()!r}")
+            policy[name.strip()] = value.strip()
+    return policy
+
+
+ACTION_POLICY = parse_policy(os.getenv("ACTION_POLICY", ""))
+ACTION_COALESCE_WINDOW_MS = int(os.getenv("ACTION_COALESCE_WINDOW_MS", "500"))
+ACTION_COALESCE_MAX_PENDING = int(os.getenv("ACTION_COALESCE_MAX_PENDING", "5000"))  # elements with unwritten state
+ACTION_RETRY_MAX_SECONDS = 5.0
+
+canvas_actions = metrics.registry.counter(
+    "canvas_actions_total", "Drawing actions received, by persistence policy", ("policy",)
+)
+coalesced_actions = metrics.registry.counter(
+    "canvas_actions_coalesced_total", "Coalescible drawing actions superseded before they were written"
+)
+
+
+def action_policy(action_type: str) -> str:
+    return ACTION_POLICY.get(action_type) or ACTION_POLICY["*"]
+
+
+def element_key(document: Dict[str, Any]) -> Tuple[str, str]:
+    """What an action applies to: its element, or the sender's current selection when it names none"""
+    data = document["data"]
+    element = data.get("element_id") or data.get("id")
+    return document["diagram_id"], str(element) if element is not None else "user:" + document["user_id"]
+
+
+class ActionCoalescer:
+    """Collapse bursts of coalescible actions to their final state before writing.
+
+    Actions are grouped per element; within a group only the latest action
+    of each type is kept. A group is written ACTION_COALESCE_WINDOW_MS
+    after its first action, so a drag of any length costs one insert per
+    window while its last position always reaches MongoDB. Writes for one
+    element never overlap: a durable action waits for the element's batch
+    in flight and takes any buffered group along in the same ordered
+    insert, and a batch waits for the element's durable write in flight.
+    """
+
+    def __init__(self):
+        # (diagram_id, element) -> [first buffered at, {action_type: document}]
+        self.pending: Dict[Tuple[str, str], list] = {}
+        # (diagram_id, element) -> the write of its actions currently in flight
+        self.writing: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.flush_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.flush_lock = asyncio.Lock()
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # The last state of every element must survive a restart
+        while self.pending:
+            if not await self.flush(force=True):
+                logger.error("Dropping unsaved state for %d canvas elements on shutdown", len(self.pending))
+                break
+
+    async def submit(self, document: Dict[str, Any]):
+        """Buffer a coalescible action, replacing the element's earlier one of the same type"""
+        if self.task is None:
+            # No background flusher (e.g. scripts): write through
+            await get_collection("canvas_actions", "actions").insert_one(document)
+            return
+        key = element_key(document)
+        group = self.pending.get(key)
+        if group is None:
+            self.pending[key] = [time.monotonic(), {document["action_type"]: document}]
+        else:
+            if document["action_type"] in group[1]:
+                coalesced_actions.inc()
+            group[1][document["action_type"]] = document
+        if len(self.pending) >= ACTION_COALESCE_MAX_PENDING:
+            # The database is falling behind; hold the sender until it catches up
+            await self.flush(force=True)
+
+    async def take(self, document: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Buffered actions for the element a durable action applies to; they must be written first.
+
+        Waits for the element's batch in flight, so a failed batch is back in
+        the buffer (and taken along) before the durable action is written.
+        """
+        key = element_key(document)
+        await self._settle(key)
+        group = self.pending.pop(key, None)
+        return list(group[1].values()) if group else []
+
+    def track(self, document: Dict[str, Any], write: Optional[asyncio.Future]):
+        """Register the in-flight durable write for an element, so its next batch waits for it"""
+        if write is not None and not write.done():
+            self._track(element_key(document), write)
+
+    def _track(self, key: Tuple[str, str], write: asyncio.Future):
+        self.writing[key] = write
+        write.add_done_callback(lambda _: self.writing.pop(key) if self.writing.get(key) is write else None)
+
+    async def _settle(self, key: Tuple[str, str]):
+        write = self.writing.get(key)
+        if write is not None and not write.done():
+            # Only the ordering matters here; the writer reports its own failures
+            await asyncio.wait([write])
+
+    async def flush(self, force: bool = False) -> bool:
+        """Write groups whose window has closed (all of them if forced); False if the write failed"""
+        async with self.flush_lock:
+            cutoff = time.monotonic() - ACTION_COALESCE_WINDOW_MS / 1000.0
+            # Groups are kept in the order they were opened, so the due ones are at the front
+            due = []
+            for key, (opened, _) in self.pending.items():
+                if not force and opened > cutoff:
+                    break
+                due.append(key)
+            if not due:
+                return True
+            batch = {key: self.pending.pop(key) for key in due}
+            documents = [document for _, actions in batch.values() for document in actions.values()]
+            earlier = [self.writing[key] for key in batch if key in self.writing and not self.writing[key].done()]
+            written = asyncio.get_running_loop().create_future()
+            for key in batch:
+                self._track(key, written)
+            try:
+                if earlier:
+                    await asyncio.wait(earlier)
+                await get_collection("canvas_actions", "actions").insert_many(documents)
+            except PyMongoError as e:
+                logger.error("Canvas action batch write failed: %s", e)
+                for key, (opened, actions) in batch.items():
+                    # Anything newer that arrived meanwhile wins
+                    newer = self.pending.pop(key, [opened, {}])[1]
+                    self.pending[key] = [opened, {**actions, **newer}]
+                return False
+            finally:
+                # Re-queued before waiters resume, so a durable action takes a failed batch along
+                written.set_result(None)
+            return True
+
+    async def _run(self):
+        delay = 0.0
+        while True:
+            await asyncio.sleep(max(ACTION_COALESCE_WINDOW_MS / 2000.0, delay))
+            try:
+                ok = await self.flush()
+            except Exception as e:
+                logger.error("Canvas action flusher error: %s", e)
+                ok = False
+            if ok:
+                delay = 0.0
+            else:
+                delay = min(ACTION_RETRY_MAX_SECONDS, max(0.1, delay * 2))
+
+
+# Global action coalescer instance
+action_coalescer = ActionCoalescer()
+
+metrics.registry.gauge(
+    "canvas_actions_pending_elements", "Canvas elements whose latest coalescible state is not yet written",
+    collect=lambda: [((), len(action_coalescer.pending))]
+)
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from fastapi import WebSocket
+
+from . import metrics
+from .ratelimit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Presence configuration
+PRESENCE_PING_INTERVAL_SECONDS = float(os.getenv("PRESENCE_PING_INTERVAL_SECONDS", "20"))  # ping sockets quiet this long
+PRESENCE_TIMEOUT_SECONDS = float(os.getenv("PRESENCE_TIMEOUT_SECONDS", "60"))  # evict sockets silent this long
+PRESENCE_ROOM_IDLE_SECONDS = float(os.getenv("PRESENCE_ROOM_IDLE_SECONDS", "120"))  # keep empty-room state this long
+PRESENCE_SWEEP_SECONDS = float(os.getenv("PRESENCE_SWEEP_SECONDS", "5"))
+
+evictions = metrics.registry.counter(
+    "presence_evictions_total", "WebSocket connections removed without a clean disconnect", ("reason",)
+)
+
+
+class PresenceTracker:
+    """Who is in which room, and whether their sockets are still alive.
+
+    Every frame a client sends counts as a heartbeat; sockets that have
+    been quiet for PRESENCE_PING_INTERVAL_SECONDS get a ping, and those
+    silent past PRESENCE_TIMEOUT_SECONDS are evicted as half-open. Room
+    members are kept per user with a connection count, so membership
+    checks and user lists never scan connections.
+
+    Rooms and users that go empty keep their sequence numbers and rate
+    limit buckets for PRESENCE_ROOM_IDLE_SECONDS, so a reconnect blip
+    neither resets them nor buys a fresh burst.
+    """
+
+    def __init__(self):
+        # websocket -> [diagram_id, user_id, last frame received]
+        self.connections: Dict[WebSocket, list] = {}
+        # diagram_id -> user_id -> [public user info, open connections]
+        self.rooms: Dict[str, Dict[str, list]] = {}
+        # When rooms and users lost their last connection
+        self.idle_rooms: Dict[str, float] = {}
+        self.idle_users: Dict[str, float] = {}
+        self.user_connections: Dict[str, int] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def join(self, websocket: WebSocket, diagram_id: str, user: dict) -> bool:
+        """Track a new connection; True if the user was not in the room yet"""
+        user_id = str(user["_id"])
+        self.connections[websocket] = [diagram_id, user_id, time.monotonic()]
+        self.idle_rooms.pop(diagram_id, None)
+        self.idle_users.pop(user_id, None)
+        self.user_connections[user_id] = self.user_connections.get(user_id, 0) + 1
+        members = self.rooms.setdefault(diagram_id, {})
+        member = members.get(user_id)
+        if member is None:
+            members[user_id] = [{"id": user_id, "username": user["username"]}, 1]
+            return True
+        member[1] += 1
+        return False
+
+    def leave(self, websocket: WebSocket) -> bool:
+        """Forget a connection; True if it was the user's last one in the room"""
+        entry = self.connections.pop(websocket, None)
+        if entry is None:
+            return False
+        diagram_id, user_id, _ = entry
+        now = time.monotonic()
+        self.user_connections[user_id] -= 1
+        if not self.user_connections[user_id]:
+            del self.user_connections[user_id]
+            self.idle_users[user_id] = now
+        members = self.rooms[diagram_id]
+        member = members[user_id]
+        member[1] -= 1
+        if member[1]:
+            return False
+        del members[user_id]
+        if not members:
+            del self.rooms[diagram_id]
+            self.idle_rooms[diagram_id] = now
+        return True
+
+    def touch(self, websocket: WebSocket):
+        entry = self.connections.get(websocket)
+        if entry is not None:
+            entry[2] = time.monotonic()
+
+    def users(self, diagram_id: str) -> List[Dict[str, Any]]:
+        """Users in a room, one entry per user however many tabs they have open"""
+        return [member[0] for member in self.rooms.get(diagram_id, {}).values()]
+
+    def is_present(self, diagram_id: str, user_id: str) -> bool:
+        return user_id in self.rooms.get(diagram_id, ())
+
+    def user_count(self) -> int:
+        return len(self.user_connections)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_SWEEP_SECONDS)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error("Presence sweep failed: %s", e)
+
+    async def sweep(self):
+        from .websocket import manager
+
+        now = time.monotonic()
+        ping = json.dumps({"type": "ping"})
+        for websocket, (diagram_id, _, last_seen) in list(self.connections.items()):
+            quiet = now - last_seen
+            if quiet >= PRESENCE_TIMEOUT_SECONDS:
+                await self.evict(websocket, diagram_id, "timeout")
+            elif quiet >= PRESENCE_PING_INTERVAL_SECONDS:
+                try:
+                    await manager.send_personal_message(ping, websocket, "ping")
+                except Exception:
+                    await self.evict(websocket, diagram_id, "send_failed")
+
+        for diagram_id, since in list(self.idle_rooms.items()):
+            if now - since >= PRESENCE_ROOM_IDLE_SECONDS:
+                del self.idle_rooms[diagram_id]
+                manager.room_seq.pop(diagram_id, None)
+                rate_limiter.release_room(diagram_id)
+        for user_id, since in list(self.idle_users.items()):
+            if now - since >= PRESENCE_ROOM_IDLE_SECONDS:
+                del self.idle_users[user_id]
+                rate_limiter.release_user(user_id)
+
+    async def evict(self, websocket: WebSocket, diagram_id: str, reason: str):
+        """Drop a connection that stopped answering and make a last attempt to close it"""
+        from .websocket import manager
+
+        if websocket not in self.connections:
+            return
+        evictions.inc(reason)
+        logger.info("Evicting WebSocket: %s", reason, extra={"diagram_id": diagram_id})
+        manager.disconnect(websocket, diagram_id)
+        try:
+            await asyncio.wait_for(websocket.close(code=1001), 1.0)
+        except Exception:
+            pass
+
+
+# Global presence tracker instance
+presence = PresenceTracker()
+
+metrics.registry.gauge(
+    "presence_users", "Distinct users with at least one open WebSocket",
+    collect=lambda: [((), presence.user_count())]
+)
+metrics.registry.gauge(
+    "presence_idle_rooms", "Empty rooms whose state is kept until PRESENCE_ROOM_IDLE_SECONDS",
+    collect=lambda: [((), len(presence.idle_rooms))]
+)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+
+from . import metrics
+from .auth import get_admin_user
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+logger = logging.getLogger(__name__)
+
+# Profiling configuration
+PROFILE_HEARTBEAT_MS = int(os.getenv("PROFILE_HEARTBEAT_MS", "20"))
+SLOW_CALLBACK_MS = int(os.getenv("SLOW_CALLBACK_MS", "100"))  # a loop stall longer than this is recorded
+PROFILE_STALL_LOG_SIZE = int(os.getenv("PROFILE_STALL_LOG_SIZE", "100"))
+PROFILE_MAX_SECONDS = 60
+STACK_DEPTH = 40
+
+loop_stalls = metrics.registry.counter("event_loop_stalls_total", "Callbacks that blocked the event loop past SLOW_CALLBACK_MS")
+loop_stall_duration = metrics.registry.histogram(
+    "event_loop_stall_seconds", "Duration of event loop stalls",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def collapsed_stack(frame, depth: int = STACK_DEPTH) -> str:
+    """Root-to-leaf frames joined by ';', the collapsed format flame graph tools read"""
+    labels = []
+    while frame is not None and len(labels) < depth:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def frame_context(frame) -> Dict[str, Any]:
+    """Route and diagram of the request a stalled frame belongs to.
+
+    A running coroutine's frames chain back through the endpoint and the
+    ASGI middleware, so their locals already name the request; nothing has
+    to be recorded per request ahead of time.
+    """
+    context: Dict[str, Any] = {}
+    while frame is not None:
+        local = frame.f_locals
+        diagram_id = local.get("diagram_id")
+        if "diagram_id" not in context and isinstance(diagram_id, str):
+            context["diagram_id"] = diagram_id
+        scope = local.get("scope")
+        if "path" not in context and isinstance(scope, dict) and scope.get("type") in ("http", "websocket"):
+            context["path"] = scope.get("path")
+            route = scope.get("route")
+            if route is not None:
+                context["route"] = getattr(route, "path", None)
+        frame = frame.f_back
+    return context
+
+
+class LoopWatchdog:
+    """Heartbeat on the event loop plus a watcher thread that catches it when it stops beating.
+
+    The heartbeat measures scheduling lag continuously. When no beat arrives
+    for SLOW_CALLBACK_MS, the watcher grabs the loop thread's current stack,
+    which is the code blocking the loop, while it is still blocking.
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.last_beat = 0.0
+        self.expected = 0.0
+        self.stall: Optional[Dict[str, Any]] = None
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=PROFILE_STALL_LOG_SIZE)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.stopping.clear()
+        self._beat()
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        await asyncio.to_thread(self.thread.join)
+        self.thread = None
+
+    def _beat(self):
+        interval = PROFILE_HEARTBEAT_MS / 1000.0
+        now = time.perf_counter()
+        if self.expected:
+            lag = max(0.0, now - self.expected)
+            metrics.loop_lag.set(lag)
+            metrics.loop_lag_histogram.observe(lag)
+        self.last_beat = now
+        self.expected = now + interval
+        self.handle = self.loop.call_later(interval, self._beat)
+
+    def _watch(self):
+        poll = PROFILE_HEARTBEAT_MS / 1000.0
+        threshold = SLOW_CALLBACK_MS / 1000.0
+        while not self.stopping.wait(poll):
+            last_beat = self.last_beat
+            blocked = time.perf_counter() - last_beat - poll
+            if self.stall is not None and self.stall["beat"] != last_beat:
+                self._finish_stall(last_beat)
+            if blocked >= threshold and self.stall is None:
+                self._capture_stall(last_beat)
+
+    def _capture_stall(self, last_beat: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        try:
+            context = frame_context(frame)
+        except Exception:
+            context = {}
+        self.stall = {
+            "beat": last_beat,
+            "detected_at": datetime.utcnow().isoformat(),
+            "stack": traceback.format_stack(frame, limit=STACK_DEPTH),
+            "collapsed": collapsed_stack(frame),
+            **context
+        }
+        del frame
+
+    def _finish_stall(self, resumed_beat: float):
+        stall, self.stall = self.stall, None
+        # The loop was due to beat one interval after the last beat before the stall
+        duration = max(0.0, resumed_beat - stall.pop("beat") - PROFILE_HEARTBEAT_MS / 1000.0)
+        stall["duration_ms"] = round(duration * 1000, 1)
+        self.stalls.append(stall)
+        loop_stalls.inc()
+        loop_stall_duration.observe(duration)
+        logger.warning(
+            "Event loop blocked for %.0f ms in %s", duration * 1000, stall["collapsed"].rsplit(";", 1)[-1],
+            extra={key: stall[key] for key in ("route", "path", "diagram_id") if key in stall}
+        )
+
+
+# Global loop watchdog instance
+loop_watchdog = LoopWatchdog()
+
+_profile_lock = asyncio.Lock()
+
+
+def sample_stacks(thread_ids: Optional[List[int]], seconds: float, interval: float) -> Counter:
+    """Sample thread stacks at a fixed interval; runs on its own thread"""
+    counts: Counter = Counter()
+    own = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or (thread_ids is not None and thread_id not in thread_ids):
+                continue
+            prefix = names.get(thread_id, str(thread_id))
+            counts[f"{prefix};{collapsed_stack(frame, 200)}"] += 1
+        time.sleep(interval)
+    return counts
+
+
+@router.get("/profile")
+async def capture_profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval_ms: int = Query(10, ge=1, le=1000),
+    all_threads: bool = Query(False),
+    admin: dict = Depends(get_admin_user)
+):
+    """Sample the running worker and return collapsed stacks for a flame graph"""
+    if _profile_lock.locked():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A profile is already being captured"
+        )
+    async with _profile_lock:
+        thread_ids = None if all_threads else [threading.get_ident()]
+        counts = await asyncio.to_thread(sample_stacks, thread_ids, seconds, interval_ms / 1000.0)
+    body = "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    return Response(body, media_type="text/plain; charset=utf-8")
+
+
+@router.get("/stalls")
+async def recent_stalls(admin: dict = Depends(get_admin_user)):
+    """Most recent event loop stalls with the blocking stack, newest first"""
+    return list(reversed(loop_watchdog.stalls))
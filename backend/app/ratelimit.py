@@ -0,0 +1,118 @@
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from . import metrics
+
+# WebSocket admission configuration
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(2 * 1024 * 1024)))
+WS_MAX_CONNECTIONS_PER_DIAGRAM = int(os.getenv("WS_MAX_CONNECTIONS_PER_DIAGRAM", "100"))
+WS_MAX_CONNECTIONS_PER_USER = int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "20"))
+WS_THROTTLE_NOTICE_SECONDS = float(os.getenv("WS_THROTTLE_NOTICE_SECONDS", "1"))
+
+# message type -> (per-user rate, burst, per-room rate, burst); rates are frames per second
+DEFAULT_LIMITS: Dict[str, Tuple[float, float, float, float]] = {
+    "drawing_action": (60, 120, 600, 1200),
+    "cursor_position": (30, 60, 1000, 2000),
+    "chat_message": (5, 10, 50, 100),
+    "diagram_update": (5, 10, 20, 40),
+    "other": (10, 20, 100, 200),
+}
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, float, float, float]]:
+    """Overrides like "drawing_action=30/60/300/600,chat_message=2/5/20/40" """
+    limits = dict(DEFAULT_LIMITS)
+    for item in spec.split(","):
+        name, _, values = item.partition("=")
+        if name.strip() and values:
+            user_rate, user_burst, room_rate, room_burst = (float(value) for value in values.split("/"))
+            limits[name.strip()] = (user_rate, user_burst, room_rate, room_burst)
+    return limits
+
+
+WS_RATE_LIMITS = parse_limits(os.getenv("WS_RATE_LIMITS", ""))
+
+throttled_frames = metrics.registry.counter(
+    "websocket_frames_throttled_total", "WebSocket frames dropped by rate limits", ("type", "scope")
+)
+rejected = metrics.registry.counter(
+    "websocket_rejected_total", "WebSocket frames and connections refused by admission control", ("reason",)
+)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Take a token; returns 0 on success, otherwise seconds until one is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimiter:
+    """Token buckets per user and per room, one of each for every message type.
+
+    A user's budget is shared by all of their connections, so opening more
+    tabs does not buy more throughput; the room budget caps what everyone
+    in a diagram can push through together.
+    """
+
+    def __init__(self):
+        # user or diagram id -> message type -> bucket
+        self.user_buckets: Dict[str, Dict[str, TokenBucket]] = {}
+        self.room_buckets: Dict[str, Dict[str, TokenBucket]] = {}
+
+    def limits(self, message_type: str) -> Tuple[str, Tuple[float, float, float, float]]:
+        if message_type in WS_RATE_LIMITS:
+            return message_type, WS_RATE_LIMITS[message_type]
+        return "other", WS_RATE_LIMITS["other"]
+
+    def admit(self, user_id: str, diagram_id: str, message_type: str) -> Optional[float]:
+        """None if the frame may proceed, otherwise the suggested retry delay in seconds"""
+        kind, (user_rate, user_burst, room_rate, room_burst) = self.limits(message_type)
+        now = time.monotonic()
+
+        buckets = self.user_buckets.setdefault(user_id, {})
+        user_bucket = buckets.get(kind)
+        if user_bucket is None:
+            user_bucket = buckets[kind] = TokenBucket(user_rate, user_burst)
+        wait = user_bucket.take(now)
+        if wait:
+            throttled_frames.inc(kind, "user")
+            return wait
+
+        buckets = self.room_buckets.setdefault(diagram_id, {})
+        room_bucket = buckets.get(kind)
+        if room_bucket is None:
+            room_bucket = buckets[kind] = TokenBucket(room_rate, room_burst)
+        wait = room_bucket.take(now)
+        if wait:
+            # The frame is not sent, so it should not count against the user either
+            user_bucket.refund()
+            throttled_frames.inc(kind, "room")
+            return wait
+        return None
+
+    def release_user(self, user_id: str):
+        self.user_buckets.pop(user_id, None)
+
+    def release_room(self, diagram_id: str):
+        self.room_buckets.pop(diagram_id, None)
+
+
+# Global rate limiter instance
+rate_limiter = RateLimiter()
@@ -0,0 +1,131 @@
+import json
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple, Type, TypeVar
+
+from bson import ObjectId
+from fastapi.responses import Response
+from pydantic import BaseModel, TypeAdapter
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
+
+def _default(value: Any):
+    """Encode the BSON types that show up in Mongo documents"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """Serialize a Mongo document (or list of them) straight to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    """Parse JSON bytes with the fastest available decoder"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class MongoJSONResponse(Response):
+    """JSON response that renders raw Mongo documents without Pydantic round-trips"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+M = TypeVar("M", bound=BaseModel)
+
+
+@lru_cache(maxsize=None)
+def _document_keys(model: Type[BaseModel]) -> Tuple[Tuple[str, str], ...]:
+    """(field name, document key) pairs, worked out once per model"""
+    return tuple((name, field.alias or name) for name, field in model.model_fields.items())
+
+
+def from_document(model: Type[M], document: Dict[str, Any]) -> M:
+    """Wrap a stored document in a response model without validating it.
+
+    Only for data this API wrote itself: fields are read by alias (so
+    `_id` fills `id`), ObjectIds become strings and everything else is
+    taken as stored. Keys the model does not declare, like a user's
+    password hash, are left behind.
+    """
+    values = {}
+    for name, key in _document_keys(model):
+        if key in document:
+            value = document[key]
+            values[name] = str(value) if isinstance(value, ObjectId) else value
+    return model.model_construct(**values)
+
+
+@lru_cache(maxsize=None)
+def _list_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+
+def dump_model(content: Any) -> bytes:
+    """Serialize a response model, or a list of one model type, to JSON bytes"""
+    if isinstance(content, BaseModel):
+        return content.__pydantic_serializer__.to_json(content, by_alias=True)
+    if not content:
+        return b"[]"
+    return _list_adapter(type(content[0])).dump_json(content, by_alias=True)
+
+
+class ModelResponse(Response):
+    """JSON response written by pydantic's compiled serializer.
+
+    Returning it skips FastAPI's response_model re-validation and the
+    intermediate dict, so the route's response_model only documents the
+    schema.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dump_model(content)
+
+
+def has_thumbnail(diagram: Dict[str, Any]) -> bool:
+    """Whether a diagram has anything to preview; unknown (older summaries) counts as yes"""
+    count = diagram.get("element_count")
+    if count is None and "elements" in (diagram.get("diagram_data") or {}):
+        count = len(diagram["diagram_data"]["elements"])
+    return count != 0
+
+
+def diagram_document(diagram: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a stored diagram like DiagramResponse without re-validating it"""
+    diagram_data = diagram.get("diagram_data") or {}
+    version = diagram.get("version", 0)
+    document = {
+        "_id": str(diagram["_id"]),
+        "title": diagram["title"],
+        "description": diagram.get("description"),
+        "diagram_data": {
+            "elements": diagram_data.get("elements", []),
+            "canvas_state": diagram_data.get("canvas_state", {})
+        },
+        "user_id": diagram["user_id"],
+        "is_public": diagram["is_public"],
+        "collaborators": diagram.get("collaborators", []),
+        "version": version,
+        "thumbnail_url": f"/diagrams/{diagram['_id']}/thumbnail?v={version}" if has_thumbnail(diagram) else None,
+        "created_at": diagram["created_at"],
+        "updated_at": diagram["updated_at"]
+    }
+    if "unread_count" in diagram:
+        document["unread_count"] = diagram["unread_count"]
+    return document
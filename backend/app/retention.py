@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import os
+import socket
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import Binary, ObjectId
+from fastapi import APIRouter, Depends, HTTPException, status
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from .auth import get_current_user
+from .chat import verify_diagram_access
+from .chat_cache import normalize_chat_message, recent_chat
+from .db import get_database
+from .responses import dumps, loads
+from .unread import unread_tracker
+
+router = APIRouter(prefix="/chat", tags=["chat"])
+logger = logging.getLogger(__name__)
+
+# Retention configuration (0 disables a rule)
+CHAT_DELETED_TTL_DAYS = float(os.getenv("CHAT_DELETED_TTL_DAYS", "30"))
+CANVAS_ACTIONS_TTL_DAYS = float(os.getenv("CANVAS_ACTIONS_TTL_DAYS", "7"))
+CHAT_ARCHIVE_AFTER_DAYS = float(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "90"))
+CHAT_ARCHIVE_CHUNK_SIZE = int(os.getenv("CHAT_ARCHIVE_CHUNK_SIZE", "1000"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_BATCH_PAUSE_MS = int(os.getenv("RETENTION_BATCH_PAUSE_MS", "50"))
+RETENTION_LEASE_SECONDS = float(os.getenv("RETENTION_LEASE_SECONDS", "600"))  # renewed between batches
+
+# Collections holding per-diagram rows, purged after the diagram is deleted
+DIAGRAM_COLLECTIONS = ("chat_messages", "diagram_elements", "canvas_actions", "chat_archives", "chat_read_markers")
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+async def ensure_ttl_index(collection, field: str, days: float):
+    """Create a TTL index, or retune it when the configured lifetime changed"""
+    if days <= 0:
+        return
+    seconds = int(days * DAY_SECONDS)
+    try:
+        await collection.create_index(field, expireAfterSeconds=seconds, name=f"{field}_ttl")
+    except OperationFailure as e:
+        # 85/86: an index on this key already exists with other options
+        if e.code not in (85, 86):
+            raise
+        await collection.database.command(
+            "collMod", collection.name,
+            index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds}
+        )
+
+
+def pack_messages(messages: List[Dict[str, Any]]) -> Binary:
+    return Binary(zlib.compress(b"\n".join(dumps(message) for message in messages), 6))
+
+
+def unpack_messages(data: bytes) -> List[Dict[str, Any]]:
+    return [loads(line) for line in zlib.decompress(data).split(b"\n") if line]
+
+
+async def acquire_lease(db, name: str, owner: str, seconds: float) -> bool:
+    """Take or extend a lease in the locks collection; False while another worker holds it"""
+    now = datetime.utcnow()
+    try:
+        await db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lease exists and is unexpired, so the upsert tried to insert a second one
+        return False
+    return True
+
+
+async def pace():
+    """Yield between batches so retention work never monopolises the database"""
+    await asyncio.sleep(RETENTION_BATCH_PAUSE_MS / 1000.0)
+
+
+class LeaseLost(Exception):
+    """Another worker took over the retention lease mid-pass"""
+
+
+class RetentionService:
+    """Background TTL setup, chat archival and batched diagram purges.
+
+    Every worker runs the loop, but a pass only runs under the "retention"
+    lease, so one worker at a time archives and resumes purges. The lease
+    is renewed between batches; a worker that loses it stops its pass.
+    Each diagram purge holds a "purge:<diagram_id>" lease the same way.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{ObjectId()}"
+        self.task: Optional[asyncio.Task] = None
+        self.purges: Dict[str, asyncio.Task] = {}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self.purges.values())
+        if self.task is not None:
+            tasks.append(self.task)
+            self.task = None
+        for task in tasks:
+            task.cancel()
+        # Interrupted purges are resumed from purge_jobs on the next start
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        db = get_database()
+        try:
+            await ensure_ttl_index(db.chat_messages, "deleted_at", CHAT_DELETED_TTL_DAYS)
+            await ensure_ttl_index(db.canvas_actions, "timestamp", CANVAS_ACTIONS_TTL_DAYS)
+            await db.canvas_actions.create_index("diagram_id")
+            await db.chat_archives.create_index([("diagram_id", 1), ("start_at", -1)])
+        except Exception as e:
+            logger.error("Failed to create retention indexes: %s", e)
+
+        while True:
+            try:
+                # Skip the pass while another worker holds the lease
+                if await self.hold_lease(db):
+                    # Resume purges interrupted by a restart or a failed batch
+                    async for job in db.purge_jobs.find({}):
+                        self._start_purge(job["_id"])
+                    await self.stamp_legacy_deletes(db)
+                    if CHAT_ARCHIVE_AFTER_DAYS > 0:
+                        await self.archive_old_messages(db)
+            except asyncio.CancelledError:
+                raise
+            except LeaseLost:
+                logger.warning("Retention lease taken over by another worker, stopping this pass")
+            except Exception as e:
+                logger.error("Retention pass failed: %s", e)
+            await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+    async def hold_lease(self, db) -> bool:
+        return await acquire_lease(db, "retention", self.owner, RETENTION_LEASE_SECONDS)
+
+    async def renew_lease(self, db):
+        if not await self.hold_lease(db):
+            raise LeaseLost()
+
+    async def stamp_legacy_deletes(self, db):
+        """Give soft-deleted messages from before the TTL index a deleted_at so they expire"""
+        if CHAT_DELETED_TTL_DAYS <= 0:
+            return
+        while True:
+            ids = [
+                document["_id"] async for document in db.chat_messages.find(
+                    {"is_deleted": True, "deleted_at": {"$exists": False}}, {"_id": 1}
+                ).limit(RETENTION_BATCH_SIZE)
+            ]
+            if not ids:
+                return
+            await db.chat_messages.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"deleted_at": datetime.utcnow()}}
+            )
+            await pace()
+            await self.renew_lease(db)
+
+    async def archive_old_messages(self, db) -> int:
+        """Move chat older than the archive cutoff into compressed per-diagram chunks"""
+        cutoff = datetime.utcnow() - timedelta(days=CHAT_ARCHIVE_AFTER_DAYS)
+        archived = 0
+        diagram_ids = await db.chat_messages.distinct(
+            "diagram_id", {"created_at": {"$lt": cutoff}, "is_deleted": False}
+        )
+        for diagram_id in diagram_ids:
+            while True:
+                messages = await db.chat_messages.find(
+                    {"diagram_id": diagram_id, "created_at": {"$lt": cutoff}, "is_deleted": False}
+                ).sort([("created_at", 1), ("_id", 1)]).limit(CHAT_ARCHIVE_CHUNK_SIZE).to_list(length=CHAT_ARCHIVE_CHUNK_SIZE)
+                if not messages:
+                    break
+                await self.write_archive_chunk(db, diagram_id, messages)
+                await db.chat_messages.delete_many({"_id": {"$in": [message["_id"] for message in messages]}})
+                archived += len(messages)
+                await pace()
+                await self.renew_lease(db)
+            recent_chat.drop(diagram_id)
+        if archived:
+            logger.info("Archived %d chat messages from %d diagrams", archived, len(diagram_ids))
+        return archived
+
+    async def write_archive_chunk(self, db, diagram_id: str, messages: List[Dict[str, Any]]):
+        # Keyed by the first message, so a pass interrupted between write and delete is merged on retry
+        archive_id = f"{diagram_id}:{messages[0]['_id']}"
+        merged = {str(m["_id"]): m for m in (loads(dumps(m)) for m in messages)}
+        try:
+            existing = await db.chat_archives.find_one({"_id": archive_id})
+            if existing:
+                merged = {**{m["_id"]: m for m in unpack_messages(existing["data"])}, **merged}
+            messages = sorted(merged.values(), key=lambda m: (m["created_at"], m["_id"]))
+            await db.chat_archives.replace_one({"_id": archive_id}, {
+                "_id": archive_id,
+                "diagram_id": diagram_id,
+                "start_at": datetime.fromisoformat(messages[0]["created_at"]),
+                "end_at": datetime.fromisoformat(messages[-1]["created_at"]),
+                "count": len(messages),
+                "codec": "zlib+ndjson",
+                "data": pack_messages(messages),
+                "archived_at": datetime.utcnow()
+            }, upsert=True)
+        except DuplicateKeyError:
+            # Another worker archived the same chunk concurrently
+            pass
+
+    async def purge_diagram(self, diagram_id: str):
+        """Queue removal of everything a deleted diagram left behind"""
+        db = get_database()
+        await db.purge_jobs.update_one(
+            {"_id": diagram_id},
+            {"$setOnInsert": {"created_at": datetime.utcnow()}},
+            upsert=True
+        )
+        recent_chat.drop(diagram_id)
+        unread_tracker.forget(diagram_id)
+        self._start_purge(diagram_id)
+
+    def _start_purge(self, diagram_id: str):
+        if diagram_id in self.purges:
+            return
+        task = asyncio.create_task(self._purge(diagram_id))
+        self.purges[diagram_id] = task
+        task.add_done_callback(lambda _: self.purges.pop(diagram_id, None))
+
+    async def _purge(self, diagram_id: str):
+        db = get_database()
+        # One lease per diagram, so a delete is purged at once by the worker that handled it
+        # while a retention pass elsewhere cannot resume the same purge alongside it
+        lease = f"purge:{diagram_id}"
+        try:
+            if not await acquire_lease(db, lease, self.owner, RETENTION_LEASE_SECONDS):
+                return
+            for name in DIAGRAM_COLLECTIONS:
+                await self.delete_in_batches(db[name], {"diagram_id": diagram_id}, lease=lease)
+            await db.diagram_thumbnails.delete_one({"_id": diagram_id})
+            await db.purge_jobs.delete_one({"_id": diagram_id})
+            await db.locks.delete_one({"_id": lease, "owner": self.owner})
+        except asyncio.CancelledError:
+            raise
+        except LeaseLost:
+            logger.warning("Diagram purge taken over by another worker", extra={"diagram_id": diagram_id})
+        except Exception as e:
+            logger.error("Diagram purge failed, will retry on the next pass: %s", e, extra={"diagram_id": diagram_id})
+
+    async def delete_in_batches(self, collection, query: Dict[str, Any], lease: Optional[str] = None) -> int:
+        """Delete matching documents a batch at a time instead of in one long operation"""
+        deleted = 0
+        while True:
+            ids = [
+                document["_id"] async for document in
+                collection.find(query, {"_id": 1}).limit(RETENTION_BATCH_SIZE)
+            ]
+            if not ids:
+                return deleted
+            result = await collection.delete_many({"_id": {"$in": ids}})
+            deleted += result.deleted_count
+            await pace()
+            if lease and not await acquire_lease(collection.database, lease, self.owner, RETENTION_LEASE_SECONDS):
+                raise LeaseLost()
+
+
+# Global retention service instance
+retention_service = RetentionService()
+
+
+@router.get("/{diagram_id}/archives")
+async def list_chat_archives(
+    diagram_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """List archived chat chunks of a diagram, newest first"""
+    db = get_database()
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    archives = await db.chat_archives.find(
+        {"diagram_id": diagram_id}, {"data": 0}
+    ).sort("start_at", -1).to_list(length=None)
+    return [
+        {
+            "id": archive["_id"],
+            "start_at": archive["start_at"],
+            "end_at": archive["end_at"],
+            "count": archive["count"]
+        }
+        for archive in archives
+    ]
+
+
+@router.get("/{diagram_id}/archives/{archive_id}")
+async def get_chat_archive(
+    diagram_id: str,
+    archive_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the messages of one archived chat chunk"""
+    db = get_database()
+    await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    archive = await db.chat_archives.find_one({"_id": archive_id, "diagram_id": diagram_id})
+    if not archive:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Archive not found"
+        )
+    return [normalize_chat_message(message) for message in unpack_messages(archive["data"])]
@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from . import metrics
+from .auth import get_admin_user, get_current_user
+from .models import ShardRebalance
+
+router = APIRouter(tags=["shards"])
+logger = logging.getLogger(__name__)
+
+# Sharding configuration
+SHARD_ID = os.getenv("SHARD_ID", "")  # this worker's name in SHARD_NODES
+SHARD_NODES = os.getenv("SHARD_NODES", "")  # "a=ws://10.0.0.1:8001,b=ws://10.0.0.1:8002"
+SHARD_PINS = os.getenv("SHARD_PINS", "")  # "<diagram_id>=b" keeps a room on a chosen worker
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))  # ring points per worker
+SHARD_MOVE_WAVE_ROOMS = int(os.getenv("SHARD_MOVE_WAVE_ROOMS", "20"))
+SHARD_MOVE_WAVE_INTERVAL_MS = int(os.getenv("SHARD_MOVE_WAVE_INTERVAL_MS", "500"))
+
+redirects = metrics.registry.counter(
+    "shard_redirects_total", "Room requests sent to the worker that owns the room", ("transport",)
+)
+moved_rooms = metrics.registry.counter(
+    "shard_rooms_moved_total", "Open rooms handed to another worker by a rebalance"
+)
+
+
+def parse_mapping(spec: str) -> Dict[str, str]:
+    """"a=ws://host:8001,b=ws://host:8002" -> {"a": "ws://host:8001", "b": "ws://host:8002"}"""
+    mapping = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            mapping[name.strip()] = value.strip()
+    return mapping
+
+
+def http_url(url: str) -> str:
+    """HTTP base URL of a worker from its WebSocket one (ws -> http, wss -> https)"""
+    return "http" + url[2:] if url.startswith("ws") else url
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring; adding or removing a worker only moves the rooms next to it"""
+
+    def __init__(self, nodes: List[str], vnodes: int = SHARD_VNODES):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardRouter:
+    """Which worker process owns each diagram room.
+
+    Every worker runs its own event loop, so a room only competes for CPU
+    with the rooms hashed to the same worker; running one worker per core
+    spreads rooms over all of them. A socket that lands on the wrong
+    worker is told where its room lives during the handshake, and a hot
+    room can be pinned to a worker of its own. REST and SSE requests that
+    touch a room's live state are refused the same way (see
+    require_room_owner), because room events only fan out from the
+    owner's connections and chat cache. With SHARD_NODES unset there is
+    a single shard and nothing is redirected.
+    """
+
+    def __init__(self, shard_id: str, nodes: Dict[str, str], pins: Dict[str, str]):
+        self.shard_id = shard_id
+        self.configure(nodes, pins)
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.nodes)
+
+    def configure(self, nodes: Dict[str, str], pins: Dict[str, str]):
+        if nodes and self.shard_id not in nodes:
+            raise ValueError(f"SHARD_ID {self.shard_id!r} is not one of the shard nodes")
+        unknown = set(pins.values()) - set(nodes)
+        if unknown:
+            raise ValueError(f"Rooms pinned to unknown shards: {', '.join(sorted(unknown))}")
+        self.nodes = nodes
+        self.pins = pins
+        self.ring = HashRing(list(nodes))
+
+    def owner(self, diagram_id: str) -> str:
+        if not self.enabled:
+            return self.shard_id
+        return self.pins.get(diagram_id) or self.ring.owner(diagram_id)
+
+    def redirect_url(self, diagram_id: str) -> Optional[str]:
+        """Base WebSocket URL of the worker that owns the room, if it is not this one"""
+        owner = self.owner(diagram_id)
+        if owner == self.shard_id:
+            return None
+        return self.nodes[owner]
+
+    def rebalance(self, nodes: Dict[str, str], pins: Dict[str, str]) -> List[str]:
+        """Apply a new shard map and start handing off the open rooms this worker lost"""
+        from .websocket import manager
+
+        self.configure(nodes, pins)
+        moving = [diagram_id for diagram_id in manager.active_connections if self.redirect_url(diagram_id)]
+        if moving:
+            if self.task is not None and not self.task.done():
+                self.task.cancel()
+            self.task = asyncio.create_task(self._move(moving))
+        logger.info("Shard map updated: %d shards, %d pins, %d open rooms moving",
+                    len(nodes), len(pins), len(moving))
+        return moving
+
+    async def _move(self, diagram_ids: List[str]):
+        from .drain import drain_controller
+
+        try:
+            await drain_controller.flush()
+        except Exception as e:
+            logger.error("Shard handoff flush failed: %s", e)
+        for start in range(0, len(diagram_ids), SHARD_MOVE_WAVE_ROOMS):
+            if start:
+                await asyncio.sleep(SHARD_MOVE_WAVE_INTERVAL_MS / 1000.0)
+            for diagram_id in diagram_ids[start:start + SHARD_MOVE_WAVE_ROOMS]:
+                # The map may have changed again while we waited
+                url = self.redirect_url(diagram_id)
+                if url:
+                    await drain_controller.close_rooms([diagram_id], url=url)
+                    moved_rooms.inc()
+
+    def load(self) -> Dict[str, Any]:
+        """Rooms and connections on this shard, busiest rooms first"""
+        from .websocket import manager
+
+        rooms: List[Tuple[str, int]] = sorted(
+            ((diagram_id, len(connections)) for diagram_id, connections in manager.active_connections.items()),
+            key=lambda room: -room[1]
+        )
+        return {
+            "rooms": len(rooms),
+            "connections": sum(count for _, count in rooms),
+            "busiest_rooms": [{"diagram_id": diagram_id, "connections": count} for diagram_id, count in rooms[:10]]
+        }
+
+
+# Global shard router instance
+shard_router = ShardRouter(SHARD_ID, parse_mapping(SHARD_NODES), parse_mapping(SHARD_PINS))
+
+
+async def require_room_owner(diagram_id: str):
+    """Dependency for room routes: answer 421 with the owner's URL on any other worker"""
+    url = shard_router.redirect_url(diagram_id)
+    if url:
+        redirects.inc("http")
+        raise HTTPException(
+            status_code=status.HTTP_421_MISDIRECTED_REQUEST,
+            detail={
+                "message": "This diagram is served by another worker",
+                "shard": shard_router.owner(diagram_id),
+                "url": http_url(url)
+            }
+        )
+
+
+def _shard_load(kind: str):
+    return [((shard_router.shard_id or "default",), shard_router.load()[kind])]
+
+
+metrics.registry.gauge(
+    "shard_rooms", "Open diagram rooms on this shard", ("shard",), collect=lambda: _shard_load("rooms")
+)
+metrics.registry.gauge(
+    "shard_connections", "Open WebSocket connections on this shard", ("shard",),
+    collect=lambda: _shard_load("connections")
+)
+
+
+@router.get("/shards/{diagram_id}")
+async def room_shard(diagram_id: str, current_user: dict = Depends(get_current_user)):
+    """Where to open the WebSocket for a diagram, so clients can skip the redirect"""
+    owner = shard_router.owner(diagram_id)
+    url = shard_router.nodes.get(owner)
+    return {"diagram_id": diagram_id, "shard": owner or None, "url": url, "http_url": http_url(url) if url else None}
+
+
+@router.get("/admin/shards")
+async def shard_status(admin: dict = Depends(get_admin_user)):
+    """This worker's shard map and load"""
+    return {
+        "shard": shard_router.shard_id or None,
+        "nodes": shard_router.nodes,
+        "pins": shard_router.pins,
+        "load": shard_router.load()
+    }
+
+
+@router.put("/admin/shards")
+async def rebalance_shards(body: ShardRebalance, admin: dict = Depends(get_admin_user)):
+    """Replace this worker's shard map; send it to every worker"""
+    try:
+        moving = shard_router.rebalance(body.nodes, body.pins)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"moving_rooms": moving, **(await shard_status(admin))}
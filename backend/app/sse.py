@@ -1,95 +1,118 @@
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import StreamingResponse
-from typing import AsyncGenerator, Dict, Set
+from typing import AsyncGenerator, Callable, Dict, Optional, Set
 import json
 import asyncio
 import logging
 from datetime import datetime
-from .auth import get_current_user
+from bson import ObjectId
+from .auth import get_stream_user
 from .db import get_database
-from .models import User
+from . import metrics
+from .logging_config import diagram_debug
+from .sharding import require_room_owner
 
 router = APIRouter()
-
-# Store active SSE connections by diagram_id
-active_sse_connections: Dict[str, Set[AsyncGenerator]] = {}
 logger = logging.getLogger(__name__)
 
+# Events buffered per SSE connection before a slow client starts losing them
+SSE_QUEUE_SIZE = 256
+SSE_HEARTBEAT_SECONDS = 30
+
 class SSEManager:
     def __init__(self):
-        self.connections: Dict[str, Set[AsyncGenerator]] = {}
+        # One outgoing queue per open event stream
+        self.connections: Dict[str, Set[asyncio.Queue]] = {}
+        # Per-user streams, for events that are not tied to one diagram
+        self.user_connections: Dict[str, Set[asyncio.Queue]] = {}
     
-    async def add_connection(self, diagram_id: str, generator: AsyncGenerator):
-        if diagram_id not in self.connections:
-            self.connections[diagram_id] = set()
-        self.connections[diagram_id].add(generator)
-        logger.info(f"SSE connection added for diagram {diagram_id}. Total: {len(self.connections[diagram_id])}")
+    def add_connection(self, diagram_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.connections.setdefault(diagram_id, set()).add(queue)
+        diagram_debug(logger, diagram_id, "SSE connection added, %d in room", len(self.connections[diagram_id]))
+        return queue
     
-    async def remove_connection(self, diagram_id: str, generator: AsyncGenerator):
+    def remove_connection(self, diagram_id: str, queue: asyncio.Queue):
         if diagram_id in self.connections:
-            self.connections[diagram_id].discard(generator)
+            self.connections[diagram_id].discard(queue)
             if not self.connections[diagram_id]:
                 del self.connections[diagram_id]
-            logger.info(f"SSE connection removed for diagram {diagram_id}")
+            diagram_debug(logger, diagram_id, "SSE connection removed")
+    
+    def add_user_connection(self, user_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.user_connections.setdefault(user_id, set()).add(queue)
+        return queue
+    
+    def remove_user_connection(self, user_id: str, queue: asyncio.Queue):
+        if user_id in self.user_connections:
+            self.user_connections[user_id].discard(queue)
+            if not self.user_connections[user_id]:
+                del self.user_connections[user_id]
     
     async def broadcast_to_diagram(self, diagram_id: str, message: dict):
-        if diagram_id not in self.connections:
+        self._push(self.connections.get(diagram_id), message)
+    
+    def send_to_user(self, user_id: str, message: dict):
+        self._push(self.user_connections.get(user_id), message)
+    
+    def _push(self, queues: Optional[Set[asyncio.Queue]], message: dict):
+        if not queues:
             return
         
-        message_str = json.dumps(message)
-        dead_connections = []
-        
-        for generator in self.connections[diagram_id].copy():
+        event = f"data: {json.dumps(message, default=str)}\n\n"
+        for queue in queues:
             try:
-                await generator.asend(f"data: {message_str}\n\n")
-                logger.info(f"SSE message sent to connection for diagram {diagram_id}")
-            except Exception as e:
-                logger.error(f"SSE connection error: {e}")
-                dead_connections.append(generator)
-        
-        # Remove dead connections
-        for dead_conn in dead_connections:
-            await self.remove_connection(diagram_id, dead_conn)
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Never let one stalled client hold up the sender
+                logger.warning("SSE queue full, dropping event")
 
 sse_manager = SSEManager()
 
-async def event_stream(diagram_id: str, user: User):
+metrics.registry.gauge(
+    "sse_connections", "Open server-sent event streams", ("kind",),
+    collect=lambda: [
+        (("diagram",), sum(len(queues) for queues in sse_manager.connections.values())),
+        (("user",), sum(len(queues) for queues in sse_manager.user_connections.values()))
+    ]
+)
+
+async def event_stream(queue: asyncio.Queue, on_close: Callable[[], None]) -> AsyncGenerator[str, None]:
     """Generate Server-Sent Events for real-time updates"""
-    
-    async def event_generator():
-        try:
-            # Send initial connection message
-            yield f"data: {json.dumps({'type': 'connected', 'message': 'SSE connection established'})}\n\n"
-            
-            # Keep connection alive
-            while True:
-                try:
-                    # Send heartbeat every 30 seconds
-                    yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.utcnow().isoformat()})}\n\n"
-                    await asyncio.sleep(30)
-                except asyncio.CancelledError:
-                    break
-                except Exception as e:
-                    logger.error(f"SSE generator error: {e}")
-                    break
-        finally:
-            await sse_manager.remove_connection(diagram_id, event_generator)
-    
-    generator = event_generator()
-    await sse_manager.add_connection(diagram_id, generator)
-    return generator
+    try:
+        # Send initial connection message
+        yield f"data: {json.dumps({'type': 'connected', 'message': 'SSE connection established'})}\n\n"
+        
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Keep the connection alive through idle proxies
+                yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.utcnow().isoformat()})}\n\n"
+    finally:
+        on_close()
+
+def sse_response(stream: AsyncGenerator[str, None]) -> StreamingResponse:
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "Cache-Control"
+        }
+    )
 
-@router.get("/sse/diagram/{diagram_id}")
-async def sse_endpoint(diagram_id: str, current_user: User = Depends(get_current_user)):
+@router.get("/sse/diagram/{diagram_id}", dependencies=[Depends(require_room_owner)])
+async def sse_endpoint(diagram_id: str, current_user: dict = Depends(get_stream_user)):
     """Server-Sent Events endpoint for real-time diagram updates"""
     
-    logger.info(f"SSE connection request from {current_user.username} for diagram {diagram_id}")
-    
     # Verify diagram access (similar to WebSocket verification)
     db = get_database()
     try:
-        from bson import ObjectId
-        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, {"diagram_data": 0})
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid diagram ID")
     
@@ -97,8 +120,8 @@ async def sse_endpoint(diagram_id: str, current_user: User = Depends(get_current
         raise HTTPException(status_code=404, detail="Diagram not found")
     
     # Check access permissions
-    user_id = str(current_user.id)
-    user_email = current_user.email
+    user_id = str(current_user["_id"])
+    user_email = current_user.get("email", "")
     
     has_access = (
         diagram["user_id"] == user_id or 
@@ -111,18 +134,9 @@ async def sse_endpoint(diagram_id: str, current_user: User = Depends(get_current
         raise HTTPException(status_code=403, detail="Access denied to this diagram")
     
     # Create event stream
-    generator = await event_stream(diagram_id, current_user)
+    queue = sse_manager.add_connection(diagram_id)
     
-    return StreamingResponse(
-        generator,
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Cache-Control"
-        }
-    )
+    return sse_response(event_stream(queue, lambda: sse_manager.remove_connection(diagram_id, queue)))
 
 # Function to broadcast messages (to be called from chat.py)
 async def broadcast_chat_message(diagram_id: str, message: dict):
@@ -0,0 +1,159 @@
+"""Cold start profiling and lazy imports.
+
+    python -m app.startup            # import-time breakdown of the API process
+    python -m app.startup --top 40
+"""
+import argparse
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import time
+import types
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends
+
+from .auth import get_admin_user
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+# Optional dependencies loaded on first attribute access instead of at startup
+_lazy_modules: Dict[str, Any] = {}
+
+
+def lazy_import(name: str):
+    """Return a module that is only executed when one of its attributes is first used"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    _lazy_modules[name] = module
+    return module
+
+
+def _process_started() -> Optional[float]:
+    """Wall-clock time the process was started, from /proc where available"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
+class StartupProfile:
+    """Durations of the phases between process start and the first request"""
+
+    def __init__(self):
+        # Fall back to when this module was imported if the process start is unknown
+        process_started = _process_started()
+        self.origin = process_started or time.time()
+        self.measured_from = "process_start" if process_started else "app_import"
+        self.phases: List[Tuple[str, float]] = []
+        self.ready_at: Optional[float] = None
+        self.first_request_at: Optional[float] = None
+
+    def mark(self, name: str, since: Optional[float] = None):
+        """Record a phase that ran from `since` (default: the process start) until now"""
+        self.phases.append((name, time.time() - (self.origin if since is None else since)))
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - started))
+
+    def ready(self):
+        self.ready_at = time.time()
+
+    def report(self) -> Dict[str, Any]:
+        def offset(at: Optional[float]) -> Optional[float]:
+            return round(at - self.origin, 4) if at is not None else None
+
+        return {
+            "measured_from": self.measured_from,
+            "phases": [{"name": name, "seconds": round(seconds, 4)} for name, seconds in self.phases],
+            "ready_seconds": offset(self.ready_at),
+            "first_request_seconds": offset(self.first_request_at),
+            "modules_loaded": len(sys.modules),
+            "lazy_modules": {
+                name: type(module) is types.ModuleType
+                for name, module in _lazy_modules.items()
+            }
+        }
+
+
+# Global startup profile instance
+startup_profile = StartupProfile()
+
+
+class FirstRequestMiddleware:
+    """Timestamps the first request the worker receives"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if startup_profile.first_request_at is None and scope["type"] in ("http", "websocket"):
+            startup_profile.first_request_at = time.time()
+        await self.app(scope, receive, send)
+
+
+@router.get("/startup")
+async def startup_report(admin: dict = Depends(get_admin_user)):
+    """Where this worker spent its cold start"""
+    return startup_profile.report()
+
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_breakdown(module: str = "app.main") -> List[Tuple[str, int, int]]:
+    """(module, self µs, cumulative µs) for every import made by a fresh `import module`"""
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=backend_dir, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2))))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    rows = import_breakdown(args.module)
+    total = next((cumulative for name, _, cumulative in rows if name == args.module), 0)
+    packages: Dict[str, int] = defaultdict(int)
+    for name, own, _ in rows:
+        packages[name if name.startswith("app.") else name.split(".")[0]] += own
+
+    print(f"import {args.module}: {total / 1000:.1f} ms, {len(rows)} modules\n")
+    print(f"{'ms (self)':>10}  {'share':>6}  package / app module")
+    for name, own in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{own / 1000:>10.1f}  {own / total if total else 0:>6.1%}  {name}")
+
+
+if __name__ == "__main__":
+    main()
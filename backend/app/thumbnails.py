@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
+
+from bson import Binary, ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from pymongo.errors import DuplicateKeyError
+
+from .auth import get_current_user
+from .caching import RenderedExport, export_cache
+from .chat import verify_diagram_access
+from .db import get_database
+from .elements import load_elements
+from .export import canvas_size, render_raster
+
+router = APIRouter(prefix="/diagrams", tags=["thumbnails"])
+logger = logging.getLogger(__name__)
+
+# Thumbnail configuration
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "320"))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "WEBP").upper()
+THUMBNAIL_DEBOUNCE_SECONDS = float(os.getenv("THUMBNAIL_DEBOUNCE_SECONDS", "3"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+THUMBNAIL_MEDIA_TYPES = {"WEBP": "image/webp", "PNG": "image/png"}
+
+
+def thumbnail_media_type(thumbnail_format: str) -> str:
+    return THUMBNAIL_MEDIA_TYPES.get(thumbnail_format, "application/octet-stream")
+
+
+def render_thumbnail(elements, width: int, height: int) -> bytes:
+    """Render a downscaled preview; runs inside a worker process"""
+    scale = min(1.0, THUMBNAIL_WIDTH / float(width))
+    return render_raster(elements, width, height, scale, THUMBNAIL_FORMAT)
+
+
+class ThumbnailService:
+    """Debounced background thumbnail rendering on a process pool"""
+
+    def __init__(self):
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending: Dict[str, asyncio.TimerHandle] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def start(self):
+        if self.executor is None and THUMBNAIL_WORKERS > 0:
+            self.executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+
+    async def stop(self):
+        for handle in self.pending.values():
+            handle.cancel()
+        self.pending.clear()
+        for task in list(self.tasks.values()):
+            task.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def schedule(self, diagram_id: str):
+        """Render a thumbnail once saves for this diagram have settled"""
+        if self.executor is None:
+            return
+        loop = asyncio.get_running_loop()
+        handle = self.pending.pop(diagram_id, None)
+        if handle is not None:
+            handle.cancel()
+        self.pending[diagram_id] = loop.call_later(THUMBNAIL_DEBOUNCE_SECONDS, self._start_render, diagram_id)
+
+    def _start_render(self, diagram_id: str):
+        self.pending.pop(diagram_id, None)
+        if diagram_id in self.tasks:
+            # A render is already running; pick up the newer version afterwards
+            self.schedule(diagram_id)
+            return
+        task = asyncio.create_task(self.render(diagram_id))
+        self.tasks[diagram_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(diagram_id, None))
+
+    async def render(self, diagram_id: str) -> Optional[Dict]:
+        """Render and store the thumbnail for the current diagram version"""
+        db = get_database()
+        diagram = await db.diagrams.find_one(
+            {"_id": ObjectId(diagram_id)},
+            {"version": 1, "diagram_data": 1, "storage": 1}
+        )
+        if not diagram:
+            return None
+        version = diagram.get("version", 0)
+
+        existing = await db.diagram_thumbnails.find_one({"_id": diagram_id}, {"data": 0})
+        if existing and existing["version"] >= version:
+            return existing
+
+        diagram_data = diagram.get("diagram_data") or {}
+        width, height = canvas_size(diagram_data.get("canvas_state", {}))
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(
+                self.executor, render_thumbnail, await load_elements(db, diagram), width, height
+            )
+        except Exception as e:
+            logger.error("Thumbnail render failed: %s", e, extra={"diagram_id": diagram_id})
+            return None
+
+        thumbnail = {
+            "_id": diagram_id,
+            "version": version,
+            "format": THUMBNAIL_FORMAT,
+            "data": Binary(data),
+            "created_at": datetime.utcnow()
+        }
+        # Never overwrite a thumbnail of a newer version
+        try:
+            await db.diagram_thumbnails.replace_one(
+                {"_id": diagram_id, "version": {"$lt": version}},
+                thumbnail,
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
+        export_cache.put((diagram_id, version, "thumbnail"), RenderedExport(data, thumbnail_media_type(THUMBNAIL_FORMAT)))
+        return thumbnail
+
+
+# Global thumbnail service instance
+thumbnail_service = ThumbnailService()
+
+
+@router.get("/{diagram_id}/thumbnail")
+async def get_thumbnail(
+    diagram_id: str,
+    v: Optional[int] = Query(None, ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a diagram preview image"""
+    immutable = {"Cache-Control": "private, max-age=31536000, immutable"}
+
+    db = get_database()
+    diagram = await verify_diagram_access(diagram_id, current_user, db, projection={"diagram_data": 0})
+    version = diagram.get("version", 0)
+
+    cached = export_cache.get((diagram_id, version, "thumbnail"))
+    if cached is not None:
+        headers = immutable if v == version else {"Cache-Control": "private, no-cache"}
+        return Response(content=cached.body, media_type=cached.media_type, headers=headers)
+
+    thumbnail = await db.diagram_thumbnails.find_one({"_id": diagram_id})
+    if not thumbnail or thumbnail["version"] < version:
+        # Render on demand when the background job has not caught up yet
+        if thumbnail_service.executor is not None:
+            rendered = await thumbnail_service.render(diagram_id)
+            if rendered and "data" in rendered:
+                thumbnail = rendered
+            elif rendered:
+                thumbnail = await db.diagram_thumbnails.find_one({"_id": diagram_id})
+    if not thumbnail:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Thumbnail not available"
+        )
+
+    # Served as the format it was rendered in, which THUMBNAIL_FORMAT may no longer be
+    data = bytes(thumbnail["data"])
+    media_type = thumbnail_media_type(thumbnail.get("format", THUMBNAIL_FORMAT))
+    export_cache.put((diagram_id, thumbnail["version"], "thumbnail"), RenderedExport(data, media_type))
+    headers = immutable if v == thumbnail["version"] else {"Cache-Control": "private, no-cache"}
+    return Response(content=data, media_type=media_type, headers=headers)
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .db import get_database
+from .sse import sse_manager
+
+logger = logging.getLogger(__name__)
+
+# Unread tracking configuration
+UNREAD_FLUSH_INTERVAL_MS = int(os.getenv("UNREAD_FLUSH_INTERVAL_MS", "1000"))
+UNREAD_CACHE_SIZE = int(os.getenv("UNREAD_CACHE_SIZE", "100000"))
+
+MarkerKey = Tuple[str, str]  # (user_id, diagram_id)
+
+
+def marker_id(user_id: str, diagram_id: str) -> str:
+    return f"{user_id}:{diagram_id}"
+
+
+class UnreadTracker:
+    """Per-diagram chat sequence numbers and per-user read markers.
+
+    Each diagram counts its messages in `chat_seq`; a reader's last-read
+    marker is the sequence number they have seen. Unread is the difference,
+    so a new message costs one counter increment instead of a write per
+    reader. Increments and marker moves accumulate in memory and are
+    flushed as coalesced bulk writes.
+    """
+
+    def __init__(self):
+        # Last chat_seq read back from MongoDB; other workers increment it too, so it
+        # is refreshed after every flush and re-read where an exact value matters
+        self.seq: "OrderedDict[str, int]" = OrderedDict()
+        self.markers: "OrderedDict[MarkerKey, int]" = OrderedDict()  # persisted read markers
+        self.pending_messages: Dict[str, int] = {}
+        self.pending_reads: Dict[MarkerKey, int] = {}
+        self.inflight_messages: Dict[str, int] = {}  # increments being written right now
+        # Dashboard subscribers: diagram -> users watching it, user -> their diagrams
+        self.watchers: Dict[str, Set[str]] = {}
+        self.watched: Dict[str, Set[str]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def _remember(self, cache: OrderedDict, key, value: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > UNREAD_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    async def current_seq(self, db, diagram_id: str, fresh: bool = False) -> int:
+        """Latest chat sequence number; `fresh` re-reads it instead of trusting the cache"""
+        if fresh or diagram_id not in self.seq:
+            diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, {"chat_seq": 1})
+            seq = (diagram or {}).get("chat_seq", 0) + self.inflight_messages.get(diagram_id, 0)
+            self._remember(self.seq, diagram_id, seq)
+        return self.seq[diagram_id] + self.pending_messages.get(diagram_id, 0)
+
+    def _marker(self, key: MarkerKey) -> Optional[int]:
+        if key in self.pending_reads:
+            return max(self.pending_reads[key], self.markers.get(key, 0))
+        return self.markers.get(key)
+
+    async def load_markers(self, db, keys: Iterable[MarkerKey]) -> Dict[MarkerKey, int]:
+        """Read markers for the given (user, diagram) pairs, fetching unknown ones in one query"""
+        keys = list(keys)
+        missing = [key for key in keys if self._marker(key) is None]
+        if missing:
+            found = {
+                (document["user_id"], document["diagram_id"]): document["seq"]
+                async for document in db.chat_read_markers.find({"_id": {"$in": [marker_id(*key) for key in missing]}})
+            }
+            for key in missing:
+                self._remember(self.markers, key, found.get(key, 0))
+        return {key: self._marker(key) or 0 for key in keys}
+
+    async def on_message(self, diagram_id: str, sender_id: str, readers: Iterable[str] = ()):
+        """Count a new message; its sender and anyone watching the room have read it"""
+        db = get_database()
+        await self.current_seq(db, diagram_id)
+        self.pending_messages[diagram_id] = self.pending_messages.get(diagram_id, 0) + 1
+        seq = await self.current_seq(db, diagram_id)
+        for user_id in {sender_id, *readers}:
+            self._advance((user_id, diagram_id), seq)
+
+        watchers = self.watchers.get(diagram_id)
+        if watchers:
+            markers = await self.load_markers(db, [(user_id, diagram_id) for user_id in watchers])
+            for (user_id, _), marker in markers.items():
+                self._notify(user_id, diagram_id, seq, marker)
+
+    async def mark_read(self, user_id: str, diagram_id: str, seq: Optional[int] = None) -> int:
+        """Move a reader's marker forward, to the latest message by default"""
+        latest = await self.current_seq(get_database(), diagram_id, fresh=True)
+        seq = latest if seq is None else max(0, min(seq, latest))
+        self._advance((user_id, diagram_id), seq)
+        self._notify(user_id, diagram_id, latest, self._marker((user_id, diagram_id)) or 0)
+        return seq
+
+    def forget(self, diagram_id: str):
+        """Drop a deleted diagram's counters and markers, so no flush writes them back"""
+        self.seq.pop(diagram_id, None)
+        self.pending_messages.pop(diagram_id, None)
+        for cache in (self.markers, self.pending_reads):
+            for key in [key for key in cache if key[1] == diagram_id]:
+                del cache[key]
+        for user_id in self.watchers.pop(diagram_id, set()):
+            self.watched.get(user_id, set()).discard(diagram_id)
+
+    def _advance(self, key: MarkerKey, seq: int):
+        if seq > (self._marker(key) or 0):
+            self.pending_reads[key] = seq
+
+    def _notify(self, user_id: str, diagram_id: str, seq: int, marker: int):
+        sse_manager.send_to_user(user_id, {
+            "type": "unread_update",
+            "diagram_id": diagram_id,
+            "unread_count": max(0, seq - marker),
+            "chat_seq": seq
+        })
+
+    async def annotate(self, db, user_id: str, diagrams: List[Dict[str, Any]]):
+        """Add unread_count to a page of diagram documents"""
+        markers = await self.load_markers(db, [(user_id, str(diagram["_id"])) for diagram in diagrams])
+        for diagram in diagrams:
+            diagram_id = str(diagram["_id"])
+            seq = diagram.get("chat_seq", 0) + self.pending_messages.get(diagram_id, 0)
+            diagram["unread_count"] = max(0, seq - markers[(user_id, diagram_id)])
+
+    async def unread_counts(self, db, user: dict) -> List[Dict[str, Any]]:
+        """Unread counts for every diagram the user owns or collaborates on"""
+        diagrams = await db.diagrams.find(
+            {"$or": [{"user_id": str(user["_id"])}, {"collaborators": user.get("email")}]},
+            {"chat_seq": 1}
+        ).to_list(length=None)
+        await self.annotate(db, str(user["_id"]), diagrams)
+        return diagrams
+
+    async def subscribe(self, db, user: dict) -> Dict[str, int]:
+        """Start pushing unread changes for every diagram the user owns or shares"""
+        user_id = str(user["_id"])
+        diagrams = await self.unread_counts(db, user)
+        for diagram in diagrams:
+            diagram_id = str(diagram["_id"])
+            self.watchers.setdefault(diagram_id, set()).add(user_id)
+            self.watched.setdefault(user_id, set()).add(diagram_id)
+            if diagram_id not in self.seq:
+                self._remember(self.seq, diagram_id, diagram.get("chat_seq", 0))
+        return {str(diagram["_id"]): diagram["unread_count"] for diagram in diagrams}
+
+    def unsubscribe(self, user_id: str):
+        if user_id in sse_manager.user_connections:
+            return  # another dashboard tab is still open
+        for diagram_id in self.watched.pop(user_id, set()):
+            watchers = self.watchers.get(diagram_id)
+            if watchers is not None:
+                watchers.discard(user_id)
+                if not watchers:
+                    del self.watchers[diagram_id]
+
+    async def flush(self):
+        """Write accumulated counter increments and read markers in two bulk operations"""
+        messages, self.pending_messages = self.pending_messages, {}
+        reads, self.pending_reads = self.pending_reads, {}
+        if not messages and not reads:
+            return
+        db = get_database()
+        now = datetime.utcnow()
+
+        if messages:
+            # Count the increments as persisted while the write is in flight
+            for diagram_id, count in messages.items():
+                if diagram_id in self.seq:
+                    self.seq[diagram_id] += count
+            self.inflight_messages = messages
+            items = list(messages.items())
+            try:
+                failed = await self._bulk_write(db.diagrams, [
+                    UpdateOne({"_id": ObjectId(diagram_id)}, {"$inc": {"chat_seq": count}, "$max": {"chat_at": now}})
+                    for diagram_id, count in items
+                ])
+            finally:
+                self.inflight_messages = {}
+            for index in failed:
+                diagram_id, count = items[index]
+                if diagram_id in self.seq:
+                    self.seq[diagram_id] -= count
+                self.pending_messages[diagram_id] = self.pending_messages.get(diagram_id, 0) + count
+            await self._refresh_seq(db, [diagram_id for diagram_id in messages if diagram_id in self.seq])
+
+        if reads:
+            for key, seq in reads.items():
+                self._remember(self.markers, key, max(seq, self.markers.get(key, 0)))
+            items = list(reads.items())
+            failed = await self._bulk_write(db.chat_read_markers, [
+                UpdateOne(
+                    {"_id": marker_id(user_id, diagram_id)},
+                    {"$max": {"seq": seq}, "$set": {"user_id": user_id, "diagram_id": diagram_id, "read_at": now}},
+                    upsert=True
+                )
+                for (user_id, diagram_id), seq in items
+            ])
+            # Markers are monotonic ($max), so retrying them is always safe
+            for index in failed:
+                key, seq = items[index]
+                self.pending_reads[key] = max(seq, self.pending_reads.get(key, 0))
+            # Read state is part of each reader's listings
+            user_ids = [ObjectId(user_id) for user_id in {user_id for user_id, _ in reads} if ObjectId.is_valid(user_id)]
+            try:
+                await db.users.update_many({"_id": {"$in": user_ids}}, {"$max": {"listings_changed_at": now}})
+            except PyMongoError as e:
+                logger.error("Listing watermark update failed: %s", e)
+
+    async def _refresh_seq(self, db, diagram_ids: List[str]):
+        """Pick up increments made by other workers for diagrams this one is counting"""
+        if not diagram_ids:
+            return
+        try:
+            async for diagram in db.diagrams.find(
+                {"_id": {"$in": [ObjectId(diagram_id) for diagram_id in diagram_ids]}}, {"chat_seq": 1}
+            ):
+                diagram_id = str(diagram["_id"])
+                if diagram_id in self.seq:
+                    self.seq[diagram_id] = diagram.get("chat_seq", 0)
+        except PyMongoError as e:
+            logger.error("Chat sequence refresh failed: %s", e)
+
+    async def _bulk_write(self, collection, operations: List[UpdateOne]) -> List[int]:
+        """Run an unordered bulk write; returns the indexes of operations that did not apply"""
+        try:
+            await collection.bulk_write(operations, ordered=False)
+            return []
+        except BulkWriteError as e:
+            errors = [(error.get("code"), error.get("errmsg")) for error in e.details.get("writeErrors", [])[:3]]
+            logger.error("Unread flush to %s partially failed: %s", collection.name, errors)
+            return [error["index"] for error in e.details.get("writeErrors", [])]
+        except PyMongoError as e:
+            logger.error("Unread flush to %s failed: %s", collection.name, e)
+            return list(range(len(operations)))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(UNREAD_FLUSH_INTERVAL_MS / 1000.0)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Unread flusher error: %s", e)
+
+
+# Global unread tracker instance
+unread_tracker = UnreadTracker()
@@ -2,15 +2,33 @@ from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPExce
 from typing import Dict, List, Set, Optional
 import json
 import logging
+import os
 import asyncio
+import time
 from datetime import datetime
 from bson import ObjectId
 
 from .models import DrawingAction, CanvasState, ChatMessage
-from .db import get_database
-from .auth import get_current_user
+from .db import get_collection, get_database
+from jose import JWTError, jwt
+from .auth import ALGORITHM, SECRET_KEY, get_current_user, get_user_by_email
+from .caching import diagram_cache
+from .thumbnails import thumbnail_service
+from .elements import apply_diagram_data
+from .chat_pipeline import chat_broadcast_data, chat_message_document, chat_pipeline
+from .unread import unread_tracker
+from . import metrics
+from .logging_config import diagram_debug
+from .persistence_policy import COALESCIBLE, DURABLE, action_coalescer, action_policy, canvas_actions
+from .presence import evictions, presence
+from .sharding import redirects, shard_router
+from .ratelimit import (
+    WS_MAX_CONNECTIONS_PER_DIAGRAM, WS_MAX_CONNECTIONS_PER_USER, WS_MAX_FRAME_BYTES,
+    WS_THROTTLE_NOTICE_SECONDS, rate_limiter, rejected
+)
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Connection manager for WebSocket connections
 class ConnectionManager:
@@ -19,37 +37,52 @@ class ConnectionManager:
         self.active_connections: Dict[str, List[WebSocket]] = {}
         # Store user info for each connection
         self.connection_users: Dict[WebSocket, dict] = {}
+        # Broadcast sequence number per room, so clients can tell whether they missed anything
+        self.room_seq: Dict[str, int] = {}
+        # Set while the worker drains; rooms already open here still accept joins
+        self.draining = False
+    
+    def admission_error(self, diagram_id: str, user_id: str) -> Optional[str]:
+        """Reason a new connection would exceed the room or per-user cap, if any"""
+        if self.draining and diagram_id not in self.active_connections:
+            return "draining"
+        if len(self.active_connections.get(diagram_id, ())) >= WS_MAX_CONNECTIONS_PER_DIAGRAM:
+            return "room_full"
+        if presence.user_connections.get(user_id, 0) >= WS_MAX_CONNECTIONS_PER_USER:
+            return "user_connection_limit"
+        return None
     
     async def connect(self, websocket: WebSocket, diagram_id: str, user: dict):
         await websocket.accept()
-        print(f"[DEBUG] WebSocket accepted for user {user['username']} in diagram {diagram_id}")
         
         if diagram_id not in self.active_connections:
             self.active_connections[diagram_id] = []
-            print(f"[DEBUG] Created new connection list for diagram {diagram_id}")
         
         self.active_connections[diagram_id].append(websocket)
         self.connection_users[websocket] = user
-        print(f"[DEBUG] Added connection. Total connections for diagram {diagram_id}: {len(self.active_connections[diagram_id])}")
+        first_connection = presence.join(websocket, diagram_id, user)
+        diagram_debug(logger, diagram_id, "WebSocket joined, %d connections in room",
+                      len(self.active_connections[diagram_id]), user_id=str(user["_id"]))
         
-        # Notify others about new user joining
-        await self.broadcast_to_diagram(diagram_id, {
-            "type": "user_joined",
-            "user": {
-                "id": str(user["_id"]),
-                "username": user["username"]
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        }, exclude=websocket)
+        # Notify others when the user arrives, not for each extra tab
+        if first_connection:
+            await self.broadcast_to_diagram(diagram_id, {
+                "type": "user_joined",
+                "user": {
+                    "id": str(user["_id"]),
+                    "username": user["username"]
+                },
+                "timestamp": datetime.utcnow().isoformat()
+            }, exclude=websocket)
     
     def disconnect(self, websocket: WebSocket, diagram_id: str):
         if diagram_id in self.active_connections:
             if websocket in self.active_connections[diagram_id]:
                 self.active_connections[diagram_id].remove(websocket)
                 
-                # Notify others about user leaving
-                if websocket in self.connection_users:
-                    user = self.connection_users[websocket]
+                # Notify others when the user's last connection leaves
+                user = self.connection_users.pop(websocket, None)
+                if presence.leave(websocket) and user is not None:
                     asyncio.create_task(self.broadcast_to_diagram(diagram_id, {
                         "type": "user_left",
                         "user": {
@@ -58,23 +91,24 @@ class ConnectionManager:
                         },
                         "timestamp": datetime.utcnow().isoformat()
                     }))
-                    del self.connection_users[websocket]
             
-            # Remove empty diagram rooms
+            # Remove empty diagram rooms; presence reaps their sequence and rate limit state later
             if not self.active_connections[diagram_id]:
                 del self.active_connections[diagram_id]
     
-    async def send_personal_message(self, message: str, websocket: WebSocket):
+    async def send_personal_message(self, message: str, websocket: WebSocket, message_type: str = "direct"):
         await websocket.send_text(message)
+        metrics.ws_frames_out.inc(message_type)
     
     async def broadcast_to_diagram(self, diagram_id: str, message: dict, exclude: Optional[WebSocket] = None):
         if diagram_id in self.active_connections:
-            message_str = json.dumps(message)
-            print(f"[DEBUG] Broadcasting message to {len(self.active_connections[diagram_id])} connections in diagram {diagram_id}")
-            print(f"[DEBUG] Message type: {message.get('type', 'unknown')}")
+            started = time.perf_counter()
+            message_type = message.get("type", "unknown")
+            seq = self.room_seq[diagram_id] = self.room_seq.get(diagram_id, 0) + 1
+            message_str = json.dumps({**message, "seq": seq})
             
             successful_sends = 0
-            failed_sends = 0
+            dead: List[WebSocket] = []
             
             for connection in self.active_connections[diagram_id]:
                 # Don't exclude anyone for chat messages to ensure all users get updates
@@ -82,41 +116,81 @@ class ConnectionManager:
                     try:
                         await connection.send_text(message_str)
                         successful_sends += 1
-                        print(f"[DEBUG] Message sent to connection successfully")
                     except Exception as e:
-                        failed_sends += 1
-                        print(f"[DEBUG] Failed to send message to connection: {e}")
-                        # Connection might be closed, will be cleaned up later
-                        pass
+                        dead.append(connection)
+                        diagram_debug(logger, diagram_id, "WebSocket send failed: %s", e)
+            
+            # A socket that cannot be written to is gone; stop paying for it on every broadcast
+            failed_sends = len(dead)
+            for connection in dead:
+                if connection in self.connection_users:
+                    evictions.inc("send_failed")
+                self.disconnect(connection, diagram_id)
             
-            print(f"[DEBUG] Broadcast complete: {successful_sends} successful, {failed_sends} failed")
-        else:
-            print(f"[DEBUG] No active connections found for diagram {diagram_id}")
+            diagram_debug(logger, diagram_id, "Broadcast %s to %d connections, %d failed",
+                          message_type, successful_sends, failed_sends)
+            metrics.ws_frames_out.inc(message_type, amount=successful_sends)
+            if failed_sends:
+                metrics.ws_send_failures.inc(message_type, amount=failed_sends)
+            metrics.broadcast_duration.observe(time.perf_counter() - started, message_type)
     
     def get_diagram_users(self, diagram_id: str) -> List[dict]:
         """Get list of active users in a diagram"""
-        if diagram_id not in self.active_connections:
-            return []
-        
-        users = []
-        for connection in self.active_connections[diagram_id]:
-            if connection in self.connection_users:
-                user = self.connection_users[connection]
-                users.append({
-                    "id": str(user["_id"]),
-                    "username": user["username"]
-                })
-        return users
+        return presence.users(diagram_id)
 
 # Global connection manager instance
 manager = ConnectionManager()
 
+# Canvas action log writes that may be in flight before senders wait for them
+ACTION_LOG_MAX_INFLIGHT = int(os.getenv("ACTION_LOG_MAX_INFLIGHT", "1000"))
+action_log_writes: Set[asyncio.Future] = set()
+
+def _action_log_written(task: asyncio.Future):
+    action_log_writes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Canvas action log write failed: %s", task.exception())
+
+async def log_canvas_actions(documents: List[dict]) -> Optional[asyncio.Future]:
+    """Append to the action log without holding up the broadcast; returns the write if still in flight"""
+    collection = get_collection("canvas_actions", "actions")
+    write = collection.insert_one(documents[0]) if len(documents) == 1 else collection.insert_many(documents)
+    if len(action_log_writes) >= ACTION_LOG_MAX_INFLIGHT:
+        # MongoDB is behind; make this sender wait rather than queue without bound
+        await write
+        return None
+    task = asyncio.ensure_future(write)
+    action_log_writes.add(task)
+    task.add_done_callback(_action_log_written)
+    return task
+
+async def wait_for_action_log():
+    """Wait for action log writes already started, so MongoDB is not closed under them"""
+    if action_log_writes:
+        await asyncio.gather(*list(action_log_writes), return_exceptions=True)
+
+# Message types clients may send; anything else is counted as "other"
+CLIENT_MESSAGE_TYPES = {"drawing_action", "chat_message", "cursor_position", "diagram_update", "pong"}
+
+# Room sizes are read at scrape time, never maintained on the hot path
+metrics.registry.gauge(
+    "websocket_connections", "Open WebSocket connections",
+    collect=lambda: [((), len(manager.connection_users))]
+)
+metrics.registry.gauge(
+    "websocket_rooms", "Diagrams with at least one WebSocket connection",
+    collect=lambda: [((), len(manager.active_connections))]
+)
+metrics.registry.gauge(
+    "websocket_room_connections", "Connections per diagram room (largest rooms only)", ("diagram_id",),
+    collect=lambda: metrics.top_rooms(manager.active_connections)
+)
+
 async def verify_diagram_access(diagram_id: str, user: dict):
     """Verify that user has access to the diagram"""
     db = get_database()
     
     try:
-        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)})
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, {"diagram_data": 0})
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid diagram ID")
     
@@ -141,48 +215,68 @@ async def verify_diagram_access(diagram_id: str, user: dict):
     return diagram
 
 @router.websocket("/ws/diagram/{diagram_id}")
-async def websocket_endpoint(websocket: WebSocket, diagram_id: str, token: str = Query(...)):
-    """WebSocket endpoint for real-time collaboration"""
-    print(f"[DEBUG] WebSocket connection attempt - diagram_id: {diagram_id}, token: {token[:20]}...")
+async def websocket_endpoint(
+    websocket: WebSocket,
+    diagram_id: str,
+    token: str = Query(...),
+    resume_chat_seq: Optional[int] = Query(None),
+    resume_version: Optional[int] = Query(None)
+):
+    """WebSocket endpoint for real-time collaboration.
+
+    Clients reconnecting after a drain pass back the chat_seq and version
+    from their reconnect hint; the chat replay is skipped when nothing
+    changed in between.
+    """
+    # Rooms live on one worker; send the client to it before doing any work here
+    redirect_url = shard_router.redirect_url(diagram_id)
+    if redirect_url:
+        redirects.inc("websocket")
+        await websocket.accept()
+        await websocket.send_text(json.dumps({"type": "reconnect", "seq": 0, "url": redirect_url, "reconnect_after_ms": 0}))
+        await websocket.close(code=1012)
+        return
     
     # Authenticate user using token
-    from jose import JWTError, jwt
-    from .auth import SECRET_KEY, ALGORITHM, get_user_by_email
-    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: Optional[str] = payload.get("sub")
         if email is None:
-            print(f"[DEBUG] No email in JWT payload")
+            logger.info("WebSocket rejected: token has no subject")
             await websocket.close(code=1008)
             return
         
         user = await get_user_by_email(email)
         if user is None:
-            print(f"[DEBUG] User not found for email: {email}")
+            logger.info("WebSocket rejected: unknown user")
             await websocket.close(code=1008)
             return
         
-        print(f"[DEBUG] User authenticated: {user['username']}")
-        
-    except JWTError as e:
-        print(f"[DEBUG] JWT decode error: {e}")
+    except JWTError:
+        logger.info("WebSocket rejected: invalid token")
         await websocket.close(code=1008)
         return
     
     # Verify diagram access
     try:
         diagram = await verify_diagram_access(diagram_id, user)
-        print(f"[DEBUG] Diagram access verified for {user['username']} on diagram {diagram_id}")
     except HTTPException as e:
-        print(f"[DEBUG] Diagram access denied: {e.detail}")
+        logger.info("WebSocket rejected: %s", e.detail, extra={"diagram_id": diagram_id, "user_id": str(user["_id"])})
         await websocket.close(code=1008)
         return
     
+    # Admission control: bounded rooms and connections per user
+    user_id = str(user["_id"])
+    reason = manager.admission_error(diagram_id, user_id)
+    if reason:
+        rejected.inc(reason)
+        logger.info("WebSocket rejected: %s", reason, extra={"diagram_id": diagram_id, "user_id": user_id})
+        # Draining workers send clients straight elsewhere; full ones ask them to back off
+        await websocket.close(code=1012 if reason == "draining" else 1013)
+        return
+    
     # Connect to the diagram room
-    print(f"[DEBUG] Connecting user {user['username']} to diagram {diagram_id}")
     await manager.connect(websocket, diagram_id, user)
-    print(f"[DEBUG] WebSocket connected successfully")
     
     try:
         # Send current active users to the new connection
@@ -191,12 +285,78 @@ async def websocket_endpoint(websocket: WebSocket, diagram_id: str, token: str =
             "type": "active_users",
             "users": active_users,
             "timestamp": datetime.utcnow().isoformat()
-        }), websocket)
+        }), websocket, "active_users")
+        
+        chat_seq = await unread_tracker.current_seq(get_database(), diagram_id, fresh=True)
+        version = diagram.get("version", 1)
+        if resume_chat_seq is not None:
+            await manager.send_personal_message(json.dumps({
+                "type": "resumed",
+                "chat_seq": chat_seq,
+                "version": version,
+                # Without the version it had, the client cannot know its copy is current
+                "stale": resume_version != version,
+                "timestamp": datetime.utcnow().isoformat()
+            }), websocket, "resumed")
+        if resume_chat_seq is None or resume_chat_seq != chat_seq:
+            # Replay the recent chat so the client can render it without a fetch
+            recent = await chat_pipeline.recent_messages(diagram_id)
+            await manager.send_personal_message(json.dumps({
+                "type": "chat_history",
+                "messages": [chat_broadcast_data(message) for message in recent.messages],
+                "complete": recent.complete,
+                "timestamp": datetime.utcnow().isoformat()
+            }), websocket, "chat_history")
+        await unread_tracker.mark_read(user_id, diagram_id)
+        
+        # Last throttle notice sent per message type, so a flood gets one notice per interval
+        throttle_notices: Dict[str, float] = {}
         
         # Main message loop
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
+            # Any frame proves the connection is alive
+            presence.touch(websocket)
+            # Checked before parsing so oversized frames cost no JSON work. The limit is in
+            # UTF-8 bytes; a character is 1-4 bytes, so only frames near it are encoded
+            if len(data) > WS_MAX_FRAME_BYTES or (
+                len(data) * 4 > WS_MAX_FRAME_BYTES and len(data.encode("utf-8")) > WS_MAX_FRAME_BYTES
+            ):
+                rejected.inc("frame_too_large")
+                await manager.send_personal_message(json.dumps({
+                    "type": "error",
+                    "error": "frame_too_large",
+                    "max_bytes": WS_MAX_FRAME_BYTES
+                }), websocket, "error")
+                manager.disconnect(websocket, diagram_id)
+                await websocket.close(code=1009)
+                return
+            try:
+                message = json.loads(data)
+                message_type = message["type"]
+                if not isinstance(message_type, str):
+                    raise TypeError("message type must be a string")
+            except (ValueError, TypeError, KeyError):
+                rejected.inc("invalid_frame")
+                await manager.send_personal_message(json.dumps({"type": "error", "error": "invalid_message"}), websocket, "error")
+                continue
+            kind = message_type if message_type in CLIENT_MESSAGE_TYPES else "other"
+            metrics.ws_frames_in.inc(kind)
+            if kind == "pong":
+                continue
+            
+            retry_after = rate_limiter.admit(user_id, diagram_id, kind)
+            if retry_after is not None:
+                now = time.monotonic()
+                if now - throttle_notices.get(kind, 0.0) >= WS_THROTTLE_NOTICE_SECONDS:
+                    throttle_notices[kind] = now
+                    # Backpressure: tell the client to slow down instead of silently dropping
+                    await manager.send_personal_message(json.dumps({
+                        "type": "throttled",
+                        "message_type": kind,
+                        "retry_after_ms": int(retry_after * 1000) + 1
+                    }), websocket, "throttled")
+                continue
             
             # Handle different message types
             if message["type"] == "drawing_action":
@@ -211,13 +371,11 @@ async def websocket_endpoint(websocket: WebSocket, diagram_id: str, token: str =
     except WebSocketDisconnect:
         manager.disconnect(websocket, diagram_id)
     except Exception as e:
-        logging.error(f"WebSocket error: {e}")
+        logger.error("WebSocket error: %s", e, extra={"diagram_id": diagram_id})
         manager.disconnect(websocket, diagram_id)
 
 async def handle_drawing_action(diagram_id: str, user: dict, message: dict, websocket: WebSocket):
     """Handle drawing actions (pen, eraser, shapes, etc.)"""
-    db = get_database()
-    
     # Create drawing action record
     action = DrawingAction(
         action_type=message["data"]["action_type"],
@@ -225,9 +383,15 @@ async def handle_drawing_action(diagram_id: str, user: dict, message: dict, webs
         user_id=str(user["_id"])
     )
     
-    # Save to database if it's a persistent action
-    if message["data"]["action_type"] in ["draw", "add_shape", "add_text"]:
-        await db.canvas_actions.insert_one(action.dict())
+    # Persist according to the action type's policy; ephemeral actions are only broadcast
+    policy = action_policy(action.action_type)
+    canvas_actions.inc(policy)
+    if policy == DURABLE:
+        document = {**action.model_dump(), "diagram_id": diagram_id}
+        earlier = await action_coalescer.take(document)
+        action_coalescer.track(document, await log_canvas_actions(earlier + [document]))
+    elif policy == COALESCIBLE:
+        await action_coalescer.submit({**action.model_dump(), "diagram_id": diagram_id})
     
     # Broadcast to other users
     await manager.broadcast_to_diagram(diagram_id, {
@@ -242,55 +406,23 @@ async def handle_drawing_action(diagram_id: str, user: dict, message: dict, webs
 
 async def handle_chat_message(diagram_id: str, user: dict, message: dict, websocket: WebSocket):
     """Handle incoming chat messages and broadcast to all users"""
-    db = get_database()
-    
-    print(f"[DEBUG] Handling chat message from user {user['username']} in diagram {diagram_id}")
-    print(f"[DEBUG] Message data: {message['data']}")
-    
-    # Create chat message document
-    chat_message = {
-        "diagram_id": diagram_id,
-        "user_id": str(user["_id"]),
-        "username": user["username"],
-        "user_avatar": user.get("avatar"),
-        "message": message["data"]["message"],
-        "message_type": message["data"].get("message_type", "text"),
-        "reply_to": message["data"].get("reply_to"),
-        "created_at": datetime.utcnow(),
-        "is_edited": False,
-        "is_deleted": False,
-        "reactions": {}
-    }
-    
-    result = await db.chat_messages.insert_one(chat_message)
-    
-    print(f"[DEBUG] Message saved to DB with ID: {result.inserted_id}")
-    
-    # Broadcast to all users in the diagram
-    broadcast_message = {
-        "type": "chat_message",
-        "data": {
-            "id": str(result.inserted_id),
-            "message": message["data"]["message"],
-            "message_type": chat_message["message_type"],
-            "reply_to": chat_message["reply_to"],
-            "user": {
-                "id": str(user["_id"]),
-                "username": user["username"],
-                "avatar": user.get("avatar")
-            },
-            "created_at": chat_message["created_at"].isoformat(),
-            "is_edited": False,
-            "reactions": {}
-        },
-        "timestamp": datetime.utcnow().isoformat()
-    }
-    
-    print(f"[DEBUG] Broadcasting message to {len(manager.active_connections.get(diagram_id, []))} connections")
-    # Broadcast to ALL users in the diagram (including sender for consistency)
-    await manager.broadcast_to_diagram(diagram_id, broadcast_message)
-    
-    print(f"[DEBUG] Message broadcast completed successfully")
+    chat_message = chat_message_document(
+        diagram_id,
+        user,
+        message["data"]["message"],
+        message["data"].get("message_type", "text"),
+        message["data"].get("reply_to")
+    )
+    # Broadcasts to ALL users in the diagram (including sender for consistency)
+    try:
+        await chat_pipeline.submit(chat_message)
+    except HTTPException:
+        # Storage is down and the buffer is full; the client takes the message back to resend
+        await manager.send_personal_message(json.dumps({
+            "type": "throttled",
+            "message_type": "chat_message",
+            "retry_after_ms": 1000
+        }), websocket, "throttled")
 
 async def handle_cursor_position(diagram_id: str, user: dict, message: dict, websocket: WebSocket):
     """Handle cursor position updates"""
@@ -317,12 +449,17 @@ async def handle_diagram_update(diagram_id: str, user: dict, message: dict, webs
     if "title" in message["data"]:
         update_data["title"] = message["data"]["title"]
     if "diagram_data" in message["data"]:
-        update_data["diagram_data"] = message["data"]["diagram_data"]
+        diagram = await db.diagrams.find_one({"_id": ObjectId(diagram_id)}, {"storage": 1})
+        if diagram:
+            await apply_diagram_data(db, diagram, message["data"]["diagram_data"], update_data)
     
-    await db.diagrams.update_one(
+    await get_collection("diagrams", "durable").update_one(
         {"_id": ObjectId(diagram_id)},
-        {"$set": update_data}
+        {"$set": update_data, "$inc": {"version": 1}}
     )
+    diagram_cache.invalidate(diagram_id)
+    if "diagram_data" in message["data"]:
+        thumbnail_service.schedule(diagram_id)
     
     # Broadcast update to other users
     await manager.broadcast_to_diagram(diagram_id, {
@@ -0,0 +1,113 @@
+"""Exercise the AI gateway against a local stub standing in for Gemini.
+
+Starts a stub server on localhost that can be slow, flaky or broken on
+demand, points the gateway at it and checks caching, coalescing of
+identical uploads, retry on 503, timeouts and the concurrency limit.
+
+    python benchmarks/ai_gateway_stub.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+# The gateway reads its configuration at import time
+os.environ.setdefault("GEMINI_API_KEY", "stub-key")
+os.environ["GEMINI_API_URL"] = "http://127.0.0.1:8765/analyze"
+os.environ.setdefault("AI_READ_TIMEOUT", "0.5")
+os.environ.setdefault("AI_RETRY_BASE_MS", "20")
+os.environ.setdefault("AI_MAX_CONCURRENCY", "2")
+os.environ.setdefault("AI_QUEUE_TIMEOUT", "0.3")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import uvicorn  # noqa: E402
+
+from app.ai_gateway import AIGatewayError, ai_gateway  # noqa: E402
+
+
+class StubGemini:
+    """Minimal ASGI app: the X-Mode header of the test selects the behaviour"""
+
+    def __init__(self):
+        self.calls = 0
+        self.mode = "ok"
+        self.failures_left = 0
+        self.delay = 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        while (await receive()).get("more_body"):
+            pass
+        self.calls += 1
+        status, body = 200, b'{"elements": []}'
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failures_left > 0:
+            self.failures_left -= 1
+            status, body = 503, b'{"error": "unavailable"}'
+        elif self.mode == "bad_request":
+            status, body = 400, b'{"error": "bad image"}'
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def expect_error(coro, status_code: int) -> bool:
+    try:
+        await coro
+    except AIGatewayError as e:
+        return e.status_code == status_code
+    return False
+
+
+async def main() -> int:
+    stub = StubGemini()
+    server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=8765, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    ai_gateway.start()
+    results = {}
+    try:
+        stub.calls = 0
+        await ai_gateway.clean_diagram(b"image-a", "a.png")
+        await ai_gateway.clean_diagram(b"image-a", "a.png")
+        results["cache hit skips upstream"] = stub.calls == 1
+
+        stub.calls, stub.delay = 0, 0.1
+        await asyncio.gather(*(ai_gateway.clean_diagram(b"image-b", "b.png") for _ in range(10)))
+        results["identical uploads coalesced"] = stub.calls == 1
+
+        stub.calls, stub.delay, stub.failures_left = 0, 0.0, 2
+        await ai_gateway.clean_diagram(b"image-c", "c.png")
+        results["retried through two 503s"] = stub.calls == 3
+
+        stub.calls, stub.mode = 0, "bad_request"
+        results["400 is not retried"] = await expect_error(ai_gateway.clean_diagram(b"image-d", "d.png"), 502) and stub.calls == 1
+        stub.mode = "ok"
+
+        stub.delay = 1.0
+        started = time.perf_counter()
+        results["read timeout gives 504"] = await expect_error(ai_gateway.clean_diagram(b"image-e", "e.png"), 504)
+        results["timeout bounded by retries"] = time.perf_counter() - started < 3 * 0.5 + 1
+
+        outcomes = await asyncio.gather(
+            *(ai_gateway.clean_diagram(f"image-f{i}".encode(), "f.png") for i in range(4)),
+            return_exceptions=True
+        )
+        results["excess calls rejected with 503"] = any(
+            isinstance(outcome, AIGatewayError) and outcome.status_code == 503 for outcome in outcomes
+        )
+    finally:
+        await ai_gateway.stop()
+        server.should_exit = True
+        await serving
+
+    for name, passed in results.items():
+        print(f"{'ok  ' if passed else 'FAIL'} {name}")
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,97 @@
+"""Concurrent chat reaction load test.
+
+Registers N users, has each of them react to the same message at the same
+time (and optionally toggle a second emoji on and off), then checks that
+the stored reactions contain exactly the expected users.
+
+Run against a live server:
+    pip install httpx
+    python benchmarks/reaction_load.py --base-url http://localhost:8000 --users 100
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+
+import httpx
+
+
+async def register(client: httpx.AsyncClient, prefix: str, index: int) -> dict:
+    name = f"{prefix}{index}"
+    response = await client.post("/auth/register", json={
+        "username": name,
+        "email": f"{name}@example.com",
+        "password": "loadtest1"
+    })
+    response.raise_for_status()
+    data = response.json()
+    return {"id": data["user"]["_id"], "headers": {"Authorization": f"Bearer {data['access_token']}"}}
+
+
+async def run(base_url: str, users: int, rounds: int):
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        prefix = f"rl{uuid.uuid4().hex[:6]}_"
+        accounts = await asyncio.gather(*(register(client, prefix, i) for i in range(users)))
+        owner = accounts[0]
+
+        diagram = (await client.post("/diagrams/", json={"title": "reaction load", "is_public": True}, headers=owner["headers"])).json()
+        diagram_id = diagram["_id"]
+        message = (await client.post(f"/chat/{diagram_id}/messages", json={"message": "react to me"}, headers=owner["headers"])).json()
+        message_id = message["_id"]
+        url = f"/chat/{diagram_id}/messages/{message_id}/reactions"
+
+        latencies = []
+
+        async def react(account: dict, emoji: str):
+            start = time.perf_counter()
+            response = await client.post(url, params={"emoji": emoji}, headers=account["headers"])
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+        start = time.perf_counter()
+        # Everyone adds 👍 at once
+        await asyncio.gather(*(react(account, "👍") for account in accounts))
+        # Every user toggles 🎉 an even number of times, so it must end up empty
+        for _ in range(rounds):
+            await asyncio.gather(*(react(account, "🎉") for account in accounts))
+            await asyncio.gather(*(react(account, "🎉") for account in accounts))
+        elapsed = time.perf_counter() - start
+
+        messages = (await client.get(f"/chat/{diagram_id}/messages", headers=owner["headers"])).json()
+        reactions = next(m for m in messages if m["_id"] == message_id)["reactions"]
+        await client.delete(f"/diagrams/{diagram_id}", headers=owner["headers"])
+
+    expected = {account["id"] for account in accounts}
+    thumbs = set(reactions.get("👍", []))
+    lost = len(expected - thumbs)
+    latencies.sort()
+    result = {
+        "users": users,
+        "requests": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        "lost_updates": lost,
+        "unexpected_users": len(thumbs - expected),
+        "leftover_toggles": len(reactions.get("🎉", []))
+    }
+    print(json.dumps(result, indent=2))
+    return lost == 0 and result["unexpected_users"] == 0 and result["leftover_toggles"] == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent chat reaction load test")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3, help="Add/remove toggle rounds per user")
+    args = parser.parse_args()
+    ok = asyncio.run(run(args.base_url, args.users, args.rounds))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Run the API for benchmarking, against a real MongoDB or an in-memory mongomock-motor.
+
+    python benchmarks/serve.py --port 8799                     # mongomock-motor
+    python benchmarks/serve.py --port 8799 --mongo-url mongodb://localhost:27017
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def use_mongomock():
+    """Swap the Mongo connection for an in-memory database"""
+    from mongomock_motor import AsyncMongoMockClient
+    import mongomock.collection
+
+    import app.db as db
+    import app.main as main
+
+    async def connect():
+        db.mongodb.client = AsyncMongoMockClient()
+        db.mongodb.database = db.mongodb.client[db.DATABASE_NAME]
+
+    async def close():
+        pass
+
+    main.connect_to_mongo = connect
+    main.close_mongo_connection = close
+
+    # mongomock's bulk builder predates the `sort` argument newer pymongo passes to update ops
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+
+    mongomock.collection.BulkOperationBuilder.add_update = add_update_without_sort
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--mongo-url", help="MongoDB to use instead of mongomock-motor")
+    args = parser.parse_args()
+
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+        os.environ.setdefault("DATABASE_NAME", "diagramming_bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import uvicorn
+    from app.main import app
+
+    if not args.mongo_url:
+        use_mongomock()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", ws_max_size=16 * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""Reproducible REST and WebSocket benchmark suite.
+
+Boots the API in a subprocess (benchmarks/serve.py, mongomock-motor unless
+--mongo-url is given), or targets --base-url. It simulates ROOMS x CLIENTS
+WebSocket clients sending drawing actions, cursor moves and chat at the
+given per-client rates, then runs micro-benchmarks. Results are written
+as JSON.
+
+    pip install httpx websockets
+    python benchmarks/suite.py --rooms 10 --clients 10 --duration 20 --output results/head.json
+    python benchmarks/suite.py compare results/base.json results/head.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p90/p99/max in milliseconds"""
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p90_ms": None, "p99_ms": None, "max_ms": None}
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": at(0.50), "p90_ms": at(0.90), "p99_ms": at(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_until_up(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not come up")
+
+
+async def register(client: httpx.AsyncClient, name: str) -> Dict[str, str]:
+    response = await client.post("/auth/register", json={"username": name, "email": f"{name}@example.com", "password": "benchmark1"})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+class Room:
+    def __init__(self, diagram_id: str, token: str):
+        self.diagram_id = diagram_id
+        self.token = token
+
+
+class Client:
+    """One simulated collaborator: sends at fixed rates and timestamps what it receives"""
+
+    def __init__(self, index: int, room: Room, ws_url: str, latencies: Dict[str, List[float]], counts: Dict[str, int]):
+        self.index = index
+        self.room = room
+        self.url = f"{ws_url}/ws/diagram/{room.diagram_id}?token={room.token}"
+        self.latencies = latencies
+        self.counts = counts
+        self.socket = None
+
+    async def connect(self):
+        self.socket = await websockets.connect(self.url, max_size=None)
+
+    async def receive(self):
+        async for raw in self.socket:
+            message = json.loads(raw)
+            kind = message.get("type")
+            if kind == "ping":
+                await self.socket.send(json.dumps({"type": "pong"}))
+                continue
+            if kind in ("drawing_action", "cursor_position"):
+                sent_at, sender = message["data"].get("bench_ts"), message["data"].get("bench_client")
+            elif kind == "chat_message":
+                parts = message["data"]["message"].split(":")
+                if parts[0] != "bench":
+                    continue
+                sender, sent_at = int(parts[1]), float(parts[2])
+            else:
+                continue
+            if sent_at is None or sender == self.index:
+                continue
+            self.latencies[kind].append(time.perf_counter() - sent_at)
+            self.counts["received"] += 1
+
+    async def send_loop(self, kind: str, rate: float, until: float):
+        if rate <= 0:
+            return
+        interval = 1.0 / rate
+        # Spread clients over the first interval so they do not send in lockstep
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.perf_counter() < until:
+            now = time.perf_counter()
+            if kind == "chat_message":
+                payload = {"type": kind, "data": {"message": f"bench:{self.index}:{now}"}}
+            elif kind == "cursor_position":
+                payload = {"type": kind, "data": {"x": random.random() * 1000, "y": random.random() * 1000, "bench_ts": now, "bench_client": self.index}}
+            else:
+                payload = {"type": kind, "data": {
+                    "action_type": "stroke_progress",
+                    "points": [{"x": random.random() * 1000, "y": random.random() * 1000} for _ in range(8)],
+                    "bench_ts": now, "bench_client": self.index
+                }}
+            await self.socket.send(json.dumps(payload))
+            self.counts["sent"] += 1
+            await asyncio.sleep(interval)
+
+
+async def server_metric_average(client: httpx.AsyncClient, name: str) -> Optional[float]:
+    """Mean of a histogram from /metrics across all label sets, in milliseconds"""
+    try:
+        text = (await client.get("/metrics")).text
+    except httpx.HTTPError:
+        return None
+    total = count = 0.0
+    for line in text.splitlines():
+        if line.startswith(f"{name}_sum"):
+            total += float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_count"):
+            count += float(line.rsplit(" ", 1)[1])
+    return round(total / count * 1000, 3) if count else None
+
+
+async def websocket_load(base_url: str, server_pid: Optional[int], args) -> Dict[str, Any]:
+    ws_url = base_url.replace("http", "ws", 1)
+    latencies: Dict[str, List[float]] = {"drawing_action": [], "cursor_position": [], "chat_message": []}
+    counts = {"sent": 0, "received": 0}
+    prefix = f"b{uuid.uuid4().hex[:6]}"
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as http:
+        rooms = []
+        for r in range(args.rooms):
+            headers = await register(http, f"{prefix}r{r}")
+            diagram = (await http.post("/diagrams/", json={"title": f"bench room {r}", "is_public": True}, headers=headers)).json()
+            rooms.append(Room(diagram["_id"], headers["Authorization"].split()[1]))
+
+        rss_before = rss_bytes(server_pid) if server_pid else None
+        clients = [Client(r * args.clients + c, room, ws_url, latencies, counts) for r, room in enumerate(rooms) for c in range(args.clients)]
+        for start in range(0, len(clients), 50):
+            await asyncio.gather(*(client.connect() for client in clients[start:start + 50]))
+        await asyncio.sleep(1)
+        rss_after = rss_bytes(server_pid) if server_pid else None
+
+        receivers = [asyncio.create_task(client.receive()) for client in clients]
+        started = time.perf_counter()
+        until = started + args.duration
+        await asyncio.gather(*(
+            client.send_loop(kind, rate, until)
+            for client in clients
+            for kind, rate in (("drawing_action", args.draw_rate), ("cursor_position", args.cursor_rate), ("chat_message", args.chat_rate))
+        ))
+        # Let in-flight broadcasts land before closing
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - started
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*(client.socket.close() for client in clients), return_exceptions=True)
+        fanout_ms = await server_metric_average(http, "websocket_broadcast_seconds")
+
+    connections = len(clients)
+    return {
+        "connections": connections,
+        "sent": counts["sent"],
+        "delivered": counts["received"],
+        "sent_per_second": round(counts["sent"] / elapsed, 1),
+        "delivered_per_second": round(counts["received"] / elapsed, 1),
+        "broadcast_latency": {kind: percentiles(samples) for kind, samples in latencies.items()},
+        "broadcast_latency_all": percentiles([sample for samples in latencies.values() for sample in samples]),
+        "server_fanout_mean_ms": fanout_ms,
+        "server_rss_bytes": rss_after,
+        "memory_per_connection_bytes": (rss_after - rss_before) // connections if rss_before and rss_after and connections else None
+    }
+
+
+def time_calls(function, iterations: int) -> Dict[str, Any]:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return {**percentiles(samples), "ops_per_second": round(iterations / sum(samples), 1)}
+
+
+async def time_async_calls(function, iterations: int) -> Dict[str, Any]:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await function()
+        samples.append(time.perf_counter() - start)
+    return {**percentiles(samples), "ops_per_second": round(iterations / sum(samples), 1)}
+
+
+def synthetic_diagram(elements: int) -> Dict[str, Any]:
+    from bson import ObjectId
+
+    return {
+        "_id": ObjectId(),
+        "title": "benchmark",
+        "description": "synthetic diagram",
+        "diagram_data": {
+            "elements": [
+                {"id": f"el{i}", "type": "rect", "x": i * 3.5, "y": i * 1.25, "width": 120, "height": 80,
+                 "stroke": "#333", "points": [{"x": j, "y": j * 2} for j in range(4)]}
+                for i in range(elements)
+            ],
+            "canvas_state": {"zoom": 1, "offset": {"x": 0, "y": 0}}
+        },
+        "user_id": "u1",
+        "is_public": False,
+        "collaborators": [],
+        "version": 3,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }
+
+
+async def micro_benchmarks(base_url: str, args) -> Dict[str, Any]:
+    from bson import ObjectId
+
+    from app.ai_service import predict_shape
+    from app.chat_cache import normalize_chat_message
+    from app.models import ChatMessageResponse, DiagramResponse, UserResponse
+    from app.responses import diagram_document, dump_model, dumps, from_document
+
+    results: Dict[str, Any] = {}
+    circle = {"points": [{"x": 100 + 50 * random.random(), "y": 100 + 50 * random.random()} for _ in range(200)]}
+    circle["points"].append(dict(circle["points"][0]))
+    results["predict_shape"] = await time_async_calls(lambda: predict_shape(circle), args.iterations)
+
+    diagram = synthetic_diagram(args.elements)
+    document = diagram_document(diagram)
+    results["serialize_orjson"] = time_calls(lambda: dumps(diagram_document(diagram)), args.iterations)
+    results["serialize_stdlib_json"] = time_calls(lambda: json.dumps(document, default=str), args.iterations)
+    results["serialize_pydantic"] = time_calls(lambda: DiagramResponse(**document).model_dump_json(by_alias=True), args.iterations)
+
+    # Response models: validate and dump to a dict then json (FastAPI's response_model path)
+    # against model_construct on trusted data written straight to bytes
+    chat_message = {
+        "_id": ObjectId(), "diagram_id": "d1", "user_id": "u1", "username": "bench", "user_avatar": None,
+        "message": "x" * 120, "message_type": "text", "reply_to": None, "created_at": datetime.utcnow(),
+        "is_edited": False, "is_deleted": False, "reactions": {"+1": ["u1", "u2"]}
+    }
+    user = {
+        "_id": ObjectId(), "username": "bench", "email": "bench@example.com", "password": "hash",
+        "full_name": "Bench User", "created_at": datetime.utcnow(), "last_login": None, "is_active": True
+    }
+    page = [chat_message] * 50
+    results["chat_page_validate"] = time_calls(lambda: json.dumps([
+        ChatMessageResponse(**normalize_chat_message(message)).model_dump(mode="json", by_alias=True) for message in page
+    ]), args.iterations)
+    results["chat_page_construct"] = time_calls(lambda: dump_model([
+        from_document(ChatMessageResponse, normalize_chat_message(message)) for message in page
+    ]), args.iterations)
+    results["user_validate"] = time_calls(
+        lambda: json.dumps(UserResponse(**{**user, "_id": str(user["_id"])}).model_dump(mode="json", by_alias=True)), args.iterations
+    )
+    results["user_construct"] = time_calls(lambda: dump_model(from_document(UserResponse, user)), args.iterations)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as http:
+        headers = await register(http, f"l{uuid.uuid4().hex[:8]}")
+        elements = synthetic_diagram(args.elements)["diagram_data"]["elements"]
+        for i in range(args.listing_diagrams):
+            await http.post("/diagrams/", json={"title": f"listing {i}", "diagram_data": {"elements": elements, "canvas_state": {}}}, headers=headers)
+        for name, params in (("listing_full", {"limit": 50}), ("listing_summary", {"limit": 50, "include_elements": "false"})):
+            async def fetch():
+                (await http.get("/diagrams/", params=params, headers=headers)).raise_for_status()
+            results[name] = await time_async_calls(fetch, args.iterations // 10 or 1)
+    return results
+
+
+def compare(base_path: str, head_path: str) -> int:
+    """Print relative change of every numeric leaf between two result files"""
+    with open(base_path) as base_file, open(head_path) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+
+    def leaves(node, path=""):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                yield from leaves(value, f"{path}.{key}" if path else key)
+        elif isinstance(node, (int, float)) and not isinstance(node, bool):
+            yield path, node
+
+    head_values = dict(leaves(head["results"]))
+    print(f"{'metric':60} {'base':>12} {'head':>12} {'change':>8}")
+    for path, old in leaves(base["results"]):
+        new = head_values.get(path)
+        if new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{path:60} {old:>12} {new:>12} {change:>8}")
+    return 0
+
+
+async def run(args) -> Dict[str, Any]:
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        base_url = f"http://127.0.0.1:{args.port}"
+        command = [sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "serve.py"), "--port", str(args.port)]
+        if args.mongo_url:
+            command += ["--mongo-url", args.mongo_url]
+        server = subprocess.Popen(command, cwd=BACKEND_DIR)
+    try:
+        await wait_until_up(base_url)
+        random.seed(args.seed)
+        results = {"websocket": await websocket_load(base_url, server.pid if server else None, args)}
+        results["micro"] = await micro_benchmarks(base_url, args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "backend": "external" if args.base_url else ("mongodb" if args.mongo_url else "mongomock"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("command", "output")},
+        "results": results
+    }
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        if len(sys.argv) != 4:
+            sys.exit("usage: suite.py compare BASE.json HEAD.json")
+        sys.exit(compare(sys.argv[2], sys.argv[3]))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="Benchmark a running server instead of booting one")
+    parser.add_argument("--mongo-url", help="Boot against this MongoDB instead of mongomock-motor")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=5, help="clients per room")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--draw-rate", type=float, default=10, help="drawing actions per client per second")
+    parser.add_argument("--cursor-rate", type=float, default=20, help="cursor moves per client per second")
+    parser.add_argument("--chat-rate", type=float, default=0.5, help="chat messages per client per second")
+    parser.add_argument("--iterations", type=int, default=1000, help="micro-benchmark iterations")
+    parser.add_argument("--elements", type=int, default=500, help="elements per synthetic diagram")
+    parser.add_argument("--listing-diagrams", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON here (default: stdout)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+        print(f"Results written to {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
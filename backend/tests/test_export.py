@@ -0,0 +1,40 @@
+from xml.dom.minidom import parseString
+
+import pytest
+
+from app.export import svg_element
+
+HOSTILE = '1" onload="alert(1)'
+
+
+@pytest.mark.parametrize("element", [
+    {"type": "pen", "width": HOSTILE, "points": [{"x": 0, "y": 0}, {"x": 5, "y": 5}]},
+    {"type": "pen", "points": [{"x": HOSTILE, "y": 0}]},
+    {"type": "line", "points": [{"x": 0, "y": HOSTILE}, {"x": 5, "y": 5}]},
+    {"type": "rect", "points": [{"x": 0, "y": 0}, {"x": HOSTILE, "y": 5}]},
+    {"type": "circle", "center": {"x": HOSTILE, "y": 0}, "radius": 3},
+    {"type": "circle", "center": {"x": 0, "y": 0}, "radius": HOSTILE},
+    {"type": "image", "src": "data:,", "x": 0, "y": 0, "width": HOSTILE, "height": 5},
+    {"type": "text", "text": "hi", "x": HOSTILE, "y": 0},
+])
+def test_hostile_numeric_fields_skip_the_element(element):
+    assert svg_element(element) == ""
+
+
+def test_numbers_and_strings_are_escaped():
+    fragment = svg_element({
+        "type": "text", "text": "<script>", "x": "12", "y": 3.5, "color": '"><script>alert(1)</script>'
+    })
+    node = parseString(fragment).documentElement
+    assert node.tagName == "text"
+    assert set(node.attributes.keys()) == {"x", "y", "fill"}
+    assert node.getAttribute("x") == "12.0"
+    assert node.firstChild.data == "<script>"
+
+
+def test_rect_is_normalised():
+    fragment = svg_element({"type": "rect", "width": 4, "points": [{"x": 10, "y": 8}, {"x": 2, "y": 1}]})
+    node = parseString(fragment).documentElement
+    assert [node.getAttribute(name) for name in ("x", "y", "width", "height", "stroke-width")] == [
+        "2.0", "1.0", "8.0", "7.0", "4.0"
+    ]
@@ -29,6 +29,11 @@ api.interceptors.request.use(
 api.interceptors.response.use(
   (response) => response,
   (error) => {
+    const shardUrl = error.response?.data?.detail?.url;
+    if (error.response?.status === 421 && shardUrl && !error.config._shardRetry) {
+      // The diagram lives on another worker; repeat the request there once
+      return api.request({ ...error.config, baseURL: shardUrl, _shardRetry: true });
+    }
     if (error.response?.status === 401) {
       // Token expired or invalid
       localStorage.removeItem('token');
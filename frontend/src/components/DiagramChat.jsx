@@ -12,6 +12,12 @@ const DiagramChat = ({ diagramId, isOpen, onToggle }) => {
   const [editingMessage, setEditingMessage] = useState(null);
   const [replyingTo, setReplyingTo] = useState(null);
   const messagesEndRef = useRef(null);
+  // Drain handoff: the server's reconnect hint, the last room sequence number seen, and the pending retry
+  const reconnectHintRef = useRef(null);
+  const lastSeqRef = useRef(0);
+  const reconnectTimerRef = useRef(null);
+  // Base URL of the worker that owns this room, once the server has pointed us at one
+  const shardUrlRef = useRef(null);
   const { user } = useAuth();
 
   // Auto-scroll to bottom when new messages arrive
@@ -29,6 +35,7 @@ const DiagramChat = ({ diagramId, isOpen, onToggle }) => {
     }
 
     return () => {
+      clearTimeout(reconnectTimerRef.current);
       if (websocket) {
         websocket.close();
       }
@@ -64,7 +71,7 @@ const DiagramChat = ({ diagramId, isOpen, onToggle }) => {
     }
   };
 
-  const connectWebSocket = async () => {
+  const connectWebSocket = async (resume = null) => {
     if (!user || !diagramId || diagramId === 'new') {
       console.log('Skipping WebSocket connection for new diagram');
       return;
@@ -87,20 +94,43 @@ const DiagramChat = ({ diagramId, isOpen, onToggle }) => {
         const backendHost = backendUrl.replace(/^https?:\/\//, '').replace(/:\d+$/, '');
         wsUrl = `${wsProtocol}//${backendHost}:8000/ws/diagram/${diagramId}?token=${token}`;
       }
+      if (shardUrlRef.current) {
+        wsUrl = `${shardUrlRef.current}/ws/diagram/${diagramId}?token=${token}`;
+      }
+      if (resume) {
+        // Lets the server skip replaying chat we already have
+        wsUrl += `&resume_chat_seq=${resume.chat_seq}`;
+        // The hint has no version when the server could not read the diagram
+        if (resume.version !== null && resume.version !== undefined) {
+          wsUrl += `&resume_version=${resume.version}`;
+        }
+      }
       
       console.log('Connecting to WebSocket:', wsUrl);
       const ws = new WebSocket(wsUrl);
 
       ws.onopen = () => {
         console.log('WebSocket connected');
+        lastSeqRef.current = 0;
         setIsConnected(true);
       };
 
       ws.onmessage = (event) => {
         const data = JSON.parse(event.data);
+        if (data.type === 'ping') {
+          // Heartbeat: answer so the server keeps us in the room
+          ws.send(JSON.stringify({ type: 'pong' }));
+          return;
+        }
         console.log('🔔 WebSocket message received:', data);
+        if (data.seq) {
+          lastSeqRef.current = data.seq;
+        }
         
-        if (data.type === 'chat_message') {
+        if (data.type === 'reconnect') {
+          // The server is draining; it closes us next and says when to come back
+          reconnectHintRef.current = data;
+        } else if (data.type === 'chat_message') {
           console.log('💬 Processing chat message:', data.data);
           const newMsg = {
             id: data.data.id,
@@ -136,12 +166,63 @@ const DiagramChat = ({ diagramId, isOpen, onToggle }) => {
             console.log('📊 Current messages count:', prev.length, '-> New count:', prev.length + 1);
             return [...prev, newMsg];
           });
+        } else if (data.type === 'chat_history') {
+          // Recent messages replayed by the server on join
+          const history = data.messages.map(msg => ({
+            id: msg.id,
+            message: msg.message,
+            username: msg.user.username,
+            user_id: msg.user.id,
+            created_at: msg.created_at,
+            is_edited: msg.is_edited || false,
+            reactions: msg.reactions || {},
+            reply_to: msg.reply_to || null
+          }));
+          setMessages(prev => {
+            const known = new Set(prev.map(msg => msg.id));
+            const merged = [...prev, ...history.filter(msg => !known.has(msg.id))];
+            return merged.sort((a, b) => new Date(a.created_at) - new Date(b.created_at));
+          });
+        } else if (data.type === 'reaction_update') {
+          // Apply the delta idempotently so it agrees with our own response
+          const { message_id, emoji, user_id, action } = data.data;
+          setMessages(prev => prev.map(msg => {
+            if (msg.id !== message_id) return msg;
+            const reactions = { ...msg.reactions };
+            const users = (reactions[emoji] || []).filter(id => id !== user_id);
+            if (action === 'added') users.push(user_id);
+            if (users.length > 0) {
+              reactions[emoji] = users;
+            } else {
+              delete reactions[emoji];
+            }
+            return { ...msg, reactions };
+          }));
+        } else if (data.type === 'throttled' && data.message_type === 'chat_message') {
+          // The server dropped our last message; take back the optimistic copy so it can be resent
+          console.warn(`Chat throttled, retry in ${data.retry_after_ms} ms`);
+          setMessages(prev => {
+            const index = prev.map(msg => msg.is_sending).lastIndexOf(true);
+            if (index === -1) return prev;
+            setNewMessage(current => current || prev[index].message);
+            return [...prev.slice(0, index), ...prev.slice(index + 1)];
+          });
         }
       };
 
       ws.onclose = () => {
         console.log('WebSocket disconnected');
         setIsConnected(false);
+        const hint = reconnectHintRef.current;
+        reconnectHintRef.current = null;
+        if (hint) {
+          if (hint.url) {
+            shardUrlRef.current = hint.url;
+          }
+          // Only resume if we saw every broadcast before the handoff, otherwise take the full replay
+          const resume = hint.chat_seq !== undefined && lastSeqRef.current >= hint.seq ? hint : null;
+          reconnectTimerRef.current = setTimeout(() => connectWebSocket(resume), hint.reconnect_after_ms);
+        }
       };
 
       ws.onerror = (error) => {
@@ -272,25 +353,11 @@ const DiagramChat = ({ diagramId, isOpen, onToggle }) => {
 
   const addReaction = async (messageId, emoji) => {
     try {
-      await chat.addReaction(diagramId, messageId, emoji);
-      // Update local state - this will be replaced by WebSocket update
-      setMessages(prev => prev.map(msg => {
-        if (msg.id === messageId) {
-          const reactions = { ...msg.reactions };
-          if (!reactions[emoji]) reactions[emoji] = [];
-          
-          const userIndex = reactions[emoji].indexOf(user?.id);
-          if (userIndex > -1) {
-            reactions[emoji].splice(userIndex, 1);
-            if (reactions[emoji].length === 0) delete reactions[emoji];
-          } else {
-            reactions[emoji].push(user?.id);
-          }
-          
-          return { ...msg, reactions };
-        }
-        return msg;
-      }));
+      const response = await chat.addReaction(diagramId, messageId, emoji);
+      // The server toggles atomically and returns the resulting reactions
+      setMessages(prev => prev.map(msg => 
+        msg.id === messageId ? { ...msg, reactions: response.reactions || {} } : msg
+      ));
     } catch (error) {
       console.error('Error adding reaction:', error);
     }
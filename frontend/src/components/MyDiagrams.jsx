@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
 import { useAuth } from '../contexts/AuthContext';
 import { diagrams } from '../api';
+import { useUnreadCounts } from '../hooks/useSSE';
 import ShareModal from './ShareModal';
 import Header from './Header';
 
@@ -14,6 +15,7 @@ const MyDiagrams = () => {
   const [shareModalOpen, setShareModalOpen] = useState(false);
   const [selectedDiagram, setSelectedDiagram] = useState(null);
   const { user, logout } = useAuth();
+  const unreadCounts = useUnreadCounts(!!user);
 
   useEffect(() => {
     console.log('MyDiagrams useEffect triggered, user:', user);
@@ -228,7 +230,14 @@ const MyDiagrams = () => {
                         <tr key={diagram._id || diagram.id} className="border-t border-t-[#dbe0e6] hover:bg-gray-50">
                           <td className="h-[72px] px-4 py-2 w-[400px] text-[#111418] text-sm font-normal leading-normal">
                             <div>
-                              <div className="font-medium">{diagram.title}</div>
+                              <div className="font-medium flex items-center gap-2">
+                                {diagram.title}
+                                {(unreadCounts[diagram._id || diagram.id] ?? diagram.unread_count) > 0 && (
+                                  <span className="rounded-full bg-[#0d80f2] px-2 py-0.5 text-xs font-bold text-white">
+                                    {unreadCounts[diagram._id || diagram.id] ?? diagram.unread_count}
+                                  </span>
+                                )}
+                              </div>
                               {diagram.description && (
                                 <div className="text-[#60758a] text-xs mt-1">{diagram.description}</div>
                               )}
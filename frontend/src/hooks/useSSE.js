@@ -93,3 +93,22 @@ export const useDiagramSSE = (diagramId, onMessage) => {
 
   return useSSE(url, { onMessage });
 };
+
+// Live unread chat counts for the user's diagrams, keyed by diagram id
+export const useUnreadCounts = (enabled = true) => {
+  const [counts, setCounts] = useState({});
+  const baseUrl = process.env.NODE_ENV === 'production' 
+    ? (process.env.REACT_APP_API_URL || 'http://localhost:8000')
+    : '';
+
+  const handleMessage = (message) => {
+    if (message.type === 'unread_snapshot') {
+      setCounts(message.counts || {});
+    } else if (message.type === 'unread_update') {
+      setCounts((previous) => ({ ...previous, [message.diagram_id]: message.unread_count }));
+    }
+  };
+
+  useSSE(enabled ? `${baseUrl}/chat/unread/stream` : null, { onMessage: handleMessage });
+  return counts;
+};